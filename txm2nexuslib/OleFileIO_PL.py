@@ -20,7 +20,9 @@
 
 #------------------------------------------------------------------------------
 
-import string, StringIO, struct, array, os.path, sys
+import string, StringIO, struct, array, os, os.path, sys, mmap, bisect
+import hashlib, json, tempfile, threading
+import numpy as np
 
 #[PL] workaround to fix an issue with array item size on 64 bits systems:
 if array.array('L').itemsize == 4:
@@ -42,6 +44,17 @@ KEEP_UNICODE_NAMES = True
 # command line to change it.
 DEBUG_MODE = False
 
+# Directory of the OLE layout cache: None by default (no cache), use
+# set_layout_cache_dir() or the cache_dir argument of OleFileIO to change it.
+LAYOUT_CACHE_DIR = None
+
+# Memory-mapped mode: False by default, use set_use_mmap() or the use_mmap
+# argument of OleFileIO to change it.
+USE_MMAP = False
+
+# Version of the layout cache files, files of other versions are ignored:
+LAYOUT_CACHE_VERSION = 1
+
 
 MAGIC = '\320\317\021\340\241\261\032\341'
 
@@ -115,6 +128,24 @@ def isOleFile (filename):
         return False
 
 
+def set_layout_cache_dir(cache_dir):
+    """
+    Set the default directory of the OLE layout cache, used by OleFileIO
+    objects created without the cache_dir argument (None to disable it).
+    """
+    global LAYOUT_CACHE_DIR
+    LAYOUT_CACHE_DIR = cache_dir
+
+
+def set_use_mmap(use_mmap):
+    """
+    Set the default mode of the OleFileIO objects created without the
+    use_mmap argument: memory-mapped if use_mmap is True.
+    """
+    global USE_MMAP
+    USE_MMAP = use_mmap
+
+
 def i16(c, o = 0):
     """
     Converts a 2-bytes (16 bits) string to an integer.
@@ -199,6 +230,186 @@ except NameError:
         
         
 
+def _run_length(fat, sect, max_length):
+    """
+    Return the number of consecutive sectors (sect, sect+1, ...) chained in
+    the FAT from sect, without exceeding max_length. The FAT is compared with
+    the expected indexes by blocks of growing size, so that a long run of
+    sectors only costs a few numpy comparisons.
+
+    fat       : numpy array of sector indexes (FAT or MiniFAT)
+    sect      : sector index of first sector of the run
+    max_length: maximum number of sectors of the run
+    """
+    # a corrupt FAT may chain its last sector past its end, which must not be
+    # part of the run:
+    max_length = min(max_length, len(fat) - sect)
+    if max_length <= 1 or fat[sect] != sect + 1:
+        return 1
+    n = 2
+    block = 64
+    while n < max_length:
+        start = sect + n - 1
+        values = fat[start:start + min(block, max_length - n)]
+        if not len(values):
+            break
+        mismatch = np.flatnonzero(
+            values != np.arange(start + 1, start + 1 + len(values)))
+        if mismatch.size:
+            return n + int(mismatch[0])
+        n += len(values)
+        block *= 2
+    return n
+
+
+def _sector_chain(sect, size, sectorsize, fat, unknown_size=False):
+    """
+    Follow a chain of sectors in the FAT (or MiniFAT), with the sanity checks
+    needed to detect malformed documents. The chain is followed by runs of
+    consecutive sectors (see _run_length).
+
+    sect        : sector index of first sector in the stream
+    size        : total size of the stream (maximum size if unknown_size)
+    sectorsize  : size of one sector
+    fat         : numpy array of sector indexes (FAT or MiniFAT)
+    unknown_size: if True, the chain may end before size is reached
+    return      : list of (first sector index, number of sectors) tuples, one
+                  per run of consecutive sectors of the stream, in order
+    """
+    #[PL] To detect malformed documents with FAT loops, we compute the
+    # expected number of sectors in the stream:
+    nb_sectors = (size + (sectorsize-1)) / sectorsize
+    # This number should (at least) be less than the total number of
+    # sectors in the given FAT:
+    if nb_sectors > len(fat):
+        raise IOError, 'malformed OLE document, stream too large'
+    # if size is zero, then first sector index should be ENDOFCHAIN:
+    if size == 0 and sect != ENDOFCHAIN:
+        if DEBUG_MODE:
+            print 'size == 0 and sect != ENDOFCHAIN:'
+        raise IOError, 'incorrect OLE sector index for empty stream'
+    runs = []
+    nb_read = 0
+    # Every iteration adds at least one sector to the chain, so the loop
+    # cannot run more than nb_sectors times, even with loops in the FAT:
+    while nb_read < nb_sectors:
+        # Sector index may be ENDOFCHAIN, but only if size was unknown
+        if sect == ENDOFCHAIN:
+            if unknown_size:
+                break
+            else:
+                # else this means that the stream is smaller than declared:
+                if DEBUG_MODE:
+                    print 'sect=ENDOFCHAIN before expected size'
+                raise IOError, 'incomplete OLE stream'
+        # sector index should be within FAT:
+        if sect<0 or sect>=len(fat):
+            if DEBUG_MODE:
+                print 'sect=%d (%X) / len(fat)=%d' % (sect, sect, len(fat))
+                print 'read=%d / nb_sectors=%d' %(nb_read, nb_sectors)
+            raise IOError, 'incorrect OLE FAT, sector index out of range'
+        length = _run_length(fat, sect, nb_sectors - nb_read)
+        runs.append((sect, length))
+        nb_read += length
+        # jump to next sector in the FAT:
+        sect = int(fat[sect + length - 1])
+    # Last sector should be a "end of chain" marker:
+    if sect != ENDOFCHAIN:
+        raise IOError, 'incorrect last sector index in OLE stream'
+    return runs
+
+
+def _chain_extents(runs, offset, sectorsize, size):
+    """
+    Convert the runs of consecutive sectors of a stream into extents of bytes,
+    so that each extent can be read with a single seek and read.
+
+    runs      : list of (first sector, number of sectors) tuples, as returned
+                by _sector_chain
+    offset    : offset in bytes for the first sector
+    sectorsize: size of one sector
+    size      : size of the stream, the last extent is truncated to it
+    return    : list of (offset, length) tuples, in stream order
+    """
+    extents = []
+    remaining = size
+    for sect, nb_sect in runs:
+        if remaining <= 0:
+            break
+        start = offset + sectorsize * sect
+        length = min(sectorsize * nb_sect, remaining)
+        if extents and extents[-1][0] + extents[-1][1] == start:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+        else:
+            extents.append((start, length))
+        remaining -= length
+    return extents
+
+
+def _map_extents(extents, container_extents):
+    """
+    Translate extents given relative to a stream (for example the MiniStream)
+    into extents of the file containing that stream.
+
+    extents          : list of (offset, length) tuples inside the stream
+    container_extents: extents of the stream in the file
+    return           : list of (offset, length) tuples in the file
+    """
+    starts = []
+    pos = 0
+    for c_offset, c_length in container_extents:
+        starts.append(pos)
+        pos += c_length
+    mapped = []
+    for offset, length in extents:
+        if offset + length > pos:
+            raise IOError, 'OLE stream extent out of range'
+        i = bisect.bisect_right(starts, offset) - 1
+        while length > 0:
+            c_offset, c_length = container_extents[i]
+            skip = offset - starts[i]
+            n = min(length, c_length - skip)
+            start = c_offset + skip
+            if mapped and mapped[-1][0] + mapped[-1][1] == start:
+                mapped[-1] = (mapped[-1][0], mapped[-1][1] + n)
+            else:
+                mapped.append((start, n))
+            offset += n
+            length -= n
+            i += 1
+    return mapped
+
+
+def _pread(fp, offset, length, lock=None):
+    """
+    Read length bytes of a file at the given offset, in a way which is safe
+    when several threads read the same file object: os.pread is used when it
+    is available (it does not use nor change the file position), otherwise
+    the seek and the read are done while holding lock.
+
+    fp    : file object (file on disk or StringIO)
+    offset: position of the first byte to read
+    length: number of bytes to read
+    lock  : lock shared by all the readers of fp, or None if fp is only used
+            by one thread
+    return: string of at most length bytes (less at the end of the file)
+    """
+    if _pread_fd is not None and hasattr(fp, 'fileno'):
+        return _pread_fd(fp.fileno(), length, offset)
+    if lock is None:
+        fp.seek(offset)
+        return fp.read(length)
+    lock.acquire()
+    try:
+        fp.seek(offset)
+        return fp.read(length)
+    finally:
+        lock.release()
+
+# positional read of a file descriptor (os.pread appeared in Python 3.3):
+_pread_fd = getattr(os, 'pread', None)
+
+
 #=== CLASSES ==================================================================
 
 #--- _OleStream ---------------------------------------------------------------
@@ -217,10 +428,12 @@ class _OleStream(StringIO.StringIO):
 
     Attributes:
         - size: actual size of data stream, after it was opened.
+        - extents: list of (offset, length) tuples of consecutive bytes of
+          the stream in fp.
     """
 
 
-    def __init__(self, fp, sect, size, offset, sectorsize, fat):
+    def __init__(self, fp, sect, size, offset, sectorsize, fat, lock=None):
         """
         Constructor for _OleStream class.
 
@@ -229,7 +442,8 @@ class _OleStream(StringIO.StringIO):
         size      : total size of the stream
         offset    : offset in bytes for the first FAT or MiniFAT sector
         sectorsize: size of one sector
-        fat       : array/list of sector indexes (FAT or MiniFAT)
+        fat       : numpy array of sector indexes (FAT or MiniFAT)
+        lock      : lock shared by the threads reading fp (see _pread)
         return    : a StringIO instance containing the OLE stream
         """
         if DEBUG_MODE:
@@ -240,8 +454,6 @@ class _OleStream(StringIO.StringIO):
             filesize = len(fp.getvalue())   # file in MiniFAT
         else:
             filesize = os.path.getsize(fp.name) # file on disk
-        #[PL] To detect malformed documents with FAT loops, we compute the
-        # expected number of sectors in the stream:
         unknown_size = False
         if size==0x7FFFFFFF:
             # this is the case when called from OleFileIO._open(), and stream
@@ -251,67 +463,33 @@ class _OleStream(StringIO.StringIO):
             # and we keep a record that size was unknown:
             unknown_size = True
             if DEBUG_MODE: print '  stream with UNKNOWN SIZE'
-        nb_sectors = (size + (sectorsize-1)) / sectorsize
-        #print 'nb_sectors = %d' % nb_sectors
-        # This number should (at least) be less than the total number of
-        # sectors in the given FAT:
-        if nb_sectors > len(fat):
-            raise IOError, 'malformed OLE document, stream too large'
+        # The whole chain is followed first, and runs of consecutive sectors
+        # are converted to extents, which are read with a single call each
+        # (image streams are usually stored in a few runs of sectors).
+        runs = _sector_chain(sect, size, sectorsize, fat, unknown_size)
+        extents = _chain_extents(runs, offset, sectorsize, size)
         # optimization(?): data is first a list of strings, and join() is called
         # at the end to concatenate all in one string.
-        # (this may not be really useful with recent Python versions)
         data = []
-        # if size is zero, then first sector index should be ENDOFCHAIN:
-        if size == 0 and sect != ENDOFCHAIN:
-            if DEBUG_MODE:
-                print 'size == 0 and sect != ENDOFCHAIN:'
-            raise IOError, 'incorrect OLE sector index for empty stream'
-        #[ A fixed-length for loop is used instead of an undefined while
-        # loop to avoid DoS attacks:
-        for i in xrange(nb_sectors):
-            # Sector index may be ENDOFCHAIN, but only if size was unknown
-            if sect == ENDOFCHAIN:
-                if unknown_size:
-                    break
-                else:
-                    # else this means that the stream is smaller than declared:
-                    if DEBUG_MODE:
-                        print 'sect=ENDOFCHAIN before expected size'
-                    raise IOError, 'incomplete OLE stream'
-            # sector index should be within FAT:
-            if sect<0 or sect>=len(fat):
-                if DEBUG_MODE:
-                    print 'sect=%d (%X) / len(fat)=%d' % (sect, sect, len(fat))
-                    print 'i=%d / nb_sectors=%d' %(i, nb_sectors)
-
-                raise IOError, 'incorrect OLE FAT, sector index out of range'
-
+        for ext_offset, ext_length in extents:
             try:
-                fp.seek(offset + sectorsize * sect)
+                ext_data = _pread(fp, ext_offset, ext_length, lock)
             except:
                 if DEBUG_MODE:
-                    print 'sect=%d, seek=%d, filesize=%d' % (sect, offset+sectorsize*sect, filesize)
+                    print 'seek=%d, filesize=%d' % (ext_offset, filesize)
                 raise IOError, 'OLE sector index out of range'
-            sector_data = fp.read(sectorsize)
             # [PL] check if there was enough data:
             # Note: if sector is the last of the file, sometimes it is not a
             # complete sector (of 512 or 4K), so we may read less than
             # sectorsize.
-            if len(sector_data)!=sectorsize and sect!=(len(fat)-1):
-                if DEBUG_MODE:
-                    print 'sect=%d / len(fat)=%d, seek=%d / filesize=%d, len read=%d' % (sect, len(fat), offset+sectorsize*sect, filesize, len(sector_data))
-                    print 'seek+len(read)=%d' % (offset+sectorsize*sect+len(sector_data))
-                raise IOError, 'incomplete OLE sector'
-            data.append(sector_data)
-            # jump to next sector in the FAT:
-            try:
-                sect = fat[sect]
-            except IndexError:
-                #  if pointer is out of the FAT an exception is raised
-                raise IOError, 'incorrect OLE FAT, sector index out of range'
-        # Last sector should be a "end of chain" marker:
-        if sect != ENDOFCHAIN:
-            raise IOError, 'incorrect last sector index in OLE stream'
+            if len(ext_data) != ext_length:
+                last_sect = (ext_offset + ext_length - 1 - offset) / sectorsize
+                if (last_sect != (len(fat)-1) or
+                        len(ext_data) < ext_length - sectorsize):
+                    if DEBUG_MODE:
+                        print 'seek=%d / filesize=%d, len read=%d / %d' % (ext_offset, filesize, len(ext_data), ext_length)
+                    raise IOError, 'incomplete OLE sector'
+            data.append(ext_data)
         data = string.join(data, "")
         # Data is truncated to the actual stream size:
         if len(data) >= size:
@@ -327,11 +505,232 @@ class _OleStream(StringIO.StringIO):
             if DEBUG_MODE:
                 print 'len(data)=%d, size=%d' % (len(data), size)
             raise IOError, 'OLE stream size is less than declared'
+        # extents of the stream in fp, available for callers planning I/O:
+        self.extents = _chain_extents(runs, offset, sectorsize, self.size)
         # when all data is read in memory, StringIO constructor is called
         StringIO.StringIO.__init__(self, data)
         # Then the _OleStream object can be used as a read-only file object.
 
 
+#--- _OleLazyStream -----------------------------------------------------------
+
+class _OleLazyStream:
+    """
+    OLE2 Stream read on demand
+
+    Read-only file object over a stream of the FAT. Only the sector chain is
+    followed when the stream is opened: data is read from the OLE container
+    when it is requested, touching only the sectors which cover the requested
+    byte range (for instance, stream.read(112) reads 112 bytes, whatever the
+    size of the stream). Each read is done at an absolute position of the
+    file (see _pread), so streams of the same container can be read by
+    several threads at the same time. To open a stream, use the openstream
+    method in the OleFile class.
+
+    Attributes:
+        - size: actual size of data stream.
+        - extents: list of (offset, length) tuples of consecutive bytes of
+          the stream in the file.
+    """
+
+    def __init__(self, fp, sect, size, offset, sectorsize, fat,
+                 extents=None, lock=None):
+        """
+        Constructor for _OleLazyStream class.
+
+        fp        : file object of the OLE container
+        sect      : sector index of first sector in the stream
+        size      : total size of the stream
+        offset    : offset in bytes for the first FAT sector
+        sectorsize: size of one sector
+        fat       : numpy array of sector indexes (FAT)
+        extents   : list of (offset, length) tuples of the stream in the file,
+                    if already known (from the layout cache). The sector
+                    chain is then not followed, and sect, offset, sectorsize
+                    and fat are not used.
+        lock      : lock shared by the threads reading fp (see _pread)
+        """
+        if DEBUG_MODE:
+            print '%s.__init__:\n' % self.__class__.__name__
+            print '  sect=%d (%X), size=%d, extents=%s \n\n' %(sect,sect,size,repr(extents))
+        self.fp = fp
+        self.lock = lock
+        self.size = size
+        if extents is None:
+            extents = _chain_extents(
+                _sector_chain(sect, size, sectorsize, fat), offset,
+                sectorsize, size)
+        self.extents = extents
+        # start position of every extent in the stream, to seek with bisect:
+        self._starts = []
+        pos = 0
+        for ext_offset, ext_length in self.extents:
+            self._starts.append(pos)
+            pos += ext_length
+        self._pos = 0
+
+    def _ranges(self, start, end):
+        """
+        Return the (offset, length) pieces of the file which contain the
+        bytes of the stream from start to end.
+        """
+        ranges = []
+        i = bisect.bisect_right(self._starts, start) - 1
+        while start < end:
+            ext_offset, ext_length = self.extents[i]
+            skip = start - self._starts[i]
+            n = min(end - start, ext_length - skip)
+            ranges.append((ext_offset + skip, n))
+            start += n
+            i += 1
+        return ranges
+
+    def _end(self, size):
+        if size is None or size < 0:
+            return self.size
+        return min(self._pos + size, self.size)
+
+    def _read_range(self, offset, length):
+        """
+        Read length bytes of the file at the given offset.
+        """
+        data = _pread(self.fp, offset, length, self.lock)
+        if len(data) != length:
+            if DEBUG_MODE:
+                print 'seek=%d, length=%d, len read=%d' % (offset, length, len(data))
+            raise IOError, 'incomplete OLE sector'
+        return data
+
+    def _readinto_range(self, view, offset, length):
+        """
+        Read length bytes of the file at the given offset into view, a
+        memoryview of bytes.
+        """
+        if _pread_fd is None and hasattr(self.fp, 'readinto'):
+            if self.lock is not None:
+                self.lock.acquire()
+            try:
+                self.fp.seek(offset)
+                if self.fp.readinto(view) != length:
+                    raise IOError, 'incomplete OLE sector'
+            finally:
+                if self.lock is not None:
+                    self.lock.release()
+        else:
+            view[:] = self._read_range(offset, length)
+
+    def read(self, size=-1):
+        """
+        Read at most size bytes from the current position (all the remaining
+        stream if size is negative or omitted).
+        """
+        end = self._end(size)
+        data = [self._read_range(offset, length)
+                for offset, length in self._ranges(self._pos, end)]
+        self._pos = max(self._pos, end)
+        return string.join(data, "")
+
+    def readinto(self, b):
+        """
+        Read at most len(b) bytes from the current position into b, without
+        building intermediate strings.
+
+        b     : writable one-dimensional buffer of bytes, for example a
+                bytearray or a numpy array viewed as uint8.
+        return: number of bytes read
+        """
+        view = memoryview(b)
+        if view.ndim != 1 or view.itemsize != 1:
+            raise TypeError, 'readinto needs a one-dimensional buffer of bytes'
+        end = self._end(len(view))
+        pos = 0
+        for offset, length in self._ranges(self._pos, end):
+            self._readinto_range(view[pos:pos+length], offset, length)
+            pos += length
+        self._pos = max(self._pos, end)
+        return pos
+
+    def seek(self, pos, mode=0):
+        if mode == 1:
+            pos += self._pos
+        elif mode == 2:
+            pos += self.size
+        self._pos = max(0, pos)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+
+#--- _OleMappedStream ---------------------------------------------------------
+
+class _OleMappedStream(_OleLazyStream):
+    """
+    OLE2 Stream backed by a memory-mapped OLE container
+
+    Read-only file object over a stream of the FAT, which does not copy the
+    stream data: it keeps a list of buffer objects (one per extent of
+    consecutive sectors) pointing into the mapped file. Those segments can be
+    handed directly to numpy.frombuffer, or read as a file through
+    read/readinto/seek/tell.
+    To open a stream in this mode, use OleFileIO(filename, use_mmap=True) and
+    the openstream method.
+
+    Attributes:
+        - size: actual size of data stream.
+        - extents: list of (offset, length) tuples of consecutive bytes of
+          the stream in the file.
+        - segments: list of buffer objects over the mapped file, one per
+          extent, in stream order.
+    """
+
+    def __init__(self, mm, sect, size, offset, sectorsize, fat,
+                 extents=None):
+        """
+        Constructor for _OleMappedStream class.
+
+        mm        : mmap object of the OLE container
+        sect      : sector index of first sector in the stream
+        size      : total size of the stream
+        offset    : offset in bytes for the first FAT sector
+        sectorsize: size of one sector
+        fat       : numpy array of sector indexes (FAT)
+        extents   : list of (offset, length) tuples of the stream in the file,
+                    if already known (see _OleLazyStream)
+        """
+        _OleLazyStream.__init__(self, mm, sect, size, offset, sectorsize,
+                                fat, extents)
+        filesize = len(mm)
+        self.segments = []
+        for start, length in self.extents:
+            if start + length > filesize:
+                if DEBUG_MODE:
+                    print 'seek=%d, length=%d, filesize=%d' % (start, length, filesize)
+                raise IOError, 'incomplete OLE sector'
+            self.segments.append(buffer(mm, start, length))
+
+    def getbuffer(self):
+        """
+        Return the whole stream as a single object supporting the buffer
+        interface. No copy is done if the stream is stored in one segment,
+        otherwise the segments are joined in a new string.
+        """
+        if len(self.segments) == 1:
+            return self.segments[0]
+        return string.join([str(segment) for segment in self.segments], "")
+
+    def _read_range(self, offset, length):
+        return self.fp[offset:offset+length]
+
+    def _readinto_range(self, view, offset, length):
+        view[:] = self.fp[offset:offset+length]
+
+    def close(self):
+        self.segments = []
+
+
 #--- _OleDirectoryEntry -------------------------------------------------------
 
 class _OleDirectoryEntry:
@@ -558,6 +957,31 @@ class _OleDirectoryEntry:
             kid.dump(tab + 2)
 
 
+#--- _OleCachedEntry ----------------------------------------------------------
+
+class _OleCachedEntry(_OleDirectoryEntry):
+    """
+    OLE2 Directory Entry restored from the layout cache
+
+    Holds the same attributes as _OleDirectoryEntry, which are used to find
+    and open streams, plus the extents of the stream in the OLE file (None
+    for storages), so that the FAT does not need to be loaded.
+    """
+
+    def __init__(self, sid, name, entry_type, size, isectStart, clsid,
+                 extents):
+        self.sid = sid
+        self.name = name
+        self.entry_type = entry_type
+        self.size = size
+        self.isectStart = isectStart
+        self.clsid = clsid
+        self.extents = extents
+        self.kids = []
+        self.kids_dict = {}
+        self.used = True
+
+
 #--- OleFileIO ----------------------------------------------------------------
 
 class OleFileIO:
@@ -589,7 +1013,8 @@ class OleFileIO:
     TIFF files).
     """
 
-    def __init__(self, filename = None, raise_defects=DEFECT_FATAL):
+    def __init__(self, filename = None, raise_defects=DEFECT_FATAL,
+                 use_mmap=None, cache_dir=None):
         """
         Constructor for OleFileIO class.
 
@@ -597,8 +1022,25 @@ class OleFileIO:
         raise_defects: minimal level for defects to be raised as exceptions.
         (use DEFECT_FATAL for a typical application, DEFECT_INCORRECT for a
         security-oriented application, see source code for details)
+        use_mmap: if True, the file is memory-mapped and openstream returns
+        streams which do not copy the data of the FAT (see _OleMappedStream).
+        If None, files on disk are memory-mapped when USE_MMAP is True.
+        cache_dir: directory of the layout cache (LAYOUT_CACHE_DIR if None).
+        The directory and the extents of all the streams of a file are saved
+        there when it is first opened, and loaded instead of the FAT and the
+        directory when it is opened again, as long as the path, size and
+        modification time of the file did not change.
         """
         self._raise_defects_level = raise_defects
+        self._use_mmap = use_mmap
+        self._mmap = None
+        if cache_dir is None:
+            cache_dir = LAYOUT_CACHE_DIR
+        self._cache_dir = cache_dir
+        self._layout_cached = False
+        # lock shared by all the streams reading self.fp, so that streams can
+        # be opened and read by several threads at the same time (see _pread):
+        self._lock = threading.RLock()
         if filename:
             self.open(filename)
 
@@ -625,7 +1067,11 @@ class OleFileIO:
         """
         Close an OLE2 file.
 
+        In memory-mapped mode, the map is not closed explicitly: the segments
+        of the streams opened, and the arrays built over them, may still use
+        it. It is released when the last of them is freed.
         """
+        self._mmap = None
         self.fp.close()
             
 
@@ -655,11 +1101,31 @@ class OleFileIO:
         self._used_streams_fat = []
         self._used_streams_minifat = []
 
+        # the layout cache is only used for files on disk:
+        cache_file = None
+        if self._cache_dir and not hasattr(filename, 'read'):
+            cache_file, file_key = self._layout_cache_key(filename)
+            layout = self._read_layout(cache_file, file_key)
+            if layout is not None:
+                try:
+                    self._load_layout(layout)
+                except (AttributeError, KeyError, IndexError, TypeError,
+                        ValueError):
+                    # malformed layout, the file is parsed instead:
+                    if DEBUG_MODE: print 'layout cache invalid: %s' % cache_file
+                    self._layout_cached = False
+                    layout = None
+            if layout is not None:
+                self._open_mmap()
+                return
+
         header = self.fp.read(512)
 
         if len(header) != 512 or header[:8] != MAGIC:
             self._raise_defect(DEFECT_FATAL, "not an OLE2 structured storage file")
 
+        self._open_mmap()
+
         # [PL] header structure according to AAF specifications:
         ##Header
         ##struct StructuredStorageHeader { // [offset from start (bytes), length (bytes)]
@@ -799,6 +1265,130 @@ class OleFileIO:
         self.ministream = None
         self.minifatsect = self.MiniFatStart #i32(header, 60)
 
+        if cache_file is not None:
+            self._write_layout(cache_file, file_key)
+
+
+    def _open_mmap(self):
+        """
+        Map the OLE file in memory, in memory-mapped mode.
+        """
+        use_mmap = self._use_mmap
+        if use_mmap is None:
+            use_mmap = USE_MMAP and hasattr(self.fp, 'fileno')
+        if use_mmap:
+            if not hasattr(self.fp, 'fileno'):
+                raise IOError, 'memory-mapped mode needs a file on disk'
+            self._mmap = mmap.mmap(self.fp.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+
+    def _layout_cache_key(self, filename):
+        """
+        Return the path of the layout cache file of an OLE file, and the key
+        (hash of the path, size and modification time) which must match for
+        the cached layout to be used.
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        path_hash = hashlib.sha1(path).hexdigest()
+        cache_file = os.path.join(self._cache_dir, path_hash + '.json')
+        return cache_file, [path_hash, stat.st_size, stat.st_mtime]
+
+
+    def _read_layout(self, cache_file, file_key):
+        """
+        Return the layout saved in the cache file, or None if there is no
+        valid layout for this version of the file.
+        """
+        try:
+            f = open(cache_file, 'rb')
+            try:
+                layout = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        if (not isinstance(layout, dict) or
+                layout.get('version') != LAYOUT_CACHE_VERSION or
+                layout.get('key') != file_key):
+            if DEBUG_MODE: print 'layout cache outdated: %s' % cache_file
+            return None
+        return layout
+
+
+    def _load_layout(self, layout):
+        """
+        Restore the directory and the stream extents saved in the layout cache,
+        instead of loading the FAT and the directory from the file.
+        """
+        self.sectorsize = self.SectorSize = layout['sectorsize']
+        self.minisectorsize = self.MiniSectorSize = layout['minisectorsize']
+        self.minisectorcutoff = layout['minisectorcutoff']
+        entries = layout['entries']
+        self.direntries = [None] * (max([entry[0] for entry in entries]) + 1)
+        for sid, name, entry_type, size, isectStart, clsid, kids, extents \
+                in entries:
+            if extents is not None:
+                extents = [tuple(extent) for extent in extents]
+            self.direntries[sid] = _OleCachedEntry(sid, name, entry_type,
+                size, isectStart, clsid, extents)
+        for sid, name, entry_type, size, isectStart, clsid, kids, extents \
+                in entries:
+            node = self.direntries[sid]
+            for kid_sid in kids:
+                kid = self.direntries[kid_sid]
+                node.kids.append(kid)
+                node.kids_dict.setdefault(kid.name.lower(), kid)
+        self.root = self.direntries[0]
+        self.ministream = None
+        self._layout_cached = True
+        self._build_index()
+
+
+    def _write_layout(self, cache_file, file_key):
+        """
+        Save the directory and the extents of all the streams in the layout
+        cache. Errors are ignored: the cache is only an optimization.
+        """
+        entries = []
+        for entry in self.direntries:
+            if entry is None:
+                continue
+            extents = None
+            if entry.entry_type == STGTY_STREAM:
+                try:
+                    extents = self._entry_extents(entry)
+                except IOError:
+                    # streams which cannot be read are not cached, so that
+                    # the error is raised when they are opened:
+                    return
+            entries.append([entry.sid, entry.name, entry.entry_type,
+                            entry.size, entry.isectStart, entry.clsid,
+                            [kid.sid for kid in entry.kids], extents])
+        layout = {'version': LAYOUT_CACHE_VERSION,
+                  'key': file_key,
+                  'sectorsize': self.sectorsize,
+                  'minisectorsize': self.minisectorsize,
+                  'minisectorcutoff': self.minisectorcutoff,
+                  'entries': entries}
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+            # the file is written under a temporary name and renamed, so that
+            # concurrent readers never see a partial layout:
+            fd, tmp_name = tempfile.mkstemp(dir=self._cache_dir)
+            f = os.fdopen(fd, 'wb')
+            try:
+                json.dump(layout, f)
+            finally:
+                f.close()
+            os.rename(tmp_name, cache_file)
+        except (IOError, OSError), exc:
+            if DEBUG_MODE: print 'layout cache not written: %s' % exc
+
 
     def _check_duplicate_stream(self, first_sect, minifat=False):
         """
@@ -886,43 +1476,39 @@ class OleFileIO:
 
     def sect2array(self, sect):
         """
-        convert a sector to an array of 32 bits unsigned integers,
-        swapping bytes on big endian CPUs such as PowerPC (old Macs)
+        convert a sector (or any string of sectors) to a numpy array of 32 bits
+        unsigned integers. The little-endian dtype takes care of swapping bytes
+        on big endian CPUs such as PowerPC (old Macs).
         """
-        a = array.array(UINT32, sect)
-        # if CPU is big endian, swap bytes:
-        if sys.byteorder == 'big':
-            a.byteswap()
-        return a        
+        return np.frombuffer(sect, dtype=np.dtype('<u4'))
 
 
     def loadfat_sect(self, sect):
         """
-        Adds the indexes of the given sector to the FAT
+        Adds the indexes of the FAT sectors listed in the given sector to the
+        FAT
         sect: string containing the first FAT sector, or array of long integers
         return: index of last FAT sector.
         """
         # a FAT sector is an array of ulong integers.
-        if isinstance(sect, array.array):
+        if isinstance(sect, np.ndarray):
             # if sect is already an array it is directly used
             fat1 = sect
         else:
             # if it's a raw sector, it is parsed in an array
             fat1 = self.sect2array(sect)
             self.dumpsect(sect)
-        # The FAT is a sector chain starting at the first index of itself.
-        for isect in fat1:
-            #print "isect = %X" % isect
-            if isect == ENDOFCHAIN or isect == FREESECT:
-                # the end of the sector chain has been reached
-                break
-            # read the FAT sector
-            s = self.getsect(isect)
-            # parse it as an array of 32 bits integers, and add it to the
-            # global FAT array
-            nextfat = self.sect2array(s)
-            self.fat = self.fat + nextfat
-        return isect
+        # The list of FAT sectors stops at the first ENDOFCHAIN or FREESECT:
+        end = np.flatnonzero((fat1 == ENDOFCHAIN) | (fat1 == FREESECT))
+        if end.size:
+            fat1 = fat1[:end[0]]
+        if not fat1.size:
+            return ENDOFCHAIN
+        # read all the FAT sectors (one read per run of consecutive sectors),
+        # and parse them as a single array of 32 bits integers, which is
+        # added to the global FAT in loadfat:
+        self._fat_parts.append(self.sect2array(self.getsects(fat1)))
+        return int(fat1[-1])
 
 
     def loadfat(self, header):
@@ -935,10 +1521,10 @@ class OleFileIO:
 
         sect = header[76:512]
 
-        # [PL] FAT is an array of 32 bits unsigned ints, it's more effective
-        # to use an array than a list in Python.
-        # It's initialized as empty first:
-        self.fat = array.array(UINT32)
+        # The FAT is a numpy array of 32 bits unsigned ints. The parts read
+        # from the header and from every DIFAT sector are concatenated at the
+        # end, to avoid growing the array many times:
+        self._fat_parts = []
         self.loadfat_sect(sect)
 
         if self.csectDif != 0:
@@ -967,13 +1553,19 @@ class OleFileIO:
                 self.dumpsect(sector_difat)
                 self.loadfat_sect(difat[:127])
                 # last DIFAT pointer is next DIFAT sector:
-                isect_difat = difat[127]
+                isect_difat = int(difat[127])
                 if DEBUG_MODE: print "next DIFAT sector: %X" % isect_difat 
             # checks:
             if isect_difat not in [ENDOFCHAIN, FREESECT]:
                 # last DIFAT pointer value must be ENDOFCHAIN or FREESECT
                 raise IOError, 'incorrect end of DIFAT'
 
+        if self._fat_parts:
+            self.fat = np.concatenate(self._fat_parts)
+        else:
+            self.fat = np.zeros(0, dtype=np.dtype('<u4'))
+        del self._fat_parts
+
         # since FAT is read from fixed-size sectors, it may contain more values
         # than the actual number of sectors in the file.
         
@@ -1046,6 +1638,36 @@ class OleFileIO:
         return sector
 
 
+    def getsects(self, sects):
+        """
+        Read given sectors from file on disk, with a single read for every
+        run of consecutive sectors.
+        sects: array of sector indexes
+        returns a string containing the data of the sectors, in order.
+        """
+        sects = np.asarray(sects, dtype=np.int64)
+        # index in sects where a new run of consecutive sectors begins:
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(sects) != 1) + 1,
+                                 [len(sects)]))
+        data = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            sect = int(sects[first])
+            length = self.sectorsize * int(last - first)
+            try:
+                self.fp.seek(self.sectorsize * (sect+1))
+            except:
+                if DEBUG_MODE: print ('getsects(): sect=%X, seek=%d' %
+                    (sect, self.sectorsize*(sect+1)))
+                self._raise_defect(DEFECT_FATAL, 'OLE sector index out of range')
+            run = self.fp.read(length)
+            if len(run) != length:
+                if DEBUG_MODE: print ('getsects(): sect=%X, read=%d, length=%d' %
+                    (sect, len(run), length))
+                self._raise_defect(DEFECT_FATAL, 'incomplete OLE sector')
+            data.append(run)
+        return string.join(data, "")
+
+
     def loaddirectory(self, sect):
         """
         Load the directory.
@@ -1080,6 +1702,35 @@ class OleFileIO:
 
         # read and build all storage trees, starting from the root:
         self.root.build_storage_tree()
+        # index of all entries by their full path, used by _find:
+        self._build_index()
+
+
+    def _build_index(self):
+        """
+        Build the dictionary of directory entries indexed by their full path
+        (tuple of names in lowercase, the root entry being the empty tuple),
+        used for case-insensitive lookups in constant time.
+        """
+        self._index = {(): self.root}
+        self._index_storage(self.root, ())
+
+
+    def _index_storage(self, node, prefix):
+        """
+        Add the children of a storage to the index. (recursive method)
+
+        node  : _OleDirectoryEntry of the storage
+        prefix: path of the storage in the index
+        """
+        for kid in node.kids:
+            path = prefix + (kid.name.lower(),)
+            # in case of duplicate names, the first one in the sorted kids
+            # list is kept, as done when walking the storage tree:
+            if path not in self._index:
+                self._index[path] = kid
+            if kid.kids:
+                self._index_storage(kid, path)
 
 
     def _load_direntry (self, sid):
@@ -1128,24 +1779,36 @@ class OleFileIO:
         # stream size is compared to the MiniSectorCutoff threshold:
         if size < self.minisectorcutoff and not force_FAT:
             # ministream object
+            self._load_ministream()
+            return _OleStream(self.ministream, start, size, 0,
+                              self.minisectorsize, self.minifat, self._lock)
+        else:
+            # standard stream
+#            return _OleStream(self.fp, start, size, 512,
+#                              self.sectorsize, self.fat)
+            return _OleStream(self.fp, start, size, self.sectorsize,
+                              self.sectorsize, self.fat, self._lock)
+
+    def _load_ministream(self):
+        """
+        Load the MiniFAT and the MiniStream, if it wasn't already done.
+        """
+        # the lock makes sure that the MiniStream is loaded only once when
+        # several threads open small streams:
+        self._lock.acquire()
+        try:
             if not self.ministream:
                 # load MiniFAT if it wasn't already done:
                 self.loadminifat()
-                # The first sector index of the miniFAT stream is stored in the
-                # root directory entry:
+                # The first sector index of the miniFAT stream is stored in
+                # the root directory entry:
                 size_ministream = self.root.size
                 if DEBUG_MODE: print ('Opening MiniStream: sect=%d, size=%d' %
                     (self.root.isectStart, size_ministream))
                 self.ministream = self._open(self.root.isectStart,
                     size_ministream, force_FAT=True)
-            return _OleStream(self.ministream, start, size, 0,
-                              self.minisectorsize, self.minifat)
-        else:
-            # standard stream
-#            return _OleStream(self.fp, start, size, 512,
-#                              self.sectorsize, self.fat)
-            return _OleStream(self.fp, start, size, self.sectorsize,
-                              self.sectorsize, self.fat)
+        finally:
+            self._lock.release()
 
     def _list(self, files, prefix, node):
         """
@@ -1185,25 +1848,37 @@ class OleFileIO:
         raise IOError if file not found
         """
 
+        entry = self._find_entry(filename)
+        if entry is None:
+            raise IOError, "file not found"
+        return entry.sid
+
+
+    def _find_entry(self, filename):
+        """
+        Returns directory entry of given filename, or None if it does not
+        exist. Note: this method is case-insensitive.
+
+        filename: path of stream in storage tree (see _find for syntax)
+        """
         # if filename is a string instead of a list, split it on slashes to
         # convert to a list:
         if isinstance(filename, basestring):
             filename = filename.split('/')
-        # walk across storage tree, following given path:
-        node = self.root
-        for name in filename:
-            for kid in node.kids:
-                if kid.name.lower() == name.lower():
-                    break
-            else:
-                raise IOError, "file not found"
-            node = kid
-        return node.sid
+        path = tuple([name.lower() for name in filename])
+        return self._index.get(path)
 
 
     def openstream(self, filename):
         """
-        Open a stream as a read-only file object (StringIO).
+        Open a stream as a read-only file object.
+        Streams stored in the FAT are returned as _OleLazyStream objects,
+        which only read the requested byte ranges, or as _OleMappedStream
+        objects in memory-mapped mode, whose data is not copied. Streams in
+        the MiniFAT are small and returned as _OleStream (StringIO).
+        Several threads may open and read streams of the same OleFileIO
+        object at the same time, as long as each stream object is only used
+        by one thread.
 
         filename: path of stream in storage tree (except root entry), either:
             - a string using Unix path syntax, for example:
@@ -1213,11 +1888,76 @@ class OleFileIO:
         return: file object (read-only)
         raise IOError if filename not found, or if this is not a stream.
         """
-        sid = self._find(filename)
-        entry = self.direntries[sid]
+        entry = self.direntries[self._find(filename)]
         if entry.entry_type != STGTY_STREAM:
             raise IOError, "this file is not a stream"
-        return self._open(entry.isectStart, entry.size)
+        if self._layout_cached:
+            return self._open_cached(entry)
+        if entry.size < self.minisectorcutoff:
+            return self._open(entry.isectStart, entry.size)
+        if self._mmap is not None:
+            return _OleMappedStream(self._mmap, entry.isectStart, entry.size,
+                                    self.sectorsize, self.sectorsize, self.fat)
+        return _OleLazyStream(self.fp, entry.isectStart, entry.size,
+                              self.sectorsize, self.sectorsize, self.fat,
+                              lock=self._lock)
+
+
+    def _open_cached(self, entry):
+        """
+        Open a stream from its extents saved in the layout cache. (openstream
+        helper)
+        """
+        if self._mmap is not None and entry.size >= self.minisectorcutoff:
+            return _OleMappedStream(self._mmap, entry.isectStart, entry.size,
+                                    None, None, None, entry.extents)
+        stream = _OleLazyStream(self.fp, entry.isectStart, entry.size,
+                                None, None, None, entry.extents, self._lock)
+        if entry.size < self.minisectorcutoff:
+            # small streams are read in memory, as in the MiniStream:
+            data = StringIO.StringIO(stream.read())
+            data.size = entry.size
+            data.extents = entry.extents
+            return data
+        return stream
+
+
+    def readstreams(self, filenames):
+        """
+        Read the whole data of several streams at once. Streams of the
+        MiniFAT are sliced directly from the MiniStream, which is only loaded
+        once, without creating a file object for each of them: this is the
+        fastest way to read many small metadata streams.
+
+        filenames: list of paths of streams (see openstream for syntax)
+        return: dictionary of the stream data indexed by the given paths
+            (paths given as lists are converted to tuples). Paths which do
+            not exist or are not streams are left out.
+        raise: IOError if a stream cannot be read.
+        """
+        streams = {}
+        ministream = None
+        for filename in filenames:
+            entry = self._find_entry(filename)
+            if entry is None or entry.entry_type != STGTY_STREAM:
+                continue
+            if entry.size < self.minisectorcutoff and not self._layout_cached:
+                if ministream is None:
+                    self._load_ministream()
+                    ministream = self.ministream.getvalue()
+                runs = _sector_chain(entry.isectStart, entry.size,
+                                     self.minisectorsize, self.minifat)
+                data = string.join([ministream[offset:offset+length]
+                    for offset, length in _chain_extents(runs, 0,
+                        self.minisectorsize, entry.size)], "")
+                if len(data) != entry.size:
+                    raise IOError, 'OLE stream size is less than declared'
+            else:
+                data = self.openstream(filename).read()
+            if isinstance(filename, list):
+                filename = tuple(filename)
+            streams[filename] = data
+        return streams
 
 
     def get_type(self, filename):
@@ -1231,12 +1971,10 @@ class OleFileIO:
             - STGTY_STORAGE: a storage
             - STGTY_ROOT: the root entry
         """
-        try:
-            sid = self._find(filename)
-            entry = self.direntries[sid]
-            return entry.entry_type
-        except:
+        entry = self._find_entry(filename)
+        if entry is None:
             return False
+        return entry.entry_type
 
 
     def exists(self, filename):
@@ -1247,11 +1985,7 @@ class OleFileIO:
         filename: path of stream in storage tree. (see openstream for syntax)
         return: True if object exist, else False.
         """
-        try:
-            sid = self._find(filename)
-            return True
-        except:
-            return False
+        return self._find_entry(filename) is not None
 
 
     def get_size(self, filename):
@@ -1270,6 +2004,43 @@ class OleFileIO:
         return entry.size
 
 
+    def get_extents(self, filename):
+        """
+        Return the location of a stream in the OLE file, without reading it.
+
+        filename: path of stream in storage tree (see openstream for syntax)
+        return: list of (offset, length) tuples, in stream order, giving the
+            runs of consecutive bytes of the stream in the OLE file (streams
+            in the MiniFAT are translated through the MiniStream extents).
+        raise: IOError if file not found, TypeError if this is not a stream.
+        """
+        sid = self._find(filename)
+        entry = self.direntries[sid]
+        if entry.entry_type != STGTY_STREAM:
+            raise TypeError, 'object is not an OLE stream'
+        return self._entry_extents(entry)
+
+
+    def _entry_extents(self, entry):
+        """
+        Return the extents of the stream of a directory entry in the OLE file.
+        (get_extents helper)
+        """
+        if self._layout_cached:
+            return list(entry.extents)
+        if entry.size < self.minisectorcutoff:
+            self._load_ministream()
+            runs = _sector_chain(entry.isectStart, entry.size,
+                                 self.minisectorsize, self.minifat)
+            extents = _chain_extents(runs, 0, self.minisectorsize,
+                                     entry.size)
+            return _map_extents(extents, self.ministream.extents)
+        runs = _sector_chain(entry.isectStart, entry.size, self.sectorsize,
+                             self.fat)
+        return _chain_extents(runs, self.sectorsize, self.sectorsize,
+                              entry.size)
+
+
     def get_rootentry_name(self):
         """
         Return root entry name. Should usually be 'Root Entry' or 'R' in most
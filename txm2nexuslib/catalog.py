@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sqlite3
+from collections import namedtuple
+
+from OleFileIO_PL import OleFileIO
+from xradiaheader import read_header_snapshot, parse_dates, iso_time
+
+
+# Extensions of the files in a catalog
+CATALOG_EXTENSIONS = ('.xrm', '.txrm')
+
+# Columns of the files table: the location of each file, its size and
+# modification time (to find the files changed since they were read), and
+# its metadata (see read_file_metadata)
+CATALOG_COLUMNS = (('path', 'TEXT PRIMARY KEY'),
+                   ('directory', 'TEXT'),
+                   ('name', 'TEXT'),
+                   ('size', 'INTEGER'),
+                   ('mtime', 'REAL'),
+                   ('role', 'TEXT'),
+                   ('sample', 'TEXT'),
+                   ('tomo', 'TEXT'),
+                   ('energy', 'REAL'),
+                   ('angle', 'REAL'),
+                   ('exposure', 'REAL'),
+                   ('date', 'TEXT'),
+                   ('images', 'INTEGER'),
+                   ('height', 'INTEGER'),
+                   ('width', 'INTEGER'),
+                   ('data_type', 'TEXT'),
+                   ('error', 'TEXT'))
+
+# Indexed columns (one index for each group of columns)
+CATALOG_INDEXES = (('directory',), ('role',), ('sample',), ('tomo',),
+                   ('energy',), ('angle',), ('exposure',), ('date',),
+                   ('height', 'width'))
+
+# Number of files read between two commits of a scan
+SCAN_COMMIT_FILES = 1000
+
+# Number of files of each kind seen by a scan
+ScanReport = namedtuple('ScanReport',
+                        ['new', 'changed', 'removed', 'unchanged'])
+
+
+def is_bright_field(file_name):
+    """
+    True for the bright field files, which have FF as one of the parts,
+    separated by '_', of their name (without extension)
+    """
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    return 'FF' in name.split('_')
+
+
+def file_role(file_name):
+    """'ff' for the bright field (FF) files, 'sample' for the others"""
+    if is_bright_field(file_name):
+        return 'ff'
+    return 'sample'
+
+
+def file_sample_and_tomo(file_name):
+    """
+    Sample and tomo of a file, from its name, as grouped by xrm2nexus: an
+    xrm file date_sample_energy_..._tomo.xrm belongs to the sample
+    date_sample_energy and to the tomo tomo.xrm (None for the bright field
+    files). A txrm file belongs to the sample named as its directory.
+    """
+    directory, name = os.path.split(file_name)
+    if name.endswith('.txrm'):
+        return os.path.basename(directory), None
+    splitted_name = name.split('_')
+    sample = '_'.join(splitted_name[:3])
+    if file_role(file_name) == 'ff':
+        return sample, None
+    return sample, splitted_name[-1]
+
+
+def _first(values):
+    if values is None or len(values) == 0:
+        return None
+    return float(values[0])
+
+
+def read_file_metadata(file_name):
+    """
+    Metadata of the txrm/xrm file file_name stored in a catalog, read from
+    its metadata streams only (see read_header_snapshot). The per-image
+    values (energy, angle, exposure and date) are those of the first image.
+    """
+    ole = OleFileIO(file_name)
+    try:
+        header = read_header_snapshot(ole)
+    finally:
+        ole.close()
+    date = None
+    if header.dates is not None and len(header.dates) > 0:
+        date = iso_time(parse_dates(header.dates[:1])[0])
+    return dict(energy=_first(header.energies),
+                angle=_first(header.angles),
+                exposure=_first(header.exp_times),
+                date=date,
+                images=header.no_of_images,
+                height=header.image_height,
+                width=header.image_width,
+                data_type=header.data_type)
+
+
+class Catalog(object):
+    """
+    SQLite catalog of the txrm/xrm files of some directories and of their
+    metadata, kept in the file database. scan() adds the files of a
+    directory, reading only the new and changed ones, and query() selects
+    the files with SQL conditions on the columns (see CATALOG_COLUMNS),
+    for instance "role = 'sample' AND energy > 520".
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.connection = sqlite3.connect(database)
+        self.connection.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files (%s)' %
+                ', '.join('%s %s' % column for column in CATALOG_COLUMNS))
+            for columns in CATALOG_INDEXES:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS files_%s ON files (%s)' %
+                    ('_'.join(columns), ', '.join(columns)))
+
+    def _known_files(self, directory):
+        # (size, mtime) of the files of directory in the catalog
+        rows = self.connection.execute(
+            'SELECT name, size, mtime FROM files WHERE directory = ?',
+            (directory,))
+        return dict((row['name'], (row['size'], row['mtime']))
+                    for row in rows)
+
+    def _insert(self, rows):
+        columns = [name for name, definition in CATALOG_COLUMNS]
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO files (%s) VALUES (%s)' %
+            (', '.join(columns), ', '.join('?' * len(columns))),
+            [[row.get(column) for column in columns] for row in rows])
+        self.connection.commit()
+
+    def _remove(self, directory, names):
+        self.connection.executemany(
+            'DELETE FROM files WHERE directory = ? AND name = ?',
+            [(directory, name) for name in names])
+
+    def scan(self, directory, recursive=True):
+        """
+        Add to the catalog the txrm/xrm files of directory (and of its
+        subdirectories if recursive). Only the files which are new, or
+        whose size or modification time has changed, are read; the files
+        which no longer exist are removed. A file which cannot be read is
+        kept with the error in the column error. Returns a ScanReport.
+        """
+        directory = os.path.abspath(directory)
+        counts = dict(new=0, changed=0, removed=0, unchanged=0)
+        rows = []
+        scanned = set()
+        for path, subdirectories, names in os.walk(directory):
+            if not recursive:
+                del subdirectories[:]
+            scanned.add(path)
+            known = self._known_files(path)
+            for name in names:
+                if not name.endswith(CATALOG_EXTENSIONS):
+                    continue
+                file_name = os.path.join(path, name)
+                try:
+                    stat = os.stat(file_name)
+                except OSError:
+                    continue
+                size_and_mtime = (stat.st_size, stat.st_mtime)
+                previous = known.pop(name, None)
+                if previous == size_and_mtime:
+                    counts['unchanged'] += 1
+                    continue
+                counts['changed' if previous else 'new'] += 1
+                rows.append(self._file_row(file_name, *size_and_mtime))
+                if len(rows) == SCAN_COMMIT_FILES:
+                    self._insert(rows)
+                    rows = []
+            self._remove(path, known)
+            counts['removed'] += len(known)
+        self._insert(rows)
+
+        # directories which no longer exist
+        with self.connection:
+            for path in self.directories():
+                if path in scanned:
+                    continue
+                inside = (path == directory or
+                          path.startswith(directory + os.sep))
+                if inside and (recursive or path == directory):
+                    counts['removed'] += self.connection.execute(
+                        'DELETE FROM files WHERE directory = ?',
+                        (path,)).rowcount
+        return ScanReport(**counts)
+
+    def _file_row(self, file_name, size, mtime):
+        sample, tomo = file_sample_and_tomo(file_name)
+        row = dict(path=file_name, directory=os.path.dirname(file_name),
+                   name=os.path.basename(file_name), size=size, mtime=mtime,
+                   role=file_role(file_name), sample=sample, tomo=tomo)
+        try:
+            row.update(read_file_metadata(file_name))
+        except Exception as error:
+            row['error'] = '%s: %s' % (type(error).__name__, error)
+        return row
+
+    def directories(self):
+        """Directories with files in the catalog"""
+        rows = self.connection.execute('SELECT DISTINCT directory FROM files')
+        return [row['directory'] for row in rows]
+
+    def query(self, where=None, parameters=(), order_by='path'):
+        """
+        Rows (sqlite3.Row, indexed by column name) of the files which meet
+        the SQL condition where, with the given parameters (for its ?
+        placeholders), sorted by the columns order_by.
+        """
+        sql = 'SELECT * FROM files'
+        if where:
+            sql += ' WHERE %s' % where
+        if order_by:
+            sql += ' ORDER BY %s' % order_by
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def files(self, where=None, parameters=(), order_by='path'):
+        """Paths of the files which meet the condition where (see query)"""
+        return [row['path'] for row in self.query(where, parameters,
+                                                  order_by)]
+
+
+def query_directory(catalog, directory, where=None, parameters=(),
+                    recursive=False, order_by='mtime'):
+    """
+    Scan directory in the catalog, and return the rows of its files which
+    meet the condition where (see Catalog.query).
+    """
+    catalog.scan(directory, recursive)
+    directory = os.path.abspath(directory)
+    if recursive:
+        condition = "(directory = ? OR directory LIKE ? ESCAPE '\\')"
+        escaped = directory.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_')
+        parameters = (directory, escaped + os.sep + '%') + tuple(parameters)
+    else:
+        condition = 'directory = ?'
+        parameters = (directory,) + tuple(parameters)
+    if where:
+        condition += ' AND (%s)' % where
+    return catalog.query(condition, parameters, order_by)
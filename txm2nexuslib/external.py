@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+import numpy as np
+import h5py
+
+from prefetch import image_stream_name
+from storage import DatasetStorage
+
+
+# Maximum number of segments of a dataset with external storage: the list
+# of segments is kept in the dataset header, which is limited to 64 KB
+MAX_EXTERNAL_SEGMENTS = 1024
+
+
+def frame_location(ole, filename, numimage, nbytes):
+    """
+    Location (filename, offset) of the first nbytes of the stream of the
+    image numimage of the txrm file filename opened as the OleFileIO ole,
+    or None if they are not contiguous in the file.
+    """
+    extents = ole.get_extents(image_stream_name(numimage))
+    if extents and extents[0][1] >= nbytes:
+        return (os.path.abspath(filename), extents[0][0])
+    return None
+
+
+def external_segments(locations, nbytes):
+    """
+    Segments (filename, offset, size) of the frames at the given locations
+    (filename, offset) of nbytes each, in order: the frames that follow
+    each other in the same file are joined in one segment.
+    """
+    segments = []
+    for filename, offset in locations:
+        if segments:
+            last_name, last_offset, last_size = segments[-1]
+            if last_name == filename and last_offset + last_size == offset:
+                segments[-1] = (last_name, last_offset, last_size + nbytes)
+                continue
+        segments.append((filename, offset, nbytes))
+    return segments
+
+
+def _split_segments(frames, locations, nbytes):
+    # Split the frames, at the given locations, in groups that have at most
+    # MAX_EXTERNAL_SEGMENTS segments
+    groups = []
+    count = 0
+    previous = None
+    for frame, location in zip(frames, locations):
+        if (previous is None or previous[0] != location[0] or
+                previous[1] + nbytes != location[1]):
+            count += 1
+            if not groups or count > MAX_EXTERNAL_SEGMENTS:
+                groups.append([])
+                count = 1
+        groups[-1].append(frame)
+        previous = location
+    return groups
+
+
+def upright_frame(dataset, i):
+    """
+    Image i of the dataset of images, upright even if its rows are kept
+    upside down (attribute 'Flipped Rows', see create_external_dataset)
+    """
+    frame = dataset[i]
+    if dataset.attrs.get('Flipped Rows', 0):
+        frame = frame[::-1]
+    return frame
+
+
+def create_external_dataset(group, name, locations, shape, dtype,
+                            read_frame=None, storage=None):
+    """
+    Create the (nFrames, rows, cols) dataset name in group without copying
+    the frames that are stored contiguously in their files: they are
+    declared as HDF5 external storage. locations[i] is the location
+    (filename, offset) of the frame i (see frame_location), or None if it
+    is fragmented: these frames are read with read_frame(i) and copied to
+    the dataset name + '_copied', created with storage.
+
+    If all the frames are referenced and fit in MAX_EXTERNAL_SEGMENTS
+    segments, name is the external dataset. Otherwise, the frames are
+    referenced by datasets name + '_external_0', name + '_external_1'...
+    and name is a virtual dataset joining them with the copied frames.
+
+    The frames are kept as they are in the files: the Xradia images are
+    upside down, which is recorded in the attribute 'Flipped Rows' of the
+    dataset; data[i, ::-1] is the image i.
+    Returns the dataset.
+    """
+    nframes = shape[0]
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape[1:])) * dtype.itemsize
+    referenced = [i for i in range(nframes) if locations[i] is not None]
+    copied = [i for i in range(nframes) if locations[i] is None]
+    if copied and read_frame is None:
+        raise ValueError("%i frames of %s are fragmented and must be "
+                         "copied" % (len(copied), name))
+
+    groups = _split_segments(referenced,
+                             [locations[i] for i in referenced], nbytes)
+    if not copied and len(groups) == 1:
+        dataset = group.create_dataset(
+            name, shape=shape, dtype=dtype,
+            external=external_segments(locations, nbytes))
+        dataset.attrs['Flipped Rows'] = 1
+        return dataset
+
+    # where each frame is: (source dataset, index in the source)
+    sources = [None] * nframes
+    for number, frames_group in enumerate(groups):
+        source_name = '%s_external_%i' % (name, number)
+        group.create_dataset(
+            source_name, shape=(len(frames_group),) + tuple(shape[1:]),
+            dtype=dtype,
+            external=external_segments(
+                [locations[i] for i in frames_group], nbytes))
+        for index, frame in enumerate(frames_group):
+            sources[frame] = (source_name, index)
+    if copied:
+        storage = storage or DatasetStorage()
+        source_name = name + '_copied'
+        copies = storage.create_dataset(
+            group, source_name, (len(copied),) + tuple(shape[1:]), dtype,
+            lambda i: read_frame(copied[i]))
+        with storage.frame_writer(copies) as writer:
+            for index, frame in enumerate(copied):
+                writer.append(read_frame(frame))
+                sources[frame] = (source_name, index)
+
+    layout = h5py.VirtualLayout(shape, dtype)
+    virtual_sources = {}
+    first = 0
+    # one mapping for each run of frames consecutive in the same source
+    for i in range(1, nframes + 1):
+        if (i < nframes and sources[i][0] == sources[first][0] and
+                sources[i][1] == sources[first][1] + i - first):
+            continue
+        source_name, index = sources[first]
+        if source_name not in virtual_sources:
+            source = group[source_name]
+            virtual_sources[source_name] = h5py.VirtualSource(
+                '.', source.name, source.shape, dtype=dtype)
+        layout[first:i] = virtual_sources[source_name][
+            index:index + i - first]
+        first = i
+    dataset = group.create_virtual_dataset(name, layout)
+    dataset.attrs['Flipped Rows'] = 1
+    return dataset
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import zlib
+import itertools
+from collections import deque
+
+import numpy as np
+
+from threadpool import OrderedThreadPool
+
+
+# Maximum memory used by the frames waiting to be written (bytes), used to
+# compute the number of frames written at once when it is not given
+DEFAULT_WRITE_MEMORY = 64 * 1024 * 1024
+
+
+def frames_per_batch(frame_shape, dtype, memory=DEFAULT_WRITE_MEMORY):
+    """Number of frames of the given shape and dtype that fit in memory"""
+    frame_bytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+    return max(1, memory // max(frame_bytes, 1))
+
+
+class FrameBatchWriter(object):
+    """
+    Write frames (dataset[i]) consecutively in an HDF5 dataset, starting at
+    the frame start. The frames are copied in a buffer of batch frames,
+    which is written with a single write_direct when it is full, when flush
+    is called, and at the end of a with block. If batch is not given, it is
+    computed from the memory budget.
+
+    Resizable datasets are enlarged when the frames do not fit in them.
+    """
+
+    def __init__(self, dataset, start=0, batch=None,
+                 memory=DEFAULT_WRITE_MEMORY):
+        self.dataset = dataset
+        self.position = start
+        frame_shape = dataset.shape[1:]
+        if not batch:
+            batch = frames_per_batch(frame_shape, dataset.dtype, memory)
+        if dataset.maxshape[0] is not None:
+            batch = min(batch, max(dataset.maxshape[0] - start, 1))
+        self.batch = batch
+        self.buffer = np.empty((batch,) + frame_shape, dtype=dataset.dtype)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+
+    def append(self, frame):
+        """Add the next frame; the dtype is converted to the dataset one"""
+        self.buffer[self.count] = frame
+        self.count += 1
+        if self.count == self.batch:
+            self.flush()
+
+    def flush(self):
+        """Write the frames in the buffer"""
+        if self.count == 0:
+            return
+        end = self.position + self.count
+        if end > self.dataset.shape[0] and self.dataset.maxshape[0] is None:
+            self.dataset.resize(end, axis=0)
+        self.dataset.write_direct(self.buffer, np.s_[0:self.count],
+                                  np.s_[self.position:end])
+        self.position = end
+        self.count = 0
+
+
+def compresses_chunks(dataset):
+    """
+    True if the chunks of dataset can be compressed outside HDF5: its only
+    filters are gzip (deflate) and, optionally, shuffle before it
+    """
+    return (dataset.chunks is not None and
+            dataset.compression == 'gzip' and
+            dataset.scaleoffset is None and
+            not dataset.fletcher32)
+
+
+def compress_chunk(chunk, level, shuffle):
+    """
+    Bytes of chunk (a numpy array) as stored in an HDF5 dataset with the
+    shuffle (optional) and deflate filters
+    """
+    chunk = np.ascontiguousarray(chunk)
+    if shuffle and chunk.dtype.itemsize > 1:
+        data = chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize)
+        data = np.ascontiguousarray(data.T).data
+    else:
+        data = chunk.data
+    # zlib releases the GIL while compressing
+    return zlib.compress(data, level)
+
+
+class ChunkCompressingWriter(object):
+    """
+    Write frames (dataset[i]) consecutively in a gzip compressed HDF5
+    dataset (see compresses_chunks), starting at the frame start, like
+    FrameBatchWriter. The frames of each chunk are compressed with zlib by
+    a pool of workers threads, and the compressed chunks are written in
+    order with write_direct_chunk. The chunks that are not filled from
+    their first frame (at the start, or when flushing) are written by
+    HDF5 as usual.
+
+    The workers are stopped by flush, and started again by append.
+    """
+
+    def __init__(self, dataset, start=0, workers=1):
+        if not compresses_chunks(dataset):
+            raise ValueError("The chunks of %s cannot be compressed "
+                             "outside HDF5" % dataset.name)
+        self.dataset = dataset
+        self.workers = workers
+        self.level = dataset.compression_opts
+        self.shuffle = dataset.shuffle
+        self.chunks = dataset.chunks
+        self.frame_shape = dataset.shape[1:]
+        self.position = start
+        self.first = start
+        self.frames = []
+        self.chunks_written = 0
+        self._pool = None
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+        else:
+            self._close_pool()
+
+    def append(self, frame):
+        """Add the next frame; the dtype is converted to the dataset one"""
+        self.frames.append(np.array(frame, dtype=self.dataset.dtype)
+                           .reshape(self.frame_shape))
+        self.position += 1
+        nframes = self.dataset.shape[0]
+        if self.position % self.chunks[0] == 0 or (
+                self.position == nframes and
+                self.dataset.maxshape[0] is not None):
+            self._end_chunk()
+
+    def _end_chunk(self):
+        if self.first % self.chunks[0] == 0:
+            slab = np.zeros((self.chunks[0],) + self.frame_shape,
+                            dtype=self.dataset.dtype)
+            slab[:len(self.frames)] = self.frames
+            self._compress(self.first, slab, len(self.frames))
+        else:
+            self._write_frames()
+        self.frames = []
+        self.first = self.position
+
+    def _compress(self, first, slab, nframes):
+        if self._pool is None:
+            self._pool = OrderedThreadPool(self.workers)
+        # the chunks of the slab, padded to the chunk shape at the edges
+        ranges = [range(0, size, chunk) for size, chunk in
+                  zip(self.frame_shape, self.chunks[1:])]
+        for offset in itertools.product(*ranges):
+            block = slab[(slice(None),) + tuple(
+                slice(start, start + chunk)
+                for start, chunk in zip(offset, self.chunks[1:]))]
+            if block.shape != self.chunks:
+                padded = np.zeros(self.chunks, dtype=block.dtype)
+                padded[tuple(slice(0, size) for size in block.shape)] = block
+                block = padded
+            task = self._pool.submit(
+                lambda chunk: compress_chunk(chunk, self.level, self.shuffle),
+                block)
+            self._pending.append(((first,) + offset, first + nframes, task))
+        while len(self._pending) > 2 * self.workers or (
+                self._pending and self._pending[0][2].done.is_set()):
+            self._write_chunk()
+
+    def _resize(self, end):
+        if end > self.dataset.shape[0] and self.dataset.maxshape[0] is None:
+            self.dataset.resize(end, axis=0)
+
+    def _write_chunk(self):
+        offset, end, task = self._pending.popleft()
+        data = task.get()
+        self._resize(end)
+        self.dataset.id.write_direct_chunk(offset, data, 0)
+        self.chunks_written += 1
+
+    def _write_frames(self):
+        if not self.frames:
+            return
+        end = self.first + len(self.frames)
+        self._resize(end)
+        self.dataset.write_direct(np.array(self.frames), None,
+                                  np.s_[self.first:end])
+
+    def _close_pool(self):
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def flush(self):
+        """Write the compressed chunks and the frames not compressed yet"""
+        try:
+            while self._pending:
+                self._write_chunk()
+        finally:
+            self._close_pool()
+        self._write_frames()
+        self.frames = []
+        self.first = self.position
+
+
+class TeeWriter(object):
+    """Append the frames to several writers"""
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for writer in self.writers:
+            writer.__exit__(type, value, traceback)
+
+    def append(self, frame):
+        for writer in self.writers:
+            writer.append(frame)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+
+def frame_writer(dataset, start=0, batch=None, workers=0):
+    """
+    Writer of frames in dataset: a ChunkCompressingWriter with the given
+    number of workers if they are more than 0 and the dataset allows it,
+    or a FrameBatchWriter.
+    """
+    if workers > 0 and compresses_chunks(dataset):
+        return ChunkCompressingWriter(dataset, start, workers)
+    return FrameBatchWriter(dataset, start, batch)
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+
+# Pixel types of the Xradia images (see ImageInfo/DataType):
+# 5 uint16 (unsigned 16-bit (2-byte) integers); 10 float (4 bytes)
+PIXEL_DTYPES = {
+    'uint16': np.dtype('<u2'),
+    'float': np.dtype('<f4'),
+    'float32': np.dtype('<f4'),
+}
+
+
+def pixel_dtype(datatype):
+    """Numpy dtype of the pixels of an image of the given data type"""
+    try:
+        return PIXEL_DTYPES[datatype]
+    except KeyError:
+        raise ValueError("Wrong data type: %s" % datatype)
+
+
+def decode_image(data, numrows, numcols, datatype, flip=True):
+    """
+    Decode the raw data of an ImageData stream.
+
+    data: string (or buffer) with the pixels of the image, row by row
+    numrows, numcols: size of the image
+    datatype: 'uint16' or 'float' (see xradiaheader.HeaderSnapshot)
+    flip: if True, the rows are returned in reversed order, as Xradia
+        files store the images upside down
+    return: read-only (numrows, numcols) array sharing the memory of data
+    """
+    dtype = pixel_dtype(datatype)
+    count = numrows * numcols
+    if len(data) < count * dtype.itemsize:
+        raise ValueError("Image data has %i bytes, %i expected" %
+                         (len(data), count * dtype.itemsize))
+    image = np.frombuffer(data, dtype=dtype, count=count)
+    image = image.reshape(numrows, numcols)
+    if flip:
+        image = image[::-1]
+    return image
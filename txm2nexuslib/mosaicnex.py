@@ -20,11 +20,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from OleFileIO_PL import *   
+from xradiaheader import (read_header_snapshot, write_motor_table,
+                          write_timestamps, iso_time)
+from imagedecode import decode_image, pixel_dtype
+from pipeline import ConversionPipeline
+from storage import DatasetStorage
 import numpy as np
 import h5py
 import sys
-import struct
-import datetime
 import time
 import argparse
 
@@ -34,7 +37,7 @@ class MosaicNex:
     def __init__(self, files, files_order='s', title='X-ray Mosaic', 
                  sourcename='ALBA', sourcetype='Synchrotron X-ray Source', 
                  sourceprobe='x-ray', instrument='BL09 @ ALBA', 
-                 sample='Unknown'): 
+                 sample='Unknown', pipeline=0, storage=None): 
 
         self.files = files
         self.num_input_files = len(files)  # number of files.
@@ -104,6 +107,12 @@ class MosaicNex:
         self.monitorsize = self.nSampleFrames 
         self.monitorcounts = 0
 
+        # Threads decoding the rows of the mosaic and FF images, converted
+        # concurrently (0: converted one after the other)
+        self.pipeline_workers = pipeline
+        # Chunking and compression of the images
+        self.storage = storage or DatasetStorage()
+
     def NXmosaic_structure(self):    
         # create_basic_structure
 
@@ -140,6 +149,8 @@ class MosaicNex:
         
         # Opening the .xrm files as Ole structures
         ole = OleFileIO(self.mosaic_file_xrm)
+        header = read_header_snapshot(ole)
+        ole.close()
 
         # xrm files have been opened
         self.mosaic_grp['program_name'] = self.programname
@@ -150,13 +161,9 @@ class MosaicNex:
              + ' '.join(sys.argv[1:]))
                                                               
         # SampleID
-        if ole.exists('SampleInfo/SampleID'):   
-            stream = ole.openstream('SampleInfo/SampleID')
-            data = stream.read()
-            struct_fmt = '<'+'50s'
-            samplename = struct.unpack(struct_fmt, data)
+        if header.sample_id is not None:
             if self.samplename != 'Unknown':
-                self.samplename = samplename[0]    
+                self.samplename = header.sample_id
             if verbose: 
                 print "SampleInfo/SampleID: %s " % self.samplename 
             self.nxsample['name'] = self.samplename
@@ -164,12 +171,8 @@ class MosaicNex:
             print("There is no information about SampleID")
 
         # Pixel-size
-        if ole.exists('ImageInfo/PixelSize'):   
-            stream = ole.openstream('ImageInfo/PixelSize')
-            data = stream.read()
-            struct_fmt = '<1f'
-            pixelsize = struct.unpack(struct_fmt, data)
-            pixelsize = pixelsize[0]
+        if header.pixel_size is not None:
+            pixelsize = header.pixel_size
             if verbose: 
                 print "ImageInfo/PixelSize: %f " % pixelsize
             self.inst_sample_grp.create_dataset("x_pixel_size", data=pixelsize)
@@ -179,13 +182,14 @@ class MosaicNex:
         else:
             print("There is no information about PixelSize")
 
+        # Positions of all the motors for each image
+        if header.motors is not None:
+            write_motor_table(self.inst_sample_grp, header.motors,
+                              header.motor_names)
+
         # Accelerator current (machine current)
-        if ole.exists('ImageInfo/Current'):   
-            stream = ole.openstream('ImageInfo/Current')
-            data = stream.read()
-            struct_fmt = '<1f'
-            current = struct.unpack(struct_fmt, data)
-            current = current[0]
+        if header.current is not None:
+            current = header.current
             if verbose: 
                 print "ImageInfo/Current: %f " % current
 
@@ -195,30 +199,17 @@ class MosaicNex:
             print("There is no information about Current")
 
         # Mosaic data size 
-        if (ole.exists('ImageInfo/NoOfImages') and 
-            ole.exists('ImageInfo/ImageWidth') and 
-            ole.exists('ImageInfo/ImageHeight')):                  
-                    
-            stream = ole.openstream('ImageInfo/NoOfImages')
-            data = stream.read()
-            nimages = struct.unpack('<I', data)
-            if verbose: 
-                print "ImageInfo/NoOfImages = %i" % nimages[0] 
-            self.nSampleFrames = np.int(nimages[0])
-        
-            stream = ole.openstream('ImageInfo/ImageHeight')
-            data = stream.read()
-            ximage = struct.unpack('<I', data)    
-            if verbose: 
-                print "ImageInfo/ImageHeight = %i" % ximage[0]  
-            self.numrows = np.int(ximage[0])
-            
-            stream = ole.openstream('ImageInfo/ImageWidth')
-            data = stream.read()
-            yimage = struct.unpack('<I', data)
+        if (header.no_of_images is not None and 
+            header.image_width is not None and 
+            header.image_height is not None):
+
+            self.nSampleFrames = np.int(header.no_of_images)
+            self.numrows = np.int(header.image_height)
+            self.numcols = np.int(header.image_width)
             if verbose: 
-                print "ImageInfo/ImageWidth = %i" % yimage[0]  
-            self.numcols = np.int(yimage[0])
+                print "ImageInfo/NoOfImages = %i" % self.nSampleFrames
+                print "ImageInfo/ImageHeight = %i" % self.numrows
+                print "ImageInfo/ImageWidth = %i" % self.numcols
 
         else:
             print('There is no information about the mosaic size ' +
@@ -227,51 +218,29 @@ class MosaicNex:
         # FF data size
         if self.brightexists == 1:
             oleFF = OleFileIO(self.mosaic_file_FF_xrm)
-            if (ole.exists('ImageInfo/NoOfImages') 
-                and oleFF.exists('ImageInfo/ImageWidth') 
-                and oleFF.exists('ImageInfo/ImageHeight')):                  
-                        
-                stream = oleFF.openstream('ImageInfo/NoOfImages')
-                data = stream.read()
-                nimages = struct.unpack('<I', data)
-                if verbose: 
-                    print "ImageInfo/NoOfImages = %i" % nimages[0] 
-                self.nSampleFramesFF = np.int(nimages[0])
-            
-                stream = oleFF.openstream('ImageInfo/ImageHeight')
-                data = stream.read()
-                ximage = struct.unpack('<I', data)    
-                if verbose: 
-                    print "ImageInfo/ImageHeight = %i" % ximage[0]  
-                self.numrowsFF = np.int(ximage[0])
-                
-                stream = oleFF.openstream('ImageInfo/ImageWidth')
-                data = stream.read()
-                yimage = struct.unpack('<I', data)
+            header_FF = read_header_snapshot(oleFF)
+            oleFF.close()
+            if (header.no_of_images is not None
+                and header_FF.image_width is not None
+                and header_FF.image_height is not None):
+
+                self.nSampleFramesFF = np.int(header_FF.no_of_images)
+                self.numrowsFF = np.int(header_FF.image_height)
+                self.numcolsFF = np.int(header_FF.image_width)
+                if header_FF.data_type is not None:
+                    self.datatypeFF = header_FF.data_type
                 if verbose: 
-                    print "ImageInfo/ImageWidth = %i" % yimage[0]  
-                self.numcolsFF = np.int(yimage[0])   
+                    print "ImageInfo/NoOfImages = %i" % self.nSampleFramesFF
+                    print "ImageInfo/ImageHeight = %i" % self.numrowsFF
+                    print "ImageInfo/ImageWidth = %i" % self.numcolsFF
                         
             else:
                 print('There is no information about the mosaic size ' +
                       '(ImageHeight, ImageWidth or Number of images)')
-            oleFF.close()    
             
         # Energy            	
-        if ole.exists('ImageInfo/Energy'):
-            stream = ole.openstream('ImageInfo/Energy')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            # we found some xrm images (flatfields) with different encoding 
-            # of data
-            try:
-                energies = struct.unpack(struct_fmt, data)
-            except struct.error:
-                print >> sys.stderr, ('Unexpected data length (%i bytes). ' +  
-                                      'Trying to unpack Energies with: ' + 
-                                      '"f"+"36xf"*(nSampleFrames-1)'%len(data))
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                energies = struct.unpack(struct_fmt, data)
+        if header.energies is not None:
+            energies = header.energies
             if verbose: print "ImageInfo/Energy: \n ",  energies  
             self.inst_source_grp['energy'] = energies
             self.inst_source_grp['energy'].attrs['units'] = 'eV'
@@ -280,78 +249,33 @@ class MosaicNex:
                   'have been taken the different mosaic images')
 
         # DataType: 10 float; 5 uint16 (unsigned 16-bit (2-byte) integers)
-        if ole.exists('ImageInfo/DataType'):                  
-            stream = ole.openstream('ImageInfo/DataType')
-            data = stream.read()
-            struct_fmt = '<1I'
-            datatype = struct.unpack(struct_fmt, data)
-            datatype = int(datatype[0])
-            if datatype == 5:
-                self.datatype = 'uint16'
-            else:
-                self.datatype = 'float'
+        if header.data_type is not None:
+            self.datatype = header.data_type
             if verbose: 
                 print "ImageInfo/DataType: %s " % self.datatype
         else:
             print("There is no information about DataType")
 
-        # Start and End Times 
-        if ole.exists('ImageInfo/Date'):  
-            stream = ole.openstream('ImageInfo/Date')       
-            data = stream.read()
-            dates = struct.unpack('<'+'17s23x'*self.nSampleFrames, data) 
-            
-            startdate = dates[0]
-            [day, hour] = startdate.split(" ")
-            [month, day, year] = day.split("/")
-            [hour, minute, second] = hour.split(":")    
-            
-            year = '20'+year
-            year = int(year)   
-            month = int(month)
-            day = int(day)
-            hour = int(hour)
-            minute = int(minute)
-            second = int(second)
-
-            starttime = datetime.datetime(year, month, day, 
-                                          hour, minute, second)                 
-            starttimeiso = starttime.isoformat()
-
+        # Start and End Times, and time of each image
+        if header.dates is not None:
+            timestamps = header.timestamps[:self.nSampleFrames]
+            starttimeiso = iso_time(timestamps[0])
             if verbose: 
                 print "ImageInfo/Date = %s" % starttimeiso 
             self.mosaic_grp['start_time'] = str(starttimeiso)
 
-            enddate = dates[self.nSampleFrames-1]    
-            [endday, endhour] = enddate.split(" ")
-            [endmonth, endday, endyear] = endday.split("/")
-            [endhour, endminute, endsecond] = endhour.split(":")
-
-            endyear = '20'+endyear
-            endyear = int(endyear)   
-            endmonth = int(endmonth)
-            endday = int(endday)
-            endhour = int(endhour)
-            endminute = int(endminute)
-            endsecond = int(endsecond)
-
-            endtime = datetime.datetime(endyear, endmonth, endday, 
-                                        endhour, endminute, endsecond)                 
-            endtimeiso = endtime.isoformat()
-
+            endtimeiso = iso_time(timestamps[-1])
             if verbose: 
                 print "ImageInfo/Date = %s" % endtimeiso 
             self.mosaic_grp['end_time'] = str(endtimeiso)
+            write_timestamps(self.mosaic_grp, timestamps)
 
         else:
             print("There is no information about Date")
 
         # Sample rotation angles 
-        if ole.exists('ImageInfo/Angles'):    
-            stream = ole.openstream('ImageInfo/Angles')
-            data = stream.read()
-            struct_fmt = '<{0:10}f'.format(self.nSampleFrames)
-            angles = struct.unpack(struct_fmt, data)
+        if header.angles is not None:
+            angles = header.angles
             if verbose: 
                 print "ImageInfo/Angles: \n ",  angles
 
@@ -372,20 +296,8 @@ class MosaicNex:
 
         # Sample translations in X, Y and Z 
         # X sample translation: nxsample['z_translation']
-        if ole.exists('ImageInfo/XPosition'):
-            stream = ole.openstream('ImageInfo/XPosition')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            # There have been found some xrm images (flatfields) with 
-            # different encoding of data
-            try: 
-                xpositions = struct.unpack(struct_fmt, data) 
-            except struct.error:
-                print >> sys.stderr, ('Unexpected data length (%i bytes). ' +  
-                                      'Trying to unpack XPositions with: ' + 
-                                      '"f"+"36xf"*(nSampleFrames-1)'%len(data))
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                xpositions = struct.unpack(struct_fmt, data)
+        if header.x_positions is not None:
+            xpositions = header.x_positions
             if verbose: 
                 print "ImageInfo/XPosition: \n ",  xpositions
             self.nxsample['x_translation'] = xpositions
@@ -394,20 +306,8 @@ class MosaicNex:
             print("There is no information about xpositions")
 
         # Y sample translation: nxsample['z_translation']
-        if ole.exists('ImageInfo/YPosition'):
-            stream = ole.openstream('ImageInfo/YPosition')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            # we found some xrm images (flatfields) with different encoding 
-            # of data.
-            try:
-                ypositions = struct.unpack(struct_fmt, data) 
-            except struct.error:
-                print >> sys.stderr, ('Unexpected data length (%i bytes). ' +  
-                                      'Trying to unpack YPositions with: ' + 
-                                      '"f"+"36xf"*(nSampleFrames-1)'%len(data))
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                ypositions = struct.unpack(struct_fmt, data)
+        if header.y_positions is not None:
+            ypositions = header.y_positions
             if verbose: 
                 print "ImageInfo/YPosition: \n ",  ypositions  
             self.nxsample['y_translation'] = ypositions
@@ -416,20 +316,8 @@ class MosaicNex:
             print("There is no information about xpositions")
 
         # Z sample translation: nxsample['z_translation']
-        if ole.exists('ImageInfo/ZPosition'):
-            stream = ole.openstream('ImageInfo/ZPosition')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            # we found some xrm images (flatfields) with different encoding 
-            # of data.
-            try: 
-                zpositions = struct.unpack(struct_fmt, data)
-            except struct.error:
-                print >> sys.stderr, ('Unexpected data length (%i bytes). ' +  
-                                      'Trying to unpack ZPositions with: ' + 
-                                      '"f"+"36xf"*(nSampleFrames-1)'%len(data))
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                zpositions = struct.unpack(struct_fmt, data)
+        if header.z_positions is not None:
+            zpositions = header.z_positions
             if verbose: 
                 print "ImageInfo/ZPosition: \n ",  zpositions
             self.nxsample['z_translation'] = zpositions
@@ -444,10 +332,42 @@ class MosaicNex:
         self.monitorcounts = np.ones(self.monitorsize, dtype=np.uint16)
         self.nxmonitor['data'] = self.monitorcounts
 
-        ole.close()
         print ("Meta-Data conversion from 'xrm' to NeXus HDF5 has been done.\n")
 
     # Converts a Mosaic image fromt xrm to NeXus hdf5.
+    # Function returning the raw data of a row of the image of an xrm file.
+    # In memory-mapped mode the rows are views of the mapped image, which
+    # is not copied.
+    def image_row_reader(self, ole, numcols, datatype):
+        stream = ole.openstream("ImageData1/Image1")
+        row_size = numcols * np.dtype(pixel_dtype(datatype)).itemsize
+        if hasattr(stream, 'getbuffer'):
+            data = stream.getbuffer()
+            return lambda row: buffer(data, row * row_size, row_size)
+
+        def read(row):
+            stream.seek(row * row_size)
+            return stream.read(row_size)
+        return read
+
+    # Row of the image of an xrm file.
+    def read_image_row(self, ole, row, numcols, datatype):
+        read = self.image_row_reader(ole, numcols, datatype)
+        return decode_image(read(row), 1, numcols, datatype, flip=False)[0]
+
+    # Add the rows of the image of an xrm file to the pipeline, to be
+    # written in dataset.
+    def add_image_rows(self, pipeline, name, ole, numrows, numcols, datatype,
+                       dataset):
+        # the rows are read in order by a single thread
+        read = self.image_row_reader(ole, numcols, datatype)
+
+        def decode(row, data):
+            return decode_image(data, 1, numcols, datatype, flip=False)[0]
+
+        pipeline.add(name, range(numrows), read, decode,
+                     self.storage.frame_writer(dataset))
+
     def convert_mosaic(self): 
 
         # Bright-Field
@@ -459,15 +379,21 @@ class MosaicNex:
         verbose = False
         print("Converting mosaic image data from xrm to NeXus HDF5.")
 
+        if self.datatype not in ('uint16', 'float'):
+            print "Wrong data type"
+            return
+
         # Opening the mosaic .xrm file as an Ole structure.
         olemosaic = OleFileIO(self.mosaic_file_xrm)
 
         # Mosaic data image
-        self.inst_sample_grp.create_dataset(
+        self.storage.create_dataset(
+            self.inst_sample_grp,
             "data",
-            shape=(self.numrows, self.numcols),
-            chunks=(1, self.numcols),
-            dtype=self.datatype)
+            (self.numrows, self.numcols),
+            self.datatype,
+            lambda row: self.read_image_row(olemosaic, row, self.numcols,
+                                            self.datatype))
 
         self.inst_sample_grp['data'].attrs['Data Type'] = self.datatype
         self.inst_sample_grp['data'].attrs['Number of Subimages'] = \
@@ -475,36 +401,18 @@ class MosaicNex:
         self.inst_sample_grp['data'].attrs['Image Height'] = self.numrows
         self.inst_sample_grp['data'].attrs['Image Width'] = self.numcols
 
-        img_string = "ImageData1/Image1"
-        stream = olemosaic.openstream(img_string)
-
-        for i in range(0, self.numrows):
-            if self.datatype == 'uint16':
-                dt = np.uint16
-                data = stream.read(self.numcols*2)
-            elif self.datatype == 'float':  
-
-                dt = np.float          
-                data = stream.read(self.numcols*4)                      
-            else:
-                print "Wrong data type"
-                return
-
-            imgdata = np.frombuffer(data, dtype=dt, count=self.numcols)
-            imgdata = np.reshape(imgdata, (1, self.numcols), order='A')
-            self.inst_sample_grp['data'][i] = imgdata
-            if i % 100 == 0:
-                print('Mosaic row %i converted' % (i + 1))
-
-        olemosaic.close()
+        # The rows of the mosaic and of its FF flow together through the
+        # pipeline. The mosaic is not flipped, neither its FF.
+        pipeline = ConversionPipeline(self.pipeline_workers, depth=64)
+        self.add_image_rows(pipeline, 'mosaic rows', olemosaic,
+                            self.numrows, self.numcols, self.datatype,
+                            self.inst_sample_grp['data'])
 
         source_addr = '/NXmosaic/instrument/sample/data'
         target_addr = 'data'
         self.inst_sample_grp['data'].attrs['target'] = source_addr
         self.nxdata._id.link(source_addr, target_addr, h5py.h5g.LINK_HARD)
 
-        print ("Mosaic image data conversion to NeXus HDF5 has been done.\n")
-
         # FF Data
         if self.index_FF_file != -1:
             
@@ -512,32 +420,27 @@ class MosaicNex:
             print ("Trying to convert FF xrm image to NeXus HDF5.")
 
             # Mosaic FF data image
-            img_string = "ImageData1/Image1"
-            stream = oleFF.openstream(img_string)        
-
-            if self.datatypeFF == 'uint16':
-                data = stream.read()
-                struct_fmt = "<{0:10}H".format(self.numrowsFF*self.numcolsFF)
-
-            elif self.datatypeFF == 'float':
-                data = stream.read()
-                struct_fmt = "<{0:10}f".format(self.numrowsFF*self.numcolsFF)
-
-            else:
-                print "Wrong FF data type"
-                return
-
-            imgdata = struct.unpack(struct_fmt, data)
-            imgdataFF = np.reshape(imgdata,
-                                   (self.numrowsFF, self.numcolsFF), order='A')
-
-            self.inst_FF_grp['data'] = imgdataFF
+            self.storage.create_dataset(
+                self.inst_FF_grp,
+                'data',
+                (self.numrowsFF, self.numcolsFF),
+                pixel_dtype(self.datatypeFF),
+                lambda row: self.read_image_row(oleFF, row, self.numcolsFF,
+                                                self.datatypeFF))
             self.inst_FF_grp['data'].attrs['Data Type'] = self.datatypeFF
             self.inst_FF_grp['data'].attrs['Number of images'] = \
                 self.nSampleFramesFF
             self.inst_FF_grp['data'].attrs['Image Height'] = self.numrowsFF
             self.inst_FF_grp['data'].attrs['Image Width'] = self.numcolsFF
+            self.add_image_rows(pipeline, 'FF rows', oleFF,
+                                self.numrowsFF, self.numcolsFF,
+                                self.datatypeFF, self.inst_FF_grp['data'])
 
+        pipeline.run()
+        print(pipeline.report())
+        olemosaic.close()
+        print ("Mosaic image data conversion to NeXus HDF5 has been done.\n")
+        if self.index_FF_file != -1:
             oleFF.close()
             print("FF image converted")
         self.mosaichdf.flush()
@@ -23,10 +23,17 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import numpy as np
 import h5py
 
+from storage import DatasetStorage
+
 
 class MosaicNormalize:
 
-    def __init__(self, inputfile, ratio=1):
+    def __init__(self, inputfile, ratio=1, write_batch=None, storage=None):
+
+        # Number of rows written at once (None: computed from memory)
+        self.write_batch = write_batch
+        # Chunking and compression of the normalized mosaic
+        self.storage = storage or DatasetStorage()
 
         # Input File: HDF5 Raw Data
         filename_nexus = inputfile
@@ -111,24 +118,9 @@ class MosaicNormalize:
 
             rel_cols_mosaic_to_FF = int(self.numcols / self.numcolsFF)
 
-            self.norm_grp.create_dataset(
-                "mosaic_normalized",
-                shape=(self.numrows, self.numcols),
-                chunks=(1, self.numcols),
-                dtype='float32')
-
-            self.norm_grp['mosaic_normalized'].attrs[
-                'Pixel Rows'] = self.numrows
-            self.norm_grp['mosaic_normalized'].attrs[
-                'Pixel Columns'] = self.numcols
-
             FF_image = FF_image_data.value
 
-            #########################################
-            # Normalization row by row              #
-            #########################################
-            for numrow in range(self.numrows):
-
+            def normalize_row(numrow):
                 individual_FF_row = list(FF_image[numrow%self.numrowsFF])
 
                 collageFFrow = individual_FF_row * rel_cols_mosaic_to_FF 
@@ -141,17 +133,34 @@ class MosaicNormalize:
                 denominator = np.array(collageFFrow)
                 denominator = denominator.astype(float)
 
-                self.norm_mosaic_row = np.array(numerator / (
+                return np.array(numerator / (
                     denominator * self.ratio_exptimes), dtype = np.float32)
 
-                imgdata = np.reshape(self.norm_mosaic_row,
-                                     (1, self.numcols),
-                                     order='A')
+            self.storage.create_dataset(
+                self.norm_grp,
+                "mosaic_normalized",
+                (self.numrows, self.numcols),
+                'float32',
+                normalize_row)
+
+            self.norm_grp['mosaic_normalized'].attrs[
+                'Pixel Rows'] = self.numrows
+            self.norm_grp['mosaic_normalized'].attrs[
+                'Pixel Columns'] = self.numcols
+
+            #########################################
+            # Normalization row by row              #
+            #########################################
+            writer = self.storage.frame_writer(
+                self.norm_grp['mosaic_normalized'], batch=self.write_batch)
+            with writer:
+                for numrow in range(self.numrows):
 
-                self.norm_grp['mosaic_normalized'][numrow] = imgdata
+                    self.norm_mosaic_row = normalize_row(numrow)
+                    writer.append(self.norm_mosaic_row)
 
-                if numrow % 200 == 0:
-                    print('Row %d has been normalized' % numrow)
+                    if numrow % 200 == 0:
+                        print('Row %d has been normalized' % numrow)
 
             print('\nMosaic has been normalized using the FF image.\n')
 
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import threading
+import Queue
+
+from prefetch import _payload_size
+
+
+# Maximum number of frames being read, decoded or waiting to be written
+DEFAULT_PIPELINE_DEPTH = 16
+# Maximum memory of the frames in the pipeline (bytes)
+DEFAULT_PIPELINE_MEMORY = 256 * 1024 * 1024
+
+
+class FrameStream(object):
+    """
+    Frames of one source converted by a ConversionPipeline: read(key)
+    returns the raw data of the frame key, decode(key, data) returns the
+    frame (with decode None, the data read is the frame) and the frames are
+    appended in the order of the keys to writer, which is flushed at the
+    end (see framewriter.frame_writer).
+    """
+
+    def __init__(self, name, keys, read, decode, writer):
+        self.name = name
+        self.keys = list(keys)
+        self.read = read
+        self.decode = decode
+        self.writer = writer
+        self.written = 0
+        self._pending = {}
+
+    def finished(self):
+        return self.written == len(self.keys)
+
+
+class ConversionPipeline(object):
+    """
+    Convert the frames of several FrameStreams concurrently in three
+    stages: a reader thread per stream, a pool of workers decoding the
+    frames of all the streams, and the writer, which is the thread calling
+    run: it is the only one writing in the HDF5 file, and it writes the
+    frames of each stream in order.
+
+    The stages are joined by queues which, all together, hold at most depth
+    frames and max_bytes of frame data (the next frame is assumed to be as
+    big as the last one read): the readers wait for the writer to catch up
+    when the pipeline is full.
+
+    With 0 workers there are no threads: the streams are converted one
+    after the other by the thread calling run.
+
+    The time spent in each stage is accumulated in read_time, decode_time
+    and write_time (seconds); read_wait_time is the time the readers have
+    been stopped by a full pipeline, and write_wait_time the time the
+    writer has waited for the frames.
+    """
+
+    def __init__(self, workers=1, depth=DEFAULT_PIPELINE_DEPTH,
+                 max_bytes=DEFAULT_PIPELINE_MEMORY):
+        if workers < 0:
+            raise ValueError("Number of workers must be positive or 0")
+        if depth < 1:
+            raise ValueError("Pipeline depth must be at least 1")
+        self.workers = workers
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.streams = []
+        self.frames = 0
+        self.read_time = 0.0
+        self.decode_time = 0.0
+        self.write_time = 0.0
+        self.read_wait_time = 0.0
+        self.write_wait_time = 0.0
+        self.elapsed = 0.0
+
+        self._in_flight = 0
+        self._bytes = 0
+        self._last_size = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._decode_queue = Queue.Queue()
+        self._write_queue = Queue.Queue()
+
+    def add(self, name, keys, read, decode, writer):
+        """Add a FrameStream to be converted by run; it is returned"""
+        stream = FrameStream(name, keys, read, decode, writer)
+        self.streams.append(stream)
+        return stream
+
+    def run(self):
+        """Convert the frames of all the streams added"""
+        start = time.time()
+        try:
+            if self.workers == 0:
+                self._run_serial()
+            else:
+                self._run_threaded()
+        finally:
+            self.elapsed += time.time() - start
+
+    def _add_time(self, stage, elapsed):
+        with self._lock:
+            setattr(self, stage, getattr(self, stage) + elapsed)
+
+    def _decode(self, stream, key, data):
+        if stream.decode is None:
+            return data
+        start = time.time()
+        frame = stream.decode(key, data)
+        self._add_time('decode_time', time.time() - start)
+        return frame
+
+    def _write(self, stream, frame):
+        start = time.time()
+        stream.writer.append(frame)
+        stream.written += 1
+        if stream.finished():
+            stream.writer.flush()
+        self.write_time += time.time() - start
+        self.frames += 1
+
+    def _run_serial(self):
+        for stream in self.streams:
+            for key in stream.keys:
+                start = time.time()
+                data = stream.read(key)
+                self.read_time += time.time() - start
+                self._write(stream, self._decode(stream, key, data))
+            if not stream.keys:
+                stream.writer.flush()
+
+    def _full(self):
+        if self._in_flight == 0:
+            return False
+        return (self._in_flight >= self.depth or
+                self._bytes + self._last_size > self.max_bytes)
+
+    def _read(self, stream):
+        try:
+            for index, key in enumerate(stream.keys):
+                with self._cond:
+                    if self._full():
+                        start = time.time()
+                        while not self._stopped and self._full():
+                            self._cond.wait()
+                        self.read_wait_time += time.time() - start
+                    if self._stopped:
+                        return
+                    self._in_flight += 1
+                start = time.time()
+                data = stream.read(key)
+                self._add_time('read_time', time.time() - start)
+                size = _payload_size(data)
+                with self._cond:
+                    self._bytes += size
+                    self._last_size = size
+                self._decode_queue.put((stream, index, key, data, size))
+        except Exception:
+            self._write_queue.put((None, None, None, sys.exc_info()))
+
+    def _work(self):
+        while True:
+            task = self._decode_queue.get()
+            if task is None:
+                return
+            stream, index, key, data, size = task
+            if self._stopped:
+                continue
+            try:
+                frame = self._decode(stream, key, data)
+            except Exception:
+                self._write_queue.put((None, None, None, sys.exc_info()))
+                continue
+            self._write_queue.put((stream, index, frame, size))
+
+    def _release(self, size):
+        with self._cond:
+            self._in_flight -= 1
+            self._bytes -= size
+            self._cond.notify_all()
+
+    def _run_threaded(self):
+        threads = []
+        for i in range(self.workers):
+            threads.append(threading.Thread(
+                target=self._work, name='ConversionPipeline-decoder-%i' % i))
+        readers = []
+        for stream in self.streams:
+            readers.append(threading.Thread(
+                target=self._read, args=(stream,),
+                name='ConversionPipeline-reader-%s' % stream.name))
+        for thread in threads + readers:
+            thread.daemon = True
+            thread.start()
+        try:
+            for stream in self.streams:
+                if not stream.keys:
+                    stream.writer.flush()
+            remaining = sum(len(stream.keys) for stream in self.streams)
+            while remaining:
+                start = time.time()
+                stream, index, frame, size = self._write_queue.get()
+                self.write_wait_time += time.time() - start
+                if stream is None:
+                    error = size
+                    raise error[0], error[1], error[2]
+                stream._pending[index] = (frame, size)
+                # write the frames of the stream that follow the last written
+                while stream.written in stream._pending:
+                    frame, size = stream._pending.pop(stream.written)
+                    self._write(stream, frame)
+                    self._release(size)
+                    remaining -= 1
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            for thread in readers:
+                thread.join()
+            for thread in threads:
+                self._decode_queue.put(None)
+            for thread in threads:
+                thread.join()
+            for stream in self.streams:
+                stream._pending.clear()
+
+    def report(self):
+        """Summary of the time spent in each stage"""
+        return ("Pipeline: %i frames of %i streams in %.3f s with %i "
+                "workers; read %.3f s (%.3f s waiting for the writer), "
+                "decode %.3f s, write %.3f s (%.3f s waiting for frames)"
+                % (self.frames, len(self.streams), self.elapsed,
+                   self.workers, self.read_time, self.read_wait_time,
+                   self.decode_time, self.write_time, self.write_wait_time))
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+
+# Number of frames read in advance
+DEFAULT_PREFETCH_DEPTH = 4
+# Maximum memory used by the frames read in advance (bytes)
+DEFAULT_PREFETCH_MEMORY = 256 * 1024 * 1024
+
+
+def image_stream_name(numimage):
+    """
+    Name of the stream of the image numimage (starting at 1) in a txrm file.
+    Images are stored as ImageData1/Image1, ImageData1/Image2...
+    each storage contains 100 images: 1-100, 101-200...
+    """
+    return "ImageData%i/Image%i" % (np.ceil(numimage/100.0), numimage)
+
+
+def stream_data(stream):
+    """
+    Raw data of a stream opened with OleFileIO.openstream. The streams of a
+    memory-mapped file return the mapped bytes themselves (see
+    _OleMappedStream.getbuffer), to be decoded with no intermediate copy;
+    the other streams are read.
+    """
+    if hasattr(stream, 'getbuffer'):
+        return stream.getbuffer()
+    return stream.read()
+
+
+def ole_image_reader(ole):
+    """
+    Return a function reading the raw data of the image numimage of the
+    txrm file opened as the OleFileIO ole (see stream_data).
+    """
+    def read(numimage):
+        return stream_data(ole.openstream(image_stream_name(numimage)))
+    return read
+
+
+def _payload_size(payload):
+    nbytes = getattr(payload, 'nbytes', None)
+    if nbytes is None:
+        nbytes = len(payload)
+    return nbytes
+
+
+class FramePrefetcher(object):
+    """
+    Iterate over the frames read with read(key) for each one of the keys,
+    in order. A background thread reads up to depth frames in advance, and
+    stops reading while the frames waiting to be consumed take more than
+    max_bytes (the next frame is assumed to be as big as the last one read).
+    With depth 0 the frames are read by the consumer when it asks for them.
+
+    Errors raised by read are raised again by the iterator once the frames
+    read before the error have been consumed.
+
+    waits counts the frames the consumer had to wait for, and wait_time
+    is the total time waited (seconds).
+    """
+
+    def __init__(self, read, keys, depth=DEFAULT_PREFETCH_DEPTH,
+                 max_bytes=DEFAULT_PREFETCH_MEMORY):
+        if depth < 0:
+            raise ValueError("Prefetch depth must be positive or 0")
+        self.read = read
+        self.keys = list(keys)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.frames = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+        self._queue = deque()
+        self._bytes = 0
+        self._last_size = 0
+        self._error = None
+        self._done = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+        if depth > 0:
+            self._thread = threading.Thread(target=self._prefetch,
+                                            name='FramePrefetcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _full(self):
+        if not self._queue:
+            return False
+        return (len(self._queue) >= self.depth or
+                self._bytes + self._last_size > self.max_bytes)
+
+    def _prefetch(self):
+        try:
+            for key in self.keys:
+                with self._cond:
+                    while not self._closed and self._full():
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                payload = self.read(key)
+                size = _payload_size(payload)
+                with self._cond:
+                    if self._closed:
+                        return
+                    self._queue.append((payload, size))
+                    self._bytes += size
+                    self._last_size = size
+                    self._cond.notify_all()
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def next(self):
+        if self._thread is None:
+            if self.frames == len(self.keys):
+                raise StopIteration
+            start = time.time()
+            payload = self.read(self.keys[self.frames])
+            self.waits += 1
+            self.wait_time += time.time() - start
+            self.frames += 1
+            return payload
+
+        with self._cond:
+            if not self._queue and not self._done:
+                self.waits += 1
+                start = time.time()
+                while not self._queue and not self._done:
+                    self._cond.wait()
+                self.wait_time += time.time() - start
+            if self._queue:
+                payload, size = self._queue.popleft()
+                self._bytes -= size
+                self._cond.notify_all()
+                self.frames += 1
+                return payload
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+        raise StopIteration
+
+    def close(self):
+        """Stop reading frames in advance and release the pending ones"""
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def report(self):
+        """Summary of the time that the consumer has waited for the frames"""
+        return ("Waited for the reading of %i of %i frames (%.3f s)"
+                % (self.waits, self.frames, self.wait_time))
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import multiprocessing
+from collections import deque
+
+
+class OrderedProcessPool(object):
+    """
+    Pool of worker processes computing func(item) for a sequence of items,
+    whose results are returned in the order of the items (see imap). func,
+    the items and the results are pickled to be sent between the processes:
+    func must be a function defined at the top level of a module.
+
+    As in OrderedThreadPool, at most max_pending items (2 per process by
+    default) are submitted before their results are consumed, which bounds
+    the memory used by the results waiting to be consumed whatever the
+    number of items.
+
+    waits counts the results the consumer had to wait for, and wait_time
+    is the total time waited (seconds).
+    """
+
+    def __init__(self, processes, max_pending=None):
+        if processes < 1:
+            raise ValueError("At least one process is needed")
+        self.processes = processes
+        self.max_pending = max_pending or 2 * processes
+        self.results = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._pool = multiprocessing.Pool(processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def imap(self, func, items):
+        """
+        Iterate over func(item) for each one of the items, in order. An
+        exception raised by func is raised again when its result is reached.
+        """
+        items = iter(items)
+        pending = deque()
+        for item in items:
+            pending.append(self._pool.apply_async(func, (item,)))
+            if len(pending) == self.max_pending:
+                break
+        while pending:
+            task = pending.popleft()
+            if not task.ready():
+                self.waits += 1
+                start = time.time()
+                task.wait()
+                self.wait_time += time.time() - start
+            result = task.get()
+            for item in items:
+                pending.append(self._pool.apply_async(func, (item,)))
+                break
+            self.results += 1
+            yield result
+
+    def close(self):
+        """Stop the processes once the submitted items are computed"""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Stop the processes without waiting for the submitted items"""
+        self._pool.terminate()
+        self._pool.join()
+
+    def report(self):
+        """Summary of the time that the consumer has waited for the results"""
+        return ("Waited for %i of %i results computed by %i processes "
+                "(%.3f s)" % (self.waits, self.results, self.processes,
+                              self.wait_time))
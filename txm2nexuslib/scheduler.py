@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import traceback
+import multiprocessing
+from collections import deque, namedtuple
+
+
+# Interval (seconds) at which the running jobs are checked
+POLL_INTERVAL = 0.05
+
+# Outcome of a job: the value returned by its function, or the traceback
+# of the error that stopped it (None if it succeeded)
+JobResult = namedtuple('JobResult', ['name', 'value', 'error', 'seconds'])
+
+
+class _Job(object):
+
+    def __init__(self, name, func, kwargs, memory, started, done):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs
+        self.memory = memory
+        self.started_callback = started
+        self.done_callback = done
+        self.process = None
+        self.connection = None
+        self.started = None
+
+    def run(self):
+        # Run the function, catching its error
+        start = time.time()
+        try:
+            value = self.func(**self.kwargs)
+            error = None
+        except Exception:
+            value = None
+            error = traceback.format_exc()
+        return JobResult(self.name, value, error, time.time() - start)
+
+    def _run_in_process(self, connection):
+        try:
+            connection.send(self.run())
+        finally:
+            connection.close()
+
+    def start(self):
+        # Run the function in a new process, which sends back the result
+        self.connection, child_connection = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(
+            target=self._run_in_process, args=(child_connection,),
+            name=str(self.name))
+        self.process.start()
+        child_connection.close()
+        self.started = time.time()
+
+    def poll(self):
+        # Result of the job started, or None if it has not finished
+        if not self.connection.poll():
+            if self.process.is_alive():
+                return None
+            # the result may have been sent just before the process exited
+            if not self.connection.poll():
+                return self._finish(None)
+        try:
+            result = self.connection.recv()
+        except EOFError:
+            result = None
+        return self._finish(result)
+
+    def _finish(self, result):
+        self.process.join()
+        self.connection.close()
+        if result is None:
+            # the process died without sending a result
+            result = JobResult(self.name, None,
+                               "Process exited with code %s" %
+                               self.process.exitcode,
+                               time.time() - self.started)
+        return result
+
+
+class ConversionScheduler(object):
+    """
+    Run independent jobs (conversions of different files) at most max_jobs
+    at once, each one in a process of its own, and collect their results.
+    A job is started only if the memory estimated for it, added to the
+    memory of the running jobs, is at most max_memory (bytes); a job is
+    always started when none is running.
+
+    With max_jobs 0, the jobs are run in this process, one after the
+    other. In any case, the error of a job does not stop the others: it is
+    recorded in the results (see JobResult and report).
+
+    The callbacks of a job are called by this process: started() just
+    before the job is started (so what it prepares is inherited by the
+    process of the job), and done(result) when it has finished.
+    """
+
+    def __init__(self, max_jobs=0, max_memory=None):
+        if max_jobs < 0:
+            raise ValueError("The number of jobs cannot be negative")
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.results = []
+        self._pending = deque()
+
+    def add(self, name, func, kwargs=None, memory=0, started=None,
+            done=None):
+        """
+        Add the job name calling func(**kwargs), using memory bytes, with
+        the optional callbacks started and done
+        """
+        self._pending.append(_Job(name, func, kwargs or {}, memory, started,
+                                  done))
+
+    def _started(self, job):
+        if job.started_callback is not None:
+            job.started_callback()
+
+    def _finished(self, job, result):
+        self.results.append(result)
+        if job.done_callback is not None:
+            job.done_callback(result)
+
+    def _can_start(self, running):
+        if not running:
+            return True
+        if len(running) >= self.max_jobs:
+            return False
+        if self.max_memory is None:
+            return True
+        used = sum(job.memory for job in running)
+        return used + self._pending[0].memory <= self.max_memory
+
+    def run(self):
+        """
+        Run all the jobs added, and return the results of all the jobs run
+        by the scheduler, in the order in which they have finished.
+        """
+        if self.max_jobs == 0:
+            while self._pending:
+                job = self._pending.popleft()
+                self._started(job)
+                self._finished(job, job.run())
+            return self.results
+        running = []
+        try:
+            while self._pending or running:
+                while self._pending and self._can_start(running):
+                    job = self._pending.popleft()
+                    self._started(job)
+                    job.start()
+                    running.append(job)
+                for job in list(running):
+                    result = job.poll()
+                    if result is not None:
+                        running.remove(job)
+                        self._finished(job, result)
+                time.sleep(POLL_INTERVAL)
+        finally:
+            # if the scheduler is interrupted, its jobs are stopped
+            for job in running:
+                job.process.terminate()
+                job.process.join()
+        return self.results
+
+    def add_failed(self, name, error):
+        """Record the job name, which cannot be run, as failed with error"""
+        self.results.append(JobResult(name, None, error, 0.0))
+
+    def failed(self):
+        """Results of the jobs that have failed"""
+        return [result for result in self.results if result.error is not None]
+
+    def report(self):
+        """Summary of the jobs run: their time and the errors of the failed"""
+        lines = []
+        for result in self.results:
+            status = 'FAILED' if result.error is not None else 'OK'
+            lines.append('%s: %s (%.1f s)' % (result.name, status,
+                                              result.seconds))
+        for result in self.failed():
+            lines.append('\nError in %s:\n%s' % (result.name,
+                                                 result.error.rstrip()))
+        lines.append('\n%i jobs converted, %i failed' %
+                     (len(self.results) - len(self.failed()),
+                      len(self.failed())))
+        return '\n'.join(lines)
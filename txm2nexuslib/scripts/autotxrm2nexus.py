@@ -23,6 +23,32 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import os
 
+from txm2nexuslib.catalog import Catalog, query_directory
+
+
+def get_tomo_folders(general_folder):
+    # Subfolders of tomos and the names of their files
+    folders = []
+    for folder in os.listdir(general_folder):
+        specific_folder = os.path.join(general_folder, folder)
+        if os.path.isdir(specific_folder):
+            folders.append((folder, os.listdir(specific_folder)))
+    return folders
+
+
+def get_catalog_tomo_folders(catalog, general_folder, where=None):
+    # Subfolders of tomos and the names of their txrm files which meet the
+    # SQL condition where, from the catalog (updated with the new and
+    # changed files)
+    general_folder = os.path.abspath(general_folder)
+    folders = {}
+    for row in query_directory(catalog, general_folder, where,
+                               recursive=True, order_by='path'):
+        if os.path.dirname(row['directory']) == general_folder:
+            folder = os.path.basename(row['directory'])
+            folders.setdefault(folder, []).append(row['name'])
+    return sorted(folders.items())
+
 
 def main():
 
@@ -39,22 +65,38 @@ def main():
                         help="Indicates the folder adress where "
                              "the subfolders 'tomo1' 'tomo2' and so on, "
                              "are located.")
+    parser.add_argument('--catalog', type=str, default=None,
+                        help="SQLite catalog of the txrm files (created if "
+                             "it does not exist). Only the new and changed "
+                             "files of the folder are read to update it, "
+                             "and the files are selected from it")
+    parser.add_argument('--query', type=str, default=None,
+                        help="SQL condition on the columns of the catalog "
+                             "selecting the files to convert")
 
     args = parser.parse_args()
+    if args.query is not None and args.catalog is None:
+        parser.error("--query needs a --catalog")
     general_folder = args.folder
 
     txrm2nexus_program_name = 'txrm2nexus'
 
-    for folder in os.listdir(general_folder):
+    if args.catalog is not None:
+        with Catalog(args.catalog) as catalog:
+            folders = get_catalog_tomo_folders(catalog, general_folder,
+                                               args.query)
+    else:
+        folders = get_tomo_folders(general_folder)
+
+    for folder, folder_files in folders:
 
         specific_folder = os.path.join(general_folder, folder)
         # Checking if the subfolder is a subfolder of tomos.
-        if os.path.isdir(specific_folder) \
-                and (('tomo' in folder) or ('TOMO' in folder)):
+        if ('tomo' in folder) or ('TOMO' in folder):
 
             os.chdir(specific_folder)
             print('Converting tomos from folder '+ folder)
-            for files in os.listdir("."):
+            for files in folder_files:
                 if files.endswith(".txrm"):    
                     if 'FF' in files:
                         flatfield_txrm_file = files
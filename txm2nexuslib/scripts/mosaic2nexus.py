@@ -19,7 +19,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from txm2nexuslib import mosaicnex
+from txm2nexuslib import mosaicnex, storage, OleFileIO_PL
 import datetime
 import argparse
 
@@ -57,13 +57,35 @@ def main():
               "Possible options are: 'x-ray', 'neutron', 'electron'"))        
     parser.add_argument('--sample-name', type=str, default='Unknown', 
         help="Sets the sample name") 
+    parser.add_argument('-p', '--pipeline', type=int, default=0,
+                        help="Convert the rows of the mosaic and FF images "
+                             "concurrently, in a pipeline with this number "
+                             "of decoding threads. With 0, the images are "
+                             "converted one after the other")
+    parser.add_argument('--mmap', action='store_true',
+                        help="Memory-map the xrm files: the images are "
+                             "decoded from the mapped files, without being "
+                             "read with system calls (nor copied, if they "
+                             "are stored contiguously)")
+    parser.add_argument('--layout-cache', type=str, default=None,
+                        metavar='DIR',
+                        help="Directory where the layout (directory and "
+                             "stream locations) of each xrm file is saved, "
+                             "to open it faster the next times it is "
+                             "converted, while it is not modified")
+    storage.add_storage_arguments(parser)
 
     args = parser.parse_args()
+    if args.mmap:
+        OleFileIO_PL.set_use_mmap(True)
+    if args.layout_cache is not None:
+        OleFileIO_PL.set_layout_cache_dir(args.layout_cache)
 
     nexusmosaic = mosaicnex.MosaicNex(args.files, args.files_order, args.title,
                                       args.source_name, args.source_type, 
                                       args.source_probe, args.instrument_name, 
-                                      args.sample_name)
+                                      args.sample_name, args.pipeline,
+                                      storage.storage_from_args(args, parser))
 
     if nexusmosaic.exitprogram != 1:
         nexusmosaic.NXmosaic_structure()  
@@ -23,6 +23,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from txm2nexuslib import tomonorm
 from txm2nexuslib import specnorm
 from txm2nexuslib import mosaicnorm
+from txm2nexuslib import framewriter
+from txm2nexuslib import storage
+from txm2nexuslib import sinogram
 import argparse
 
 
@@ -80,12 +83,29 @@ def main():
                         help='Correct diffraction pattern with external '
                              'given avgFF (-d=1).')
 
+    parser.add_argument('--write-batch', type=int, default=None,
+                        help='Number of images written at once to the HDF5 '
+                             'file. By default, as many as fit in %i MB.'
+                             % (framewriter.DEFAULT_WRITE_MEMORY / 2**20))
+    parser.add_argument('--sinogram', type=str, default=None,
+                        choices=sinogram.SINOGRAM_MODES,
+                        help='Write also, or only, the normalized images as '
+                             'sinograms: a (rows, images, columns) dataset. '
+                             'Available only for Tomo normalization.')
+    parser.add_argument('--sinogram-memory', type=int,
+                        default=sinogram.DEFAULT_SINOGRAM_MEMORY / 2**20,
+                        help='Maximum memory (MB) used to transpose the '
+                             'normalized images into sinograms.')
+    storage.add_storage_arguments(parser)
+
     args = parser.parse_args()
+    dataset_storage = storage.storage_from_args(args, parser)
 
     if args.mosaicnorm == 1:
         print("\nNormalizing Mosaic")
-        normalize_object = mosaicnorm.MosaicNormalize(args.inputfile,
-                                                      ratio=args.ratio)
+        normalize_object = mosaicnorm.MosaicNormalize(
+            args.inputfile, ratio=args.ratio, write_batch=args.write_batch,
+            storage=dataset_storage)
         normalize_object.normalizeMosaic()  
         
     else:
@@ -98,11 +118,15 @@ def main():
                                                       args.avgtomnorm,
                                                       args.gaussianblur,
                                                       args.avgff,
-                        args.diffraction)
+                        args.diffraction, args.write_batch,
+                        dataset_storage, args.sinogram,
+                        args.sinogram_memory * 1024 * 1024)
             normalize_object.normalize_tomo()
         else:
             print("\nNormalizing Spectroscopy images")
-            normalize_object = specnorm.SpecNormalize(args.inputfile)
+            normalize_object = specnorm.SpecNormalize(
+                args.inputfile, write_batch=args.write_batch,
+                storage=dataset_storage)
             normalize_object.normalizeSpec()
 
   
@@ -20,7 +20,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
-from txm2nexuslib import txrmnex
+from txm2nexuslib import txrmnex, prefetch, framewriter, storage, sinogram
+from txm2nexuslib import OleFileIO_PL
 import datetime
 import argparse
 
@@ -65,8 +66,76 @@ def main():
                         help="Sets the instrument name")
     parser.add_argument('--sample-name', type=str, default='Unknown',
                         help="Sets the sample name")
+    parser.add_argument('--prefetch', type=int,
+                        default=prefetch.DEFAULT_PREFETCH_DEPTH,
+                        help="Number of images read in advance while the "
+                             "previous ones are converted (0 disables it)")
+    parser.add_argument('--prefetch-memory', type=int,
+                        default=prefetch.DEFAULT_PREFETCH_MEMORY / 2**20,
+                        help="Maximum memory (MB) used by the images "
+                             "read in advance")
+    parser.add_argument('--write-batch', type=int, default=None,
+                        help="Number of images written at once to the HDF5 "
+                             "file. By default, as many as fit in %i MB"
+                             % (framewriter.DEFAULT_WRITE_MEMORY / 2**20))
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help="Number of threads reading and decoding the "
+                             "images. With 0, the images are decoded by the "
+                             "thread writing them in the HDF5 file")
+    parser.add_argument('-p', '--pipeline', type=int, default=0,
+                        help="Convert the images of the sample, bright and "
+                             "dark field files concurrently, in a pipeline "
+                             "with this number of decoding threads. With 0, "
+                             "the files are converted one after the other")
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help="Convert the sample images while the sample "
+                             "txrm file is being acquired. The metadata is "
+                             "converted when the acquisition finishes")
+    parser.add_argument('--poll-interval', type=float,
+                        default=txrmnex.DEFAULT_POLL_INTERVAL,
+                        help="Seconds between two readings of the txrm "
+                             "file in follow mode")
+    parser.add_argument('--idle-timeout', type=float,
+                        default=txrmnex.DEFAULT_IDLE_TIMEOUT,
+                        help="Seconds without changes in the txrm file "
+                             "after which the acquisition is considered "
+                             "finished in follow mode")
+    parser.add_argument('--sinogram', type=str, default=None,
+                        choices=sinogram.SINOGRAM_MODES,
+                        help="Write also, or only, the sample images as "
+                             "sinograms: a (rows, images, columns) dataset")
+    parser.add_argument('--sinogram-memory', type=int,
+                        default=sinogram.DEFAULT_SINOGRAM_MEMORY / 2**20,
+                        help="Maximum memory (MB) used to transpose the "
+                             "images into sinograms; with more images, "
+                             "they are transposed through a temporary file")
+    parser.add_argument('--external', action='store_true',
+                        help="Reference the sample images in the txrm file "
+                             "instead of copying them (HDF5 external "
+                             "storage; the images are kept upside down). "
+                             "Fragmented images are copied")
+    parser.add_argument('--mmap', action='store_true',
+                        help="Memory-map the txrm files: the images are "
+                             "decoded from the mapped files, without being "
+                             "read with system calls (nor copied, if they "
+                             "are stored contiguously)")
+    parser.add_argument('--layout-cache', type=str, default=None,
+                        metavar='DIR',
+                        help="Directory where the layout (directory and "
+                             "stream locations) of each txrm file is saved, "
+                             "to open it faster the next times it is "
+                             "converted, while it is not modified")
+    storage.add_storage_arguments(parser)
 
     args = parser.parse_args()
+    if args.follow and args.sinogram == 'only':
+        parser.error("--sinogram only cannot be used with --follow")
+    if args.external and (args.follow or args.sinogram is not None):
+        parser.error("--external cannot be used with --follow or --sinogram")
+    if args.mmap:
+        OleFileIO_PL.set_use_mmap(True)
+    if args.layout_cache is not None:
+        OleFileIO_PL.set_layout_cache_dir(args.layout_cache)
 
     nexus = txrmnex.txrmNXtomo(args.files,
                                args.files_order,
@@ -77,10 +146,21 @@ def main():
                                args.source_type,
                                args.source_probe,
                                args.instrument_name,
-                               args.sample_name)
+                               args.sample_name,
+                               args.prefetch,
+                               args.prefetch_memory * 1024 * 1024,
+                               args.write_batch,
+                               args.workers,
+                               args.pipeline,
+                               storage.storage_from_args(args, parser),
+                               args.sinogram,
+                               args.sinogram_memory * 1024 * 1024,
+                               args.external)
 
     if nexus.exitprogram != 1:
         nexus.NXtomo_structure()
+        if args.follow:
+            nexus.follow_image_stack(args.poll_interval, args.idle_timeout)
         nexus.convert_metadata()
         nexus.convert_image_stack()
         
@@ -21,7 +21,11 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os, sys
 import datetime
 import argparse
-from txm2nexuslib.xrmnex import xrmNXtomo, xrmReader
+from txm2nexuslib.xrmnex import (convert_xrm_tomo, convert_xrm_bright_field,
+                                 bright_field_file_name, xrmReader)
+from txm2nexuslib.scheduler import ConversionScheduler
+from txm2nexuslib.catalog import Catalog, query_directory, is_bright_field
+from txm2nexuslib import prefetch, framewriter, storage, OleFileIO_PL
 
 
 def get_samples(dir_name):
@@ -33,7 +37,7 @@ def get_samples(dir_name):
             continue
 
         splitted_name = file.split('_')
-        has_ff = file.find('_FF_') != -1
+        has_ff = is_bright_field(file)
 
         sample_name = "{0}_{1}_{2}".format(splitted_name[0],
                                            splitted_name[1],
@@ -49,6 +53,60 @@ def get_samples(dir_name):
         else:
             samples[sample_name]['ff'].append(fname)
 
+    # sort files
+    for sample in samples.values():
+        sample['ff'].sort(key=lambda x: os.path.getmtime(x))
+        for tomo_files in sample['tomos'].values():
+            tomo_files.sort(key=lambda x: os.path.getmtime(x))
+    return samples
+
+
+class SampleBrightField(object):
+    """
+    Bright field of a sample decoded once for all its tomos (shared by the
+    processes of the tomos): its images are cached when the first tomo is
+    started, and released when the last one has finished. The memory of
+    the cached images is estimated as the size of the files.
+    """
+
+    def __init__(self, ff_files, tomos):
+        self.reader = xrmReader(ff_files, cache_images=True)
+        self.remaining = tomos
+        self.loaded = False
+        self.memory = sum(os.path.getsize(name) for name in ff_files)
+
+    def started(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            self.reader.preload()
+        except Exception:
+            # the error is reported by the tomos, which read the files
+            self.reader.close()
+
+    def done(self, result):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.reader.close()
+
+
+def get_catalog_samples(catalog, dir_name, where=None):
+    """
+    Samples of the xrm files of dir_name, as get_samples, from the catalog
+    (updated with the new and changed files) and only with the files that
+    meet the SQL condition where (see catalog.Catalog.query).
+    """
+    samples = {}
+    # rows sorted by modification time
+    for row in query_directory(catalog, dir_name, where):
+        if not row['name'].endswith('.xrm'):
+            continue
+        sample = samples.setdefault(row['sample'], {'tomos': {}, 'ff': []})
+        if row['role'] == 'ff':
+            sample['ff'].append(row['path'])
+        else:
+            sample['tomos'].setdefault(row['tomo'], []).append(row['path'])
     return samples
 
 
@@ -80,19 +138,150 @@ def main():
                              "'x-ray', 'neutron','electron'")
     parser.add_argument('--instrument-name', type=str, default='BL09 @ ALBA',
                         help="Sets the instrument name")
+    parser.add_argument('--prefetch', type=int,
+                        default=prefetch.DEFAULT_PREFETCH_DEPTH,
+                        help="Number of images read in advance while the "
+                             "previous ones are converted (0 disables it)")
+    parser.add_argument('--prefetch-memory', type=int,
+                        default=prefetch.DEFAULT_PREFETCH_MEMORY / 2**20,
+                        help="Maximum memory (MB) used by the images "
+                             "read in advance")
+    parser.add_argument('--write-batch', type=int, default=None,
+                        help="Number of images written at once to the HDF5 "
+                             "file. By default, as many as fit in %i MB"
+                             % (framewriter.DEFAULT_WRITE_MEMORY / 2**20))
+    parser.add_argument('-p', '--pipeline', type=int, default=0,
+                        help="Convert the images of the sample and bright "
+                             "field files concurrently, in a pipeline with "
+                             "this number of decoding threads. With 0, the "
+                             "files are converted one after the other")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help="Open and decode the xrm files in this number "
+                             "of processes, whose images are written in "
+                             "order to the HDF5 file. With 0, the files are "
+                             "read by this process")
+    parser.add_argument('--tomo-jobs', type=int, default=0,
+                        help="Number of tomos converted at once, each one "
+                             "in a process of its own. With 0, the tomos "
+                             "are converted one after the other by this "
+                             "process")
+    parser.add_argument('--max-memory', type=int, default=None,
+                        help="Maximum memory (MB) used by the tomos "
+                             "converted at once. Each one is estimated to "
+                             "use the prefetch memory, %i MB to write "
+                             "the images and, without "
+                             "--shared-bright-field, the size of the "
+                             "bright field files of its sample, whose "
+                             "images are kept in memory" %
+                             (framewriter.DEFAULT_WRITE_MEMORY / 2**20))
+    parser.add_argument('--shared-bright-field', action='store_true',
+                        help="Convert the bright field of each sample once, "
+                             "to a file referenced by the files of its "
+                             "tomos through external links. Otherwise, it "
+                             "is decoded once and copied to each file, its "
+                             "images being kept in memory while the tomos of "
+                             "the sample are converted")
+    parser.add_argument('--catalog', type=str, default=None,
+                        help="SQLite catalog of the xrm files (created if "
+                             "it does not exist). Only the new and changed "
+                             "files of the input path are read to update it, "
+                             "and the files are selected from it")
+    parser.add_argument('--query', type=str, default=None,
+                        help="SQL condition on the columns of the catalog "
+                             "selecting the files to convert, for instance "
+                             "\"energy > 520 AND exposure < 2\"")
+    parser.add_argument('--mmap', action='store_true',
+                        help="Memory-map the xrm files: the images are "
+                             "decoded from the mapped files, without being "
+                             "read with system calls (nor copied, if they "
+                             "are stored contiguously)")
+    parser.add_argument('--layout-cache', type=str, default=None,
+                        metavar='DIR',
+                        help="Directory where the layout (directory and "
+                             "stream locations) of each xrm file is saved, "
+                             "to open it faster the next times it is "
+                             "converted, while it is not modified")
+    storage.add_storage_arguments(parser)
 
     args = parser.parse_args()
+    if args.jobs > 0 and args.pipeline > 0:
+        parser.error("--jobs cannot be used with --pipeline")
+    if args.tomo_jobs < 0:
+        parser.error("--tomo-jobs cannot be negative")
+    if args.query is not None and args.catalog is None:
+        parser.error("--query needs a --catalog")
+    if args.mmap:
+        OleFileIO_PL.set_use_mmap(True)
+    if args.layout_cache is not None:
+        OleFileIO_PL.set_layout_cache_dir(args.layout_cache)
+    dataset_storage = storage.storage_from_args(args, parser)
 
     dir_name = args.input_dir_name
     output_dir = args.output_dir_name
-    samples = get_samples(dir_name)
+    if args.catalog is not None:
+        with Catalog(args.catalog) as catalog:
+            samples = get_catalog_samples(catalog, dir_name, args.query)
+    else:
+        samples = get_samples(dir_name)
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = args.max_memory * 1024 * 1024
+    tomo_memory = (args.prefetch_memory * 1024 * 1024 +
+                   framewriter.DEFAULT_WRITE_MEMORY)
+    scheduler = ConversionScheduler(args.tomo_jobs, max_memory)
+    image_options = dict(prefetch_depth=args.prefetch,
+                         prefetch_memory=args.prefetch_memory * 1024 * 1024,
+                         write_batch=args.write_batch,
+                         storage=dataset_storage,
+                         jobs=args.jobs)
+
+    # The shared bright field files are converted before the tomos
+    bright_field_scheduler = ConversionScheduler(args.tomo_jobs, max_memory)
+    bright_field_files = {}
+    if args.shared_bright_field:
+        for sample in samples.keys():
+            ff_files = samples[sample]['ff']
+            if len(ff_files) == 0:
+                continue
+            file_name = bright_field_file_name(ff_files, output_dir)
+            bright_field_files[sample] = file_name
+            options = dict(image_options, ff_files=ff_files,
+                           file_name=file_name)
+            bright_field_scheduler.add('%s bright field' % sample,
+                                       convert_xrm_bright_field, options,
+                                       tomo_memory)
+        bright_field_scheduler.run()
+        failed = set(result.name
+                     for result in bright_field_scheduler.failed())
+        for sample in bright_field_files.keys():
+            if '%s bright field' % sample in failed:
+                del bright_field_files[sample]
+
     # Generate the hdf5 files
     for sample in samples.keys():
         tomos = samples[sample]['tomos']
-        # Create FF reader
         ff_files = samples[sample]['ff']
-        ff_files.sort(key=lambda x: os.path.getmtime(x))
-        ffreader = xrmReader(ff_files)
+        ffreader = None
+        callbacks = {}
+        memory = tomo_memory
+        if len(ff_files) == 0:
+            pass
+        elif not args.shared_bright_field:
+            bright_field = SampleBrightField(ff_files, len(tomos))
+            ffreader = bright_field.reader
+            callbacks = dict(started=bright_field.started,
+                             done=bright_field.done)
+            # the cached images are inherited by the processes of the tomos
+            memory += bright_field.memory
+        elif sample not in bright_field_files:
+            print "WARNING: The BrightField of Sample: %s could not be " \
+                  "converted. HDF5 files can not be created for its " \
+                  "tomos" % sample
+            for tomo in tomos.keys():
+                scheduler.add_failed('%s %s' % (sample, tomo),
+                                     "The bright field of the sample could "
+                                     "not be converted")
+            continue
         for tomo in tomos.keys():
             tomo_files = samples[sample]['tomos'][tomo]
             if len(ff_files) == 0:
@@ -100,31 +289,34 @@ def main():
                       "files. HDF5 file can not be created for this tomo" %\
                       (tomo, sample)
                 continue
-            # sort files
-            tomo_files.sort(key=lambda x: os.path.getmtime(x))
-
-            reader = xrmReader(tomo_files)
-
-            xrm = xrmNXtomo(reader, ffreader,
-
-                            'sb',  # TODO: Not need?
-                            'xrm2nexus',
-                            program_args=sys.argv[1:],  # TODO:show args?
-                            hdf5_output_path=output_dir,
-                            title=args.title,
-                            zero_deg_in=None,  # TODO Not well implemented
-                            zero_deg_final=None,  # TODO Not well implemented
-                            sourcename=args.source_name,
-                            sourcetype=args.source_type,
-                            sourceprobe=args.source_probe,
-                            instrument=args.instrument_name,
-                            )
-            xrm.convert_metadata()
-            xrm.convert_tomography()
+            options = dict(image_options,
+                           tomo_files=tomo_files,
+                           ffreader=ffreader,
+                           bright_field_file=bright_field_files.get(sample),
+                           program_args=sys.argv[1:],  # TODO:show args?
+                           hdf5_output_path=output_dir,
+                           title=args.title,
+                           zero_deg_in=None,  # TODO Not well implemented
+                           zero_deg_final=None,  # TODO Not well implemented
+                           sourcename=args.source_name,
+                           sourcetype=args.source_type,
+                           sourceprobe=args.source_probe,
+                           instrument=args.instrument_name,
+                           pipeline=args.pipeline)
+            scheduler.add('%s %s' % (sample, tomo), convert_xrm_tomo,
+                          options, memory, **callbacks)
+    scheduler.run()
+    if bright_field_scheduler.results:
+        print("\n")
+        print(bright_field_scheduler.report())
+    print("\n")
+    print(scheduler.report())
 
     print("\n")    
     print(datetime.datetime.today())
     print("\n")
+    if bright_field_scheduler.failed() or scheduler.failed():
+        sys.exit(1)
 
 
 if __name__ == "__main__":
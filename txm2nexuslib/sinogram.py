@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import h5py
+
+from storage import DatasetStorage
+
+
+SINOGRAM_MODES = ('also', 'only')
+# Maximum memory used to transpose the images into sinograms (bytes)
+DEFAULT_SINOGRAM_MEMORY = 512 * 1024 * 1024
+# Maximum size of a chunk of a sinogram dataset (bytes)
+MAX_SINOGRAM_CHUNK = 64 * 1024 * 1024
+
+
+def sinogram_chunks(shape, dtype):
+    """
+    Chunks of a (rows, nFrames, cols) sinogram dataset: a whole sinogram
+    per chunk, split along the frames if it is bigger than
+    MAX_SINOGRAM_CHUNK
+    """
+    rows, nframes, cols = shape
+    row_bytes = max(cols * np.dtype(dtype).itemsize, 1)
+    frames = max(1, min(nframes, MAX_SINOGRAM_CHUNK // row_bytes))
+    return (1, frames, cols)
+
+
+class SinogramWriter(object):
+    """
+    Write the frames of a (nFrames, rows, cols) image stack, appended in
+    order, as the (rows, nFrames, cols) sinogram dataset name of group.
+
+    The transposition uses at most memory bytes. When the whole stack does
+    not fit, the frames are written in blocks to a temporary HDF5 file
+    (next to the output file) with chunks of (frames of a block, rows of a
+    sinogram block, cols). Once all the frames have been appended, the
+    sinograms are built one block of rows at a time, which reads each
+    temporary chunk once.
+
+    The dataset has the filters of storage and sinogram_chunks. With the
+    auto compression, they are chosen with the images frame(i).
+    """
+
+    def __init__(self, group, name, shape, dtype, storage=None, frame=None,
+                 memory=DEFAULT_SINOGRAM_MEMORY):
+        storage = storage or DatasetStorage()
+        if storage.compression == 'auto' and frame is None:
+            raise ValueError("The auto compression needs sample frames")
+        self.nframes, self.rows, self.cols = shape
+        self.dtype = np.dtype(dtype)
+        self.storage = storage
+        self.position = 0
+        self.written = False
+
+        sinogram_shape = (self.rows, self.nframes, self.cols)
+        options = storage.tune(shape, dtype, frame).options(sinogram_shape,
+                                                            dtype)
+        options['chunks'] = sinogram_chunks(sinogram_shape, dtype)
+        self.dataset = group.create_dataset(name, shape=sinogram_shape,
+                                            dtype=dtype, **options)
+
+        itemsize = self.dtype.itemsize
+        frame_bytes = max(self.rows * self.cols * itemsize, 1)
+        self.block_frames = int(max(1, min(self.nframes,
+                                           memory // frame_bytes)))
+        sinogram_bytes = max(self.nframes * self.cols * itemsize, 1)
+        self.block_rows = int(max(1, min(self.rows,
+                                         memory // sinogram_bytes)))
+        self.buffer = np.empty((self.block_frames, self.rows, self.cols),
+                               dtype=self.dtype)
+        self.count = 0
+        self.tmp_name = None
+        self.tmp_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+        else:
+            self.close()
+
+    def in_memory(self):
+        """True if the whole stack is transposed in memory"""
+        return self.block_frames == self.nframes
+
+    def append(self, frame):
+        """Add the next frame"""
+        if self.position == self.nframes:
+            raise ValueError("All the %i frames of %s have been written"
+                             % (self.nframes, self.dataset.name))
+        self.buffer[self.count] = frame
+        self.count += 1
+        self.position += 1
+        if self.count == self.block_frames and not self.in_memory():
+            self._write_block()
+
+    def _temporary(self):
+        if self.tmp_file is None:
+            directory = os.path.dirname(
+                os.path.abspath(self.dataset.file.filename))
+            handle, self.tmp_name = tempfile.mkstemp(
+                suffix='.hdf5', prefix='.sinogram-', dir=directory)
+            os.close(handle)
+            self.tmp_file = h5py.File(self.tmp_name, 'w')
+            self.tmp_file.create_dataset(
+                'frames', shape=(self.nframes, self.rows, self.cols),
+                dtype=self.dtype,
+                chunks=(self.block_frames, self.block_rows, self.cols))
+        return self.tmp_file['frames']
+
+    def _write_block(self):
+        if self.count == 0:
+            return
+        frames = self._temporary()
+        first = self.position - self.count
+        frames.write_direct(self.buffer, np.s_[0:self.count],
+                            np.s_[first:self.position])
+        self.count = 0
+
+    def _write_sinograms(self):
+        if self.in_memory():
+            frames = self.buffer
+        else:
+            self._write_block()
+            frames = self.tmp_file['frames']
+        writer = self.storage.frame_writer(self.dataset)
+        with writer:
+            for first in range(0, self.rows, self.block_rows):
+                rows = frames[:, first:first + self.block_rows, :]
+                for sinogram in np.swapaxes(rows, 0, 1):
+                    writer.append(sinogram)
+        self.written = True
+
+    def flush(self):
+        """
+        Write the frames appended, and the sinograms once all the frames
+        have been appended
+        """
+        if self.position == self.nframes and not self.written:
+            try:
+                self._write_sinograms()
+            finally:
+                self.close()
+        elif not self.in_memory():
+            self._write_block()
+
+    def close(self):
+        """Remove the temporary file and free the memory"""
+        self.buffer = None
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+            self.tmp_file = None
+        if self.tmp_name is not None:
+            os.remove(self.tmp_name)
+            self.tmp_name = None
+
+
+def write_sinograms(source, group, name, storage=None,
+                   memory=DEFAULT_SINOGRAM_MEMORY):
+    """
+    Write the (nFrames, rows, cols) dataset source as the sinogram dataset
+    name of group (see SinogramWriter). Returns the sinogram dataset.
+    """
+    writer = SinogramWriter(group, name, source.shape, source.dtype,
+                            storage, lambda i: source[i], memory)
+    with writer:
+        for first in range(0, source.shape[0], writer.block_frames):
+            for frame in source[first:first + writer.block_frames]:
+                writer.append(frame)
+    return writer.dataset
@@ -23,12 +23,20 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import numpy as np
 import h5py
 
+from storage import DatasetStorage
+from external import upright_frame
+
 
 class SpecNormalize:
 
-    def __init__(self, inputfile):
+    def __init__(self, inputfile, write_batch=None, storage=None):
         #Note: FF is equivalent to brightfield 
 
+        # Number of images written at once (None: computed from memory)
+        self.write_batch = write_batch
+        # Chunking and compression of the normalized images
+        self.storage = storage or DatasetStorage()
+
         # Input File: HDF5 Raw Data
         filename_nexus = inputfile
         self.input_nexusfile = h5py.File(filename_nexus, 'r')
@@ -182,15 +190,24 @@ class SpecNormalize:
                   "(for sampleImages and FF) is present in the hdf5 file.\n")
 
 
-            self.norm_grp.create_dataset(
+            def normalize_image(numimg):
+                individual_spect_image = upright_frame(sample_image_data,
+                                                       numimg)
+                individual_FF_image = FF_image_data[numimg]
+
+                # Compute normalized images:
+                numerator = np.array(individual_spect_image * (
+                self.exptimes_FF[numimg] * self.currents_FF[numimg]))
+                denominator = np.array(individual_FF_image * (
+                             self.exptimes[numimg] * self.currents[numimg]))
+                return np.array(numerator / (denominator), dtype = np.float32)
+
+            self.storage.create_dataset(
+                self.norm_grp,
                 "spectroscopy_normalized",
-                shape=(self.nFrames,
-                       self.numrows,
-                       self.numcols),
-                chunks=(1,
-                        self.numrows,
-                        self.numcols),
-                dtype='float32')
+                (self.nFrames, self.numrows, self.numcols),
+                'float32',
+                normalize_image)
 
             self.norm_grp['spectroscopy_normalized'].attrs[
                 'Number of Frames'] = self.nFrames
@@ -199,23 +216,16 @@ class SpecNormalize:
             self.norm_grp['spectroscopy_normalized'].attrs[
                 'Pixel Columns'] = self.numcols
 
-            for numimg in range(self.nFrames):
+            writer = self.storage.frame_writer(
+                self.norm_grp['spectroscopy_normalized'],
+                batch=self.write_batch)
+            with writer:
+                for numimg in range(self.nFrames):
+                    normalizedspectrum_singleimage = normalize_image(numimg)
+                    writer.append(normalizedspectrum_singleimage)
 
-                individual_spect_image = sample_image_data[numimg]
-                individual_FF_image = FF_image_data[numimg]
-                
-                # Compute normalized images:
-                numerator = np.array(individual_spect_image * (
-                self.exptimes_FF[numimg] * self.currents_FF[numimg]))
-                denominator = np.array(individual_FF_image * (
-                                 self.exptimes[numimg] * self.currents[numimg]))
-                normalizedspectrum_singleimage = np.array(numerator / (
-                                               denominator), dtype = np.float32)
-                self.norm_grp['spectroscopy_normalized'][numimg] = \
-                    normalizedspectrum_singleimage
-
-                if numimg % 10 == 0:
-                    print('Image %d has been normalized' % numimg)
+                    if numimg % 10 == 0:
+                        print('Image %d has been normalized' % numimg)
 
             print('\nSpectroscopy has been normalized taking into account ' +
                    'the ExposureTimes and the MachineCurrents\n')
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import uuid
+
+import numpy as np
+import h5py
+
+from framewriter import frame_writer
+
+
+COMPRESSIONS = ('none', 'gzip', 'lzf', 'auto')
+DEFAULT_GZIP_LEVEL = 4
+# Write bandwidth of the storage (bytes/s) assumed by the auto compression
+DEFAULT_STORAGE_BANDWIDTH = 200 * 1024 * 1024
+# Maximum size of the frames used to choose the auto compression (bytes)
+AUTO_SAMPLE_MEMORY = 16 * 1024 * 1024
+
+
+def parse_chunks(chunks):
+    """
+    Chunk shape given in the command line: a number of frames per chunk
+    ('4'), or the full chunk shape ('4,256,256')
+    """
+    if chunks is None:
+        return None
+    try:
+        shape = tuple(int(size) for size in chunks.split(','))
+    except ValueError:
+        raise ValueError("Wrong chunk shape: %s" % chunks)
+    if not shape or min(shape) < 1:
+        raise ValueError("Wrong chunk shape: %s" % chunks)
+    if len(shape) == 1:
+        return shape[0]
+    return shape
+
+
+class DatasetStorage(object):
+    """
+    Chunking and filters of the image stacks written to the HDF5 files.
+
+    compression: None, 'gzip', 'lzf' or 'auto'. With 'auto', each dataset
+    is compressed with the candidate (see candidates) that takes the
+    shortest time to compress and write a few of its frames, assuming a
+    storage that writes bandwidth bytes per second.
+    level: gzip compression level (0-9).
+    shuffle: apply the byte shuffle filter before the compression.
+    scaleoffset: scale-offset filter; number of bits kept for integers (0
+    finds the minimum needed, lossless) and of decimal digits for floats
+    (lossy).
+    chunks: chunk shape; a number of frames (first axis) per chunk, or the
+    full chunk shape. By default, one frame per chunk.
+    workers: threads compressing the gzip chunks, which are then written
+    with write_direct_chunk (see framewriter.ChunkCompressingWriter). With
+    0, HDF5 compresses the chunks in the thread writing them.
+    """
+
+    def __init__(self, compression=None, level=None, shuffle=False,
+                 scaleoffset=None, chunks=None,
+                 bandwidth=DEFAULT_STORAGE_BANDWIDTH, workers=0):
+        if compression == 'none':
+            compression = None
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("Wrong compression: %s" % compression)
+        if level is not None and compression != 'gzip':
+            raise ValueError("A compression level needs gzip compression")
+        self.compression = compression
+        self.level = level
+        self.shuffle = shuffle
+        self.scaleoffset = scaleoffset
+        self.chunks = chunks
+        self.bandwidth = bandwidth
+        self.workers = workers
+
+    def __repr__(self):
+        filters = []
+        if self.compression is not None:
+            filters.append(self.compression)
+        if self.level is not None:
+            filters.append('level %i' % self.level)
+        if self.shuffle:
+            filters.append('shuffle')
+        if self.scaleoffset is not None:
+            filters.append('scaleoffset %i' % self.scaleoffset)
+        return 'DatasetStorage(%s)' % (', '.join(filters) or 'uncompressed')
+
+    def chunk_shape(self, shape):
+        """Chunk shape of a dataset of the given shape (or maxshape)"""
+        if self.chunks is None:
+            chunks = (1,) + tuple(shape[1:])
+        elif isinstance(self.chunks, int):
+            chunks = (self.chunks,) + tuple(shape[1:])
+        else:
+            chunks = tuple(self.chunks)
+            if len(chunks) != len(shape):
+                raise ValueError("Chunk shape %s does not match the "
+                                 "dataset shape %s" % (chunks, shape))
+        # shape can be the maxshape of a resizable dataset
+        return tuple(max(1, min(chunk, size or chunk))
+                     for chunk, size in zip(chunks, shape))
+
+    def options(self, shape, dtype):
+        """Keyword arguments of h5py create_dataset"""
+        if self.compression == 'auto':
+            raise ValueError("The auto compression must be tuned first")
+        options = {'chunks': self.chunk_shape(shape)}
+        if self.compression is not None:
+            options['compression'] = self.compression
+            if self.level is not None:
+                options['compression_opts'] = self.level
+        if self.shuffle:
+            options['shuffle'] = True
+        if self.scaleoffset is not None:
+            options['scaleoffset'] = self.scaleoffset
+        return options
+
+    def candidates(self, dtype):
+        """
+        Storages tried by the auto compression for the given dtype. They all
+        use the shuffle (with a compression) and scale-offset filters, the
+        chunks and the workers of this storage.
+        """
+        settings = [(None, None, False)]
+        if not self.shuffle:
+            settings.append(('lzf', None, False))
+        settings += [('lzf', None, True),
+                     ('gzip', 1, True),
+                     ('gzip', DEFAULT_GZIP_LEVEL, True)]
+        candidates = [DatasetStorage(compression, level, shuffle,
+                                     self.scaleoffset, self.chunks,
+                                     self.bandwidth, self.workers)
+                      for compression, level, shuffle in settings]
+        if self.scaleoffset is None and np.dtype(dtype).kind in 'ui':
+            # lossless only for integers
+            candidates.append(DatasetStorage(scaleoffset=0,
+                                             chunks=self.chunks,
+                                             bandwidth=self.bandwidth,
+                                             workers=self.workers))
+        return candidates
+
+    def tune(self, shape, dtype, frame):
+        """
+        Storage used for a dataset of the given shape and dtype. With the
+        auto compression, the candidates are tried with the frames frame(i)
+        spread over the dataset.
+        """
+        if self.compression != 'auto':
+            return self
+        if not shape[0]:
+            return self.candidates(dtype)[0]
+        frame_bytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+        count = max(1, min(shape[0], AUTO_SAMPLE_MEMORY // max(frame_bytes,
+                                                                1)))
+        indexes = np.linspace(0, shape[0] - 1, count).astype(int)
+        frames = np.empty((count,) + tuple(shape[1:]), dtype=dtype)
+        for i, index in enumerate(indexes):
+            frames[i] = frame(int(index))
+
+        # in-memory file, never written to disk
+        name = 'storage-%s.hdf5' % uuid.uuid4().hex
+        hdf5 = h5py.File(name, 'w', driver='core', backing_store=False)
+        best = None
+        try:
+            for candidate in self.candidates(dtype):
+                start = time.time()
+                dataset = hdf5.create_dataset(
+                    str(len(hdf5)), shape=frames.shape, dtype=dtype,
+                    **candidate.options(frames.shape, dtype))
+                dataset.write_direct(frames)
+                hdf5.flush()
+                elapsed = time.time() - start
+                size = dataset.id.get_storage_size()
+                cost = elapsed + float(size) / self.bandwidth
+                if best is None or cost < best[0]:
+                    best = (cost, candidate, size)
+        finally:
+            hdf5.close()
+        print('Compression of %s chosen from %i frames: %s (%.2f:1)'
+              % (dtype, count, best[1],
+                 float(frames.nbytes) / max(best[2], 1)))
+        return best[1]
+
+    def frame_writer(self, dataset, start=0, batch=None):
+        """Writer of the frames of a dataset created with this storage"""
+        return frame_writer(dataset, start, batch, self.workers)
+
+    def create_dataset(self, group, name, shape, dtype, frame=None):
+        """
+        Create the dataset name in group. frame(i) returns the frame i of
+        the dataset; it is needed with the auto compression.
+        """
+        if self.compression == 'auto' and frame is None:
+            raise ValueError("The auto compression needs sample frames")
+        storage = self.tune(shape, dtype, frame)
+        return group.create_dataset(name, shape=shape, dtype=dtype,
+                                    **storage.options(shape, dtype))
+
+
+def add_storage_arguments(parser):
+    """Add the options of the storage of the datasets to parser"""
+    parser.add_argument('--compression', type=str, default='none',
+                        choices=COMPRESSIONS,
+                        help="Compression of the images in the HDF5 file. "
+                             "auto tries each compression with some images "
+                             "and chooses the fastest to compress and write")
+    parser.add_argument('--compression-level', type=int, default=None,
+                        help="gzip compression level (0-9, %i by default)"
+                             % DEFAULT_GZIP_LEVEL)
+    parser.add_argument('--shuffle', action='store_true',
+                        help="Apply the shuffle filter before compressing")
+    parser.add_argument('--scaleoffset', type=int, default=None,
+                        help="Apply the scale-offset filter: bits kept for "
+                             "integers (0: lossless) or decimal digits for "
+                             "floats (lossy)")
+    parser.add_argument('--compression-workers', type=int, default=0,
+                        help="Threads compressing the gzip chunks of the "
+                             "images. With 0, HDF5 compresses them while "
+                             "writing them")
+    parser.add_argument('--chunks', type=str, default=None,
+                        help="Images per chunk, or chunk shape (e.g. "
+                             "'1,256,256'). By default, one image per chunk")
+
+
+def storage_from_args(args, parser=None):
+    """
+    DatasetStorage of the options added by add_storage_arguments. Wrong
+    options are reported with parser.error if parser is given, otherwise
+    they raise ValueError.
+    """
+    level = args.compression_level
+    if args.compression == 'gzip' and level is None:
+        level = DEFAULT_GZIP_LEVEL
+    try:
+        return DatasetStorage(args.compression, level, args.shuffle,
+                              args.scaleoffset, parse_chunks(args.chunks),
+                              workers=args.compression_workers)
+    except ValueError as error:
+        if parser is None:
+            raise
+        parser.error(str(error))
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+"""
+Micro-benchmark of the decoding of one image: struct.unpack + np.reshape +
+np.flipud (the decoding done before imagedecode) against
+imagedecode.decode_image.
+
+python benchmark_imagedecode.py [rows cols [repeat]]
+"""
+
+import sys
+import struct
+import timeit
+
+import numpy as np
+
+from txm2nexuslib.imagedecode import decode_image
+
+
+def struct_decode_image(data, numrows, numcols, datatype):
+    if datatype == 'uint16':
+        struct_fmt = "<{0:10}H".format(numrows * numcols)
+    else:
+        struct_fmt = "<{0:10}f".format(numrows * numcols)
+    imgdata = struct.unpack(struct_fmt, data)
+    return np.flipud(np.reshape(imgdata, (numrows, numcols), order='A'))
+
+
+def benchmark(numrows=1024, numcols=1024, repeat=5):
+    rng = np.random.RandomState(0)
+    images = {
+        'uint16': rng.randint(0, 65535,
+                              size=(numrows, numcols)).astype('<u2'),
+        'float': rng.rand(numrows, numcols).astype('<f4'),
+    }
+    print("Decoding of a %i x %i image (best of %i), ms per frame"
+          % (numrows, numcols, repeat))
+    print("(decode_image returns a view, copy is the time to make it a "
+          "contiguous array)")
+    for datatype in sorted(images):
+        data = images[datatype].tostring()
+        tests = [
+            (struct_decode_image, 1),
+            (decode_image, 1000),
+            (lambda *args: np.ascontiguousarray(decode_image(*args)), 20),
+        ]
+        results = []
+        for decode, number in tests:
+            timer = timeit.Timer(
+                lambda: decode(data, numrows, numcols, datatype))
+            results.append(min(timer.repeat(repeat, number)) / number * 1000)
+        print("  %-6s  struct: %8.3f  decode_image: %8.5f  copy: %8.3f"
+              % ((datatype,) + tuple(results)))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
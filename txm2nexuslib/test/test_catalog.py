@@ -0,0 +1,124 @@
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+from txm2nexuslib import catalog
+from txm2nexuslib.catalog import (Catalog, ScanReport, file_role,
+                                  file_sample_and_tomo, is_bright_field,
+                                  query_directory)
+from test_olefileio import write_ole
+
+
+def write_xrm(file_name, angle, energy=520.0):
+    streams = {
+        'ImageInfo/NoOfImages': struct.pack('<I', 1),
+        'ImageInfo/ImageHeight': struct.pack('<I', 3),
+        'ImageInfo/ImageWidth': struct.pack('<I', 4),
+        'ImageInfo/DataType': struct.pack('<I', 5),
+        'ImageInfo/ExpTimes': struct.pack('<f', 1.5),
+        'ImageInfo/Angles': struct.pack('<f', angle),
+        'ImageInfo/Energy': struct.pack('<f', energy),
+        'ImageInfo/Date': '06/26/16 10:00:00' + '\0' * 23,
+        'ImageData1/Image1': '\0' * 24,
+    }
+    write_ole(file_name, streams)
+
+
+class TestCatalog(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data_1')
+        os.makedirs(os.path.join(self.data_dir, 'tomo'))
+        self.names = ['20160626_S1_520.0_0.0_-10113.1.xrm',
+                      '20160626_S1_520.0_10.0_-10113.1.xrm',
+                      '20160626_S1_520.0_FF_0.xrm']
+        for angle, name in enumerate(self.names):
+            write_xrm(self.path(name), angle * 10)
+        write_xrm(self.path('tomo', 'tomo.txrm'), 30, energy=700.0)
+        with open(self.path('notes.txt'), 'w') as notes:
+            notes.write('not catalogued')
+        self.database = os.path.join(self.tmp_dir, 'catalog.db')
+        self.catalog = Catalog(self.database)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, *names):
+        return os.path.join(self.data_dir, *names)
+
+    def test_names(self):
+        self.assertEqual(file_role(self.names[2]), 'ff')
+        self.assertEqual(file_role('tomo_FF.txrm'), 'ff')
+        self.assertEqual(file_role(self.names[0]), 'sample')
+        self.assertTrue(is_bright_field(self.path(self.names[2])))
+        self.assertTrue(is_bright_field('20160626_S1_520.0_FF.xrm'))
+        self.assertFalse(is_bright_field('20160626_S1_520.0_FFT_0.xrm'))
+        self.assertFalse(is_bright_field(self.names[0]))
+        self.assertEqual(file_sample_and_tomo(self.path(self.names[0])),
+                         ('20160626_S1_520.0', '-10113.1.xrm'))
+        self.assertEqual(file_sample_and_tomo(self.path(self.names[2])),
+                         ('20160626_S1_520.0', None))
+        self.assertEqual(file_sample_and_tomo(self.path('tomo', 'a.txrm')),
+                         ('tomo', None))
+
+    def test_scan(self):
+        self.assertEqual(self.catalog.scan(self.data_dir),
+                         ScanReport(new=4, changed=0, removed=0,
+                                    unchanged=0))
+        rows = self.catalog.query("role = 'sample' AND angle >= ?", (5,))
+        self.assertEqual([row['name'] for row in rows],
+                         [self.names[1], 'tomo.txrm'])
+        row = rows[0]
+        self.assertEqual((row['energy'], row['exposure'], row['date']),
+                         (520.0, 1.5, '2016-06-26T10:00:00'))
+        self.assertEqual((row['images'], row['height'], row['width'],
+                          row['data_type']), (1, 3, 4, 'uint16'))
+        self.assertEqual(self.catalog.files('energy > 600'),
+                         [self.path('tomo', 'tomo.txrm')])
+
+    def test_incremental(self):
+        self.catalog.scan(self.data_dir)
+        read = []
+        read_file_metadata = catalog.read_file_metadata
+
+        def record(file_name):
+            read.append(os.path.basename(file_name))
+            return read_file_metadata(file_name)
+        catalog.read_file_metadata = record
+        try:
+            # a changed, a new, a removed and a corrupted file
+            write_xrm(self.path(self.names[0]), 5)
+            os.utime(self.path(self.names[0]), (0, 0))
+            write_xrm(self.path('20160626_S1_520.0_20.0_-10113.1.xrm'), 20)
+            os.remove(self.path(self.names[1]))
+            shutil.rmtree(self.path('tomo'))
+            with open(self.path(self.names[2]), 'w') as corrupted:
+                corrupted.write('corrupted')
+            report = Catalog(self.database).scan(self.data_dir)
+        finally:
+            catalog.read_file_metadata = read_file_metadata
+        self.assertEqual(report, ScanReport(new=1, changed=2, removed=2,
+                                            unchanged=0))
+        self.assertEqual(sorted(read), sorted([
+            self.names[0], self.names[2],
+            '20160626_S1_520.0_20.0_-10113.1.xrm']))
+        self.assertEqual([row['angle'] for row in self.catalog.query(
+            "role = 'sample'", order_by='angle')], [5, 20])
+        error = self.catalog.query('error IS NOT NULL')
+        self.assertEqual([row['name'] for row in error], [self.names[2]])
+
+    def test_query_directory(self):
+        # the _ of data_1 is not a wildcard
+        os.makedirs(os.path.join(self.tmp_dir, 'dataX1'))
+        write_xrm(os.path.join(self.tmp_dir, 'dataX1', 'other.xrm'), 0)
+        self.catalog.scan(self.tmp_dir)
+        rows = query_directory(self.catalog, self.data_dir, "role = 'ff'")
+        self.assertEqual([row['name'] for row in rows], [self.names[2]])
+        rows = query_directory(self.catalog, self.data_dir,
+                               "name LIKE '%.txrm' OR name = 'other.xrm'",
+                               recursive=True)
+        self.assertEqual([row['name'] for row in rows], ['tomo.txrm'])
@@ -0,0 +1,155 @@
+import os
+import shutil
+import sys
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib import external
+from txm2nexuslib.external import (create_external_dataset,
+                                   external_segments, upright_frame)
+from txm2nexuslib.scripts import normalize, txrm2nexus
+from test_follow import COLUMNS, ROWS, txrm_streams
+from test_olefileio import write_ole
+
+
+class TestExternalDataset(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hdf5 = h5py.File(os.path.join(self.tmp_dir, 'stack.hdf5'), 'w')
+        rng = np.random.RandomState(0)
+        self.frames = rng.randint(0, 100, size=(8, 6, 5)).astype('<u2')
+        self.nbytes = self.frames[0].nbytes
+        # raw file: a header, frames 0-3 one after the other, a gap and
+        # frames 4-7
+        self.raw = os.path.join(self.tmp_dir, 'frames.raw')
+        with open(self.raw, 'wb') as raw:
+            raw.write('h' * 10)
+            raw.write(self.frames[:4].tostring())
+            raw.write('g' * 3)
+            raw.write(self.frames[4:].tostring())
+        self.locations = [(self.raw, 10 + i * self.nbytes) for i in range(4)]
+        self.locations += [(self.raw, 13 + i * self.nbytes)
+                           for i in range(4, 8)]
+        self.max_segments = external.MAX_EXTERNAL_SEGMENTS
+
+    def tearDown(self):
+        external.MAX_EXTERNAL_SEGMENTS = self.max_segments
+        self.hdf5.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_segments(self):
+        self.assertEqual(external_segments(self.locations, self.nbytes),
+                         [(self.raw, 10, 4 * self.nbytes),
+                          (self.raw, 10 + 4 * self.nbytes + 3,
+                           4 * self.nbytes)])
+
+    def test_external(self):
+        dataset = create_external_dataset(self.hdf5, 'data', self.locations,
+                                          self.frames.shape, '<u2')
+        self.assertFalse(dataset.is_virtual)
+        self.assertEqual(len(dataset.external), 2)
+        self.assertEqual(dataset.attrs['Flipped Rows'], 1)
+        self.assertTrue(np.array_equal(dataset[()], self.frames))
+        self.assertEqual(list(self.hdf5), ['data'])
+
+    def test_copied(self):
+        # frames 2 and 5 are fragmented
+        read = []
+
+        def read_frame(i):
+            read.append(i)
+            return self.frames[i]
+        locations = list(self.locations)
+        locations[2] = locations[5] = None
+        self.assertRaises(ValueError, create_external_dataset, self.hdf5,
+                          'data', locations, self.frames.shape, '<u2')
+        dataset = create_external_dataset(self.hdf5, 'data', locations,
+                                          self.frames.shape, '<u2',
+                                          read_frame)
+        self.assertTrue(dataset.is_virtual)
+        self.assertEqual(read, [2, 5])
+        self.assertEqual(self.hdf5['data_copied'].shape, (2, 6, 5))
+        self.assertTrue(np.array_equal(dataset[()], self.frames))
+
+    def test_split(self):
+        external.MAX_EXTERNAL_SEGMENTS = 1
+        dataset = create_external_dataset(self.hdf5, 'data', self.locations,
+                                          self.frames.shape, '<u2')
+        self.assertTrue(dataset.is_virtual)
+        self.assertEqual(self.hdf5['data_external_0'].shape, (4, 6, 5))
+        self.assertEqual(self.hdf5['data_external_1'].shape, (4, 6, 5))
+        self.assertTrue(np.array_equal(dataset[()], self.frames))
+
+    def test_upright_frame(self):
+        dataset = create_external_dataset(self.hdf5, 'data', self.locations,
+                                          self.frames.shape, '<u2')
+        self.assertTrue(np.array_equal(upright_frame(dataset, 3),
+                                       self.frames[3, ::-1]))
+        copy = self.hdf5.create_dataset('copy', data=self.frames)
+        self.assertTrue(np.array_equal(upright_frame(copy, 3),
+                                       self.frames[3]))
+
+
+class TestExternalNormalization(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.images = [rng.randint(1, 65535, size=(ROWS, COLUMNS))
+                       .astype('<u2') for i in range(4)]
+        self.bright = [rng.randint(1, 65535, size=(ROWS, COLUMNS))
+                       .astype('<u2') for i in range(2)]
+        self.argv = sys.argv
+
+    def tearDown(self):
+        sys.argv = self.argv
+        shutil.rmtree(self.tmp_dir)
+
+    def normalize(self, name, *options):
+        """
+        Convert the sample and bright field txrm files with txrm2nexus and
+        the given options, in the directory name, and normalize the result
+        with normalize. Returns the NeXus file and the normalized file.
+        """
+        directory = os.path.join(self.tmp_dir, name)
+        os.mkdir(directory)
+        sample = os.path.join(directory, 'tomo.txrm')
+        bright = os.path.join(directory, 'tomo_FF.txrm')
+        write_ole(sample, txrm_streams(self.images, len(self.images)))
+        write_ole(bright, txrm_streams(self.bright, len(self.bright)))
+        sys.argv = ['txrm2nexus', sample, bright, '-o', 'sb'] + list(options)
+        txrm2nexus.main()
+        nexus = os.path.join(directory, 'tomo.hdf5')
+        sys.argv = ['normalize', nexus, '--sinogram', 'also']
+        normalize.main()
+        return nexus, os.path.join(directory, 'tomo_norm.hdf5')
+
+    def test_normalize(self):
+        nexus, normalized = self.normalize('copied')
+        external_nexus, external_normalized = self.normalize('external',
+                                                             '--external')
+        hdf5 = h5py.File(external_nexus, 'r')
+        data = hdf5['NXtomo/instrument/sample/data']
+        self.assertEqual(data.attrs['Flipped Rows'], 1)
+        self.assertTrue(len(data.external))
+        hdf5.close()
+
+        average_bright = np.mean([image[::-1] for image in self.bright],
+                                 axis=0)
+        expected = [image[::-1] / average_bright for image in self.images]
+        for file_name in (normalized, external_normalized):
+            hdf5 = h5py.File(file_name, 'r')
+            try:
+                group = hdf5['TomoNormalized']
+                for i, image in enumerate(expected):
+                    self.assertTrue(np.allclose(
+                        group['TomoNormalized'][i], image, rtol=1e-5))
+                    self.assertTrue(np.allclose(
+                        group['TomoNormalizedSinogram'][:, i], image,
+                        rtol=1e-5))
+            finally:
+                hdf5.close()
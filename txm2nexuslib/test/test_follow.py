@@ -0,0 +1,146 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.txrmnex import txrmNXtomo
+from test_olefileio import write_ole
+
+NUMBER_OF_IMAGES = 20
+ROWS = 64
+COLUMNS = 48
+# the encoders of the distances, the energy and the machine current are at
+# the positions expected by txrmNXtomo
+AXIS_NAMES = ['Axis %i' % i for i in range(31)]
+AXIS_NAMES[2] = 'Sample Z'
+AXIS_NAMES[23] = 'Detector Z'
+AXIS_NAMES[27] = 'Energy'
+AXIS_NAMES[28] = 'machine_current'
+AXIS_NAMES[30] = 'Energyenc'
+
+
+def txrm_streams(images, nimages):
+    """
+    Streams of a txrm file announcing nimages images, of which only images
+    (a list of arrays) have been written
+    """
+    streams = {
+        'ImageInfo/NoOfImages': struct.pack('<I', nimages),
+        'ImageInfo/ImageHeight': struct.pack('<I', ROWS),
+        'ImageInfo/ImageWidth': struct.pack('<I', COLUMNS),
+        'ImageInfo/DataType': struct.pack('<I', 5),
+        'ImageInfo/PixelSize': struct.pack('<f', 0.01),
+        'ImageInfo/ExpTimes': struct.pack('<%if' % nimages,
+                                          *[1.5] * nimages),
+        'ImageInfo/Angles': struct.pack('<%if' % nimages,
+                                        *range(nimages)),
+        'ImageInfo/Date': ''.join('06/26/16 10:00:%02i' % i + '\0' * 23
+                                  for i in range(nimages)),
+        'PositionInfo/AxisNames': ''.join(name + '\0\0'
+                                          for name in AXIS_NAMES) + '\0',
+        'PositionInfo/MotorPositions': np.zeros(
+            (nimages, len(AXIS_NAMES)), dtype='<f4').tostring(),
+    }
+    for numimage, image in enumerate(images, 1):
+        streams['ImageData1/Image%i' % numimage] = image.tostring()
+    return streams
+
+
+class TestFollowImageStack(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp_dir, 'tomo.txrm')
+        rng = np.random.RandomState(0)
+        self.images = [rng.randint(0, 65535, size=(ROWS, COLUMNS))
+                       .astype('<u2') for i in range(NUMBER_OF_IMAGES)]
+        self.nexus = None
+        self.sizes = []
+        self.errors = []
+
+    def tearDown(self):
+        if self.nexus is not None:
+            self.nexus.txrmhdf.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_txrm(self, nimages):
+        # the microscope file is replaced at once, so that it is never read
+        # half written
+        tmp_name = self.file_name + '.tmp'
+        write_ole(tmp_name, txrm_streams(self.images[:nimages],
+                                         NUMBER_OF_IMAGES))
+        os.rename(tmp_name, self.file_name)
+
+    def converted_images(self):
+        group = self.nexus.nxdetectorsample
+        if 'data' not in group:
+            return 0
+        return group['data'].shape[0]
+
+    def acquire(self, steps):
+        """
+        Write the txrm file with the numbers of images of steps, one after
+        the other, waiting each time until they have been converted
+        """
+        try:
+            for nimages in steps:
+                self.write_txrm(nimages)
+                deadline = time.time() + 10
+                while (self.converted_images() < nimages and
+                       time.time() < deadline):
+                    time.sleep(0.01)
+                self.sizes.append(self.converted_images())
+        except Exception as error:
+            self.errors.append(error)
+
+    def follow(self, steps, idle_timeout):
+        self.write_txrm(0)
+        self.nexus = txrmNXtomo([self.file_name], 's')
+        self.nexus.NXtomo_structure()
+        microscope = threading.Thread(target=self.acquire, args=(steps,))
+        microscope.start()
+        try:
+            self.nexus.follow_image_stack(0.02, idle_timeout)
+        finally:
+            microscope.join()
+        self.assertEqual(self.errors, [])
+        # the dataset grows with the images written
+        self.assertEqual(self.sizes, list(steps))
+
+    def check_converted(self):
+        self.nexus.convert_metadata()
+        self.nexus.convert_image_stack()
+        self.nexus = None
+        hdf5 = h5py.File(os.path.join(self.tmp_dir, 'tomo.hdf5'), 'r')
+        try:
+            data = hdf5['NXtomo/instrument/sample/data']
+            self.assertEqual(data.shape, (NUMBER_OF_IMAGES, ROWS, COLUMNS))
+            self.assertEqual(data.attrs['Number of Frames'],
+                             NUMBER_OF_IMAGES)
+            # the images are stored upside down
+            for image, converted in zip(self.images, data):
+                self.assertTrue(np.array_equal(converted, image[::-1]))
+            self.assertEqual(
+                list(hdf5['NXtomo/instrument/sample/sequence_number']),
+                range(1, NUMBER_OF_IMAGES + 1))
+        finally:
+            hdf5.close()
+
+    def test_follow(self):
+        self.follow((5, 12, NUMBER_OF_IMAGES), 10)
+        self.assertEqual(self.nexus.followed_frames, NUMBER_OF_IMAGES)
+        self.check_converted()
+
+    def test_idle_timeout(self):
+        # the acquisition stops for longer than the idle timeout
+        self.follow((5, 12), 0.5)
+        self.assertEqual(self.nexus.followed_frames, 12)
+        # the last images are converted with the metadata
+        self.write_txrm(NUMBER_OF_IMAGES)
+        self.check_converted()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.framewriter import (FrameBatchWriter, frames_per_batch,
+                                      ChunkCompressingWriter, frame_writer)
+
+
+class TestFrameBatchWriter(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hdf5 = h5py.File(os.path.join(self.tmp_dir, 'frames.hdf5'), 'w')
+        rng = np.random.RandomState(0)
+        self.frames = rng.randint(0, 65535, size=(23, 8, 6))
+
+    def tearDown(self):
+        self.hdf5.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frames_per_batch(self):
+        self.assertEqual(frames_per_batch((100, 100), 'uint16', 100000), 5)
+        self.assertEqual(frames_per_batch((100, 100), 'float32', 1000), 1)
+
+    def test_write(self):
+        for batch in (1, 4, 23, 50, None):
+            dataset = self.hdf5.create_dataset('data%s' % batch,
+                                               shape=(25, 8, 6),
+                                               dtype='uint16')
+            with FrameBatchWriter(dataset, 2, batch) as writer:
+                for frame in self.frames:
+                    writer.append(frame[np.newaxis])
+            self.assertTrue(np.array_equal(dataset[2:], self.frames))
+            self.assertTrue(np.array_equal(dataset[:2], np.zeros((2, 8, 6))))
+
+    def test_resizable(self):
+        dataset = self.hdf5.create_dataset('data', shape=(0, 8, 6),
+                                           maxshape=(None, 8, 6),
+                                           dtype='uint16')
+        writer = FrameBatchWriter(dataset, batch=5)
+        for frame in self.frames[:7]:
+            writer.append(frame)
+        self.assertEqual(dataset.shape[0], 5)
+        writer.flush()
+        self.assertEqual(dataset.shape[0], 7)
+        for frame in self.frames[7:]:
+            writer.append(frame)
+        writer.flush()
+        self.assertTrue(np.array_equal(dataset[()], self.frames))
+
+
+class TestChunkCompressingWriter(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hdf5 = h5py.File(os.path.join(self.tmp_dir, 'chunks.hdf5'), 'w')
+        rng = np.random.RandomState(0)
+        self.frames = rng.randint(0, 300, size=(23, 8, 6)).astype('uint16')
+
+    def tearDown(self):
+        self.hdf5.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def create(self, name, chunks, shuffle, shape=(23, 8, 6), **options):
+        return self.hdf5.create_dataset(name, shape=shape, dtype='uint16',
+                                        chunks=chunks, compression='gzip',
+                                        compression_opts=4, shuffle=shuffle,
+                                        **options)
+
+    def test_same_chunks_as_hdf5(self):
+        for shuffle in (False, True):
+            name = 'shuffle' if shuffle else 'deflate'
+            reference = self.create(name + '_ref', (4, 8, 6), shuffle)
+            reference[...] = self.frames
+            dataset = self.create(name, (4, 8, 6), shuffle)
+            with ChunkCompressingWriter(dataset, workers=3) as writer:
+                for frame in self.frames:
+                    writer.append(frame)
+            self.assertEqual(writer.chunks_written, 6)
+            self.assertTrue(np.array_equal(dataset[()], self.frames))
+            for first in range(0, 20, 4):
+                self.assertEqual(
+                    dataset.id.read_direct_chunk((first, 0, 0)),
+                    reference.id.read_direct_chunk((first, 0, 0)))
+
+    def test_partial_chunks(self):
+        # chunks splitting the frames, start and flush out of the chunks
+        dataset = self.create('data', (3, 5, 4), True, shape=(25, 8, 6))
+        writer = ChunkCompressingWriter(dataset, start=2, workers=2)
+        for frame in self.frames[:10]:
+            writer.append(frame)
+        writer.flush()
+        for frame in self.frames[10:]:
+            writer.append(frame)
+        writer.flush()
+        self.assertTrue(np.array_equal(dataset[2:], self.frames))
+        self.assertTrue(np.array_equal(dataset[:2], np.zeros((2, 8, 6))))
+
+    def test_resizable(self):
+        dataset = self.create('data', (4, 8, 6), False, shape=(0, 8, 6),
+                              maxshape=(None, 8, 6))
+        writer = ChunkCompressingWriter(dataset, workers=2)
+        for frame in self.frames[:9]:
+            writer.append(frame)
+        writer.flush()
+        self.assertEqual(dataset.shape[0], 9)
+        for frame in self.frames[9:]:
+            writer.append(frame)
+        writer.flush()
+        self.assertTrue(np.array_equal(dataset[()], self.frames))
+
+    def test_frame_writer(self):
+        compressed = self.create('gzip', (1, 8, 6), False)
+        lzf = self.hdf5.create_dataset('lzf', shape=(23, 8, 6), chunks=True,
+                                       dtype='uint16', compression='lzf')
+        self.assertTrue(isinstance(frame_writer(compressed, workers=2),
+                                   ChunkCompressingWriter))
+        self.assertTrue(isinstance(frame_writer(compressed),
+                                   FrameBatchWriter))
+        self.assertTrue(isinstance(frame_writer(lzf, workers=2),
+                                   FrameBatchWriter))
+        self.assertRaises(ValueError, ChunkCompressingWriter, lzf)
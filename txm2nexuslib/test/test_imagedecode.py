@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import numpy as np
+
+from txm2nexuslib.imagedecode import decode_image
+
+
+class TestDecodeImage(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.uint16 = rng.randint(0, 65535, size=(30, 20)).astype('<u2')
+        self.float = rng.rand(30, 20).astype('<f4')
+
+    def test_uint16(self):
+        data = self.uint16.tostring()
+        image = decode_image(data, 30, 20, 'uint16')
+        self.assertEqual(image.dtype, np.uint16)
+        self.assertEqual(image.shape, (30, 20))
+        self.assertTrue(np.array_equal(image, self.uint16[::-1]))
+
+    def test_float(self):
+        data = self.float.tostring()
+        image = decode_image(data, 30, 20, 'float')
+        self.assertEqual(image.dtype, np.float32)
+        self.assertTrue(np.array_equal(image, self.float[::-1]))
+
+    def test_no_flip(self):
+        image = decode_image(self.uint16.tostring(), 30, 20, 'uint16',
+                             flip=False)
+        self.assertTrue(np.array_equal(image, self.uint16))
+
+    def test_no_copy(self):
+        image = decode_image(self.uint16.tostring(), 30, 20, 'uint16')
+        self.assertFalse(image.flags.owndata)
+        self.assertFalse(image.flags.writeable)
+
+    def test_errors(self):
+        data = self.uint16.tostring()
+        self.assertRaises(ValueError, decode_image, data[:-2], 30, 20,
+                          'uint16')
+        self.assertRaises(ValueError, decode_image, data, 30, 20, 'int8')
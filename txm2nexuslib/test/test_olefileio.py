@@ -0,0 +1,648 @@
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+from unittest import TestCase
+
+import numpy as np
+
+from txm2nexuslib.OleFileIO_PL import (OleFileIO, STGTY_STORAGE, STGTY_STREAM,
+                                        LAYOUT_CACHE_VERSION,
+                                        set_layout_cache_dir, set_use_mmap,
+                                        _OleLazyStream, _OleMappedStream,
+                                        _sector_chain)
+
+SECTOR_SIZE = 512
+MINI_SECTOR_SIZE = 64
+MINI_STREAM_CUTOFF = 4096
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+
+NUMBER_OF_IMAGES = 40
+NUMBER_OF_THREADS = 16
+READS_PER_THREAD = 200
+
+
+def _sectors(data, size):
+    """Split data in chunks of size bytes, the last one padded with zeros"""
+    count = (len(data) + size - 1) / size
+    data += '\0' * (count * size - len(data))
+    return [data[i * size:(i + 1) * size] for i in range(count)]
+
+
+def write_ole(filename, streams, interleave=False):
+    """
+    Write a minimal OLE2 file (512 bytes sectors, no DIFAT) containing the
+    given streams, a dictionary of data indexed by path. Storages are created
+    from the paths. If interleave is True, the sectors of the big streams are
+    interleaved, so that each stream is fragmented in the file.
+    """
+    root = {'name': u'Root Entry', 'kids': [], 'data': None}
+    for path in sorted(streams):
+        names = path.split('/')
+        node = root
+        for name in names[:-1]:
+            for kid in node['kids']:
+                if kid['name'] == name and kid['data'] is None:
+                    node = kid
+                    break
+            else:
+                kid = {'name': name, 'kids': [], 'data': None}
+                node['kids'].append(kid)
+                node = kid
+        node['kids'].append({'name': names[-1], 'kids': [],
+                             'data': streams[path]})
+    entries = []
+
+    def number(node):
+        node['sid'] = len(entries)
+        entries.append(node)
+        for kid in node['kids']:
+            number(kid)
+    number(root)
+
+    sectors = []
+    fat = []
+
+    def allocate(chains, interleaved=False):
+        """Append the chains of sectors, return their first sectors"""
+        if interleaved:
+            order = [(i, j) for j in range(max(map(len, chains)))
+                     for i in range(len(chains)) if j < len(chains[i])]
+        else:
+            order = [(i, j) for i in range(len(chains))
+                     for j in range(len(chains[i]))]
+        positions = [[] for chain in chains]
+        for i, j in order:
+            positions[i].append(len(sectors))
+            sectors.append(chains[i][j])
+            fat.append(None)
+        for sects in positions:
+            for sect, next_sect in zip(sects, sects[1:] + [ENDOFCHAIN]):
+                fat[sect] = next_sect
+        return [sects[0] if sects else ENDOFCHAIN for sects in positions]
+
+    # small streams are stored in the MiniStream:
+    ministream = ''
+    minifat = []
+    for node in entries:
+        node['start'] = ENDOFCHAIN
+        node['size'] = 0
+        data = node['data']
+        if data is not None and 0 < len(data) < MINI_STREAM_CUTOFF:
+            chain = _sectors(data, MINI_SECTOR_SIZE)
+            node['start'] = len(minifat)
+            node['size'] = len(data)
+            minifat.extend(range(len(minifat) + 1,
+                                 len(minifat) + len(chain)) + [ENDOFCHAIN])
+            ministream += ''.join(chain)
+    big = [node for node in entries if node['data'] is not None and
+           len(node['data']) >= MINI_STREAM_CUTOFF]
+    starts = allocate([_sectors(node['data'], SECTOR_SIZE) for node in big],
+                      interleave)
+    for node, start in zip(big, starts):
+        node['start'] = start
+        node['size'] = len(node['data'])
+    minifat_start = ENDOFCHAIN
+    minifat_sectors = 0
+    if ministream:
+        root['start'] = allocate([_sectors(ministream, SECTOR_SIZE)])[0]
+        root['size'] = len(ministream)
+        minifat_data = ''.join([struct.pack('<I', sect) for sect in minifat])
+        minifat_data += '\xff' * (-len(minifat_data) % SECTOR_SIZE)
+        minifat_chain = _sectors(minifat_data, SECTOR_SIZE)
+        minifat_start = allocate([minifat_chain])[0]
+        minifat_sectors = len(minifat_chain)
+
+    # directory: the kids of a storage are chained as right siblings
+    right = {}
+    for node in entries:
+        for kid, next_kid in zip(node['kids'], node['kids'][1:]):
+            right[kid['sid']] = next_kid['sid']
+    directory = ''
+    for node in entries:
+        name = node['name'].encode('utf-16-le') + '\0\0'
+        if node is root:
+            entry_type = 5
+        elif node['data'] is None:
+            entry_type = 1
+        else:
+            entry_type = 2
+        child = node['kids'][0]['sid'] if node['kids'] else NOSTREAM
+        directory += struct.pack('<64sHBBIII16sI8s8sIII', name, len(name),
+                                 entry_type, 1, NOSTREAM,
+                                 right.get(node['sid'], NOSTREAM), child,
+                                 '\0' * 16, 0, '\0' * 8, '\0' * 8,
+                                 node['start'], node['size'], 0)
+    directory += '\0' * (-len(directory) % SECTOR_SIZE)
+    directory_start = allocate([_sectors(directory, SECTOR_SIZE)])[0]
+
+    # FAT sectors, at the end of the file:
+    fat_count = 0
+    while fat_count * 128 < len(sectors) + fat_count:
+        fat_count += 1
+    assert fat_count <= 109, 'DIFAT is not supported'
+    fat_sects = range(len(sectors), len(sectors) + fat_count)
+    fat.extend([FATSECT] * fat_count)
+    fat.extend([FREESECT] * (fat_count * 128 - len(fat)))
+    sectors.extend(_sectors(''.join([struct.pack('<I', sect)
+                                     for sect in fat]), SECTOR_SIZE))
+
+    header = struct.pack('<8s16sHHHHHHLLLLLLLLLL',
+                         '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', '\0' * 16,
+                         0x3E, 3, 0xFFFE, 9, 6, 0, 0, 0, fat_count,
+                         directory_start, 0, MINI_STREAM_CUTOFF,
+                         minifat_start, minifat_sectors, ENDOFCHAIN, 0)
+    header += ''.join([struct.pack('<I', sect) for sect in
+                       fat_sects + [FREESECT] * (109 - fat_count)])
+    f = open(filename, 'wb')
+    try:
+        f.write(header)
+        f.write(''.join(sectors))
+    finally:
+        f.close()
+
+
+class TestConcurrentReads(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp_dir, 'tomo.txrm')
+        rng = np.random.RandomState(0)
+        self.streams = {}
+        for numimage in range(1, NUMBER_OF_IMAGES + 1):
+            image = rng.randint(0, 65535, size=(64, 48)).astype('<u2')
+            path = 'ImageData%i/Image%i' % (np.ceil(numimage / 100.0),
+                                             numimage)
+            self.streams[path] = image.tostring()
+        for name in ('Angles', 'ExpTimes', 'XPosition', 'YPosition'):
+            self.streams['ImageInfo/' + name] = \
+                rng.rand(NUMBER_OF_IMAGES).astype('<f4').tostring()
+        write_ole(self.file_name, self.streams, interleave=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_from_threads(self, ole, read):
+        """
+        Call read(ole, path, offset, length) for random ranges of random
+        streams from many threads at the same time, and check that every call
+        returned the right data.
+        """
+        errors = []
+        paths = sorted(self.streams)
+        start = threading.Event()
+
+        def worker(seed):
+            rng = random.Random(seed)
+            start.wait()
+            try:
+                for i in range(READS_PER_THREAD):
+                    path = rng.choice(paths)
+                    data = self.streams[path]
+                    offset = rng.randint(0, len(data) - 1)
+                    length = rng.randint(1, len(data))
+                    expected = data[offset:offset + length]
+                    if read(ole, path, offset, length) != expected:
+                        errors.append('%s [%d:%d]' % (path, offset,
+                                                      offset + length))
+            except Exception, exc:
+                errors.append(repr(exc))
+
+        threads = [threading.Thread(target=worker, args=(seed,))
+                   for seed in range(NUMBER_OF_THREADS)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [], "%d wrong reads, first ones: %s" %
+                         (len(errors), errors[:5]))
+
+    def test_read_streams(self):
+        ole = OleFileIO(self.file_name)
+        for path, data in self.streams.items():
+            self.assertEqual(ole.openstream(path).read(), data)
+        ole.close()
+
+    def test_readstreams(self):
+        ole = OleFileIO(self.file_name)
+        paths = sorted(self.streams) + ['ImageInfo/Date']
+        streams = ole.readstreams(paths)
+        self.assertEqual(streams, self.streams)
+        ole.close()
+
+    def test_concurrent_read(self):
+        def read(ole, path, offset, length):
+            stream = ole.openstream(path)
+            stream.seek(offset)
+            return stream.read(length)
+        ole = OleFileIO(self.file_name)
+        self.read_from_threads(ole, read)
+        ole.close()
+
+    def test_concurrent_readinto(self):
+        def read(ole, path, offset, length):
+            stream = ole.openstream(path)
+            stream.seek(offset)
+            if not hasattr(stream, 'readinto'):
+                return stream.read(length)
+            buf = bytearray(length)
+            return str(buf[:stream.readinto(buf)])
+        ole = OleFileIO(self.file_name)
+        self.read_from_threads(ole, read)
+        ole.close()
+
+    def test_concurrent_read_mmap(self):
+        def read(ole, path, offset, length):
+            stream = ole.openstream(path)
+            stream.seek(offset)
+            return stream.read(length)
+        ole = OleFileIO(self.file_name, use_mmap=True)
+        self.read_from_threads(ole, read)
+        ole.close()
+
+
+class TestSectorChains(TestCase):
+
+    def test_chain_past_end_of_fat(self):
+        # the last sector of the FAT is chained to a sector past its end
+        fat = np.array([ENDOFCHAIN, 2, 3], dtype='<u4')
+        self.assertRaises(IOError, _sector_chain, 1, 3 * SECTOR_SIZE,
+                          SECTOR_SIZE, fat)
+
+    def test_chain_runs(self):
+        fat = np.array([1, 2, 5, ENDOFCHAIN, FREESECT, 6, 3],
+                       dtype='<u4')
+        self.assertEqual(_sector_chain(0, 6 * SECTOR_SIZE, SECTOR_SIZE, fat),
+                         [(0, 3), (5, 2), (3, 1)])
+
+
+def example_streams():
+    """
+    Streams of a small txrm-like file: two images stored in the FAT, and
+    metadata streams of one or several sectors of the MiniFAT
+    """
+    rng = np.random.RandomState(1)
+    streams = {}
+    for numimage in (1, 2):
+        image = rng.randint(0, 65535, size=(64, 48)).astype('<u2')
+        streams['ImageData1/Image%i' % numimage] = image.tostring()
+    streams['ImageInfo/Angles'] = rng.rand(40).astype('<f4').tostring()
+    streams['ImageInfo/ImagesTaken'] = struct.pack('<I', 2)
+    streams['SampleInfo/SampleID'] = rng.bytes(1000)
+    return streams
+
+
+class OleFileTestCase(TestCase):
+    """Test case writing the example streams in an OLE file"""
+
+    interleave = False
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp_dir, 'tomo.txrm')
+        self.streams = example_streams()
+        write_ole(self.file_name, self.streams, self.interleave)
+        self.ole = OleFileIO(self.file_name)
+
+    def tearDown(self):
+        self.ole.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def read_extents(self, extents):
+        f = open(self.file_name, 'rb')
+        try:
+            data = []
+            for offset, length in extents:
+                f.seek(offset)
+                data.append(f.read(length))
+            return ''.join(data)
+        finally:
+            f.close()
+
+
+class TestContiguousExtents(OleFileTestCase):
+
+    def test_one_extent_per_stream(self):
+        for path in ('ImageData1/Image1', 'ImageData1/Image2'):
+            data = self.streams[path]
+            extents = self.ole.get_extents(path)
+            self.assertEqual(len(extents), 1)
+            self.assertEqual(extents[0][1], len(data))
+            self.assertEqual(self.ole.openstream(path).extents, extents)
+            self.assertEqual(self.read_extents(extents), data)
+
+    def test_ministream_extents(self):
+        for path in ('ImageInfo/Angles', 'ImageInfo/ImagesTaken',
+                     'SampleInfo/SampleID'):
+            extents = self.ole.get_extents(path)
+            self.assertEqual(self.read_extents(extents), self.streams[path])
+
+
+class TestFragmentedExtents(OleFileTestCase):
+
+    interleave = True
+
+    def test_one_extent_per_run(self):
+        for path in ('ImageData1/Image1', 'ImageData1/Image2'):
+            data = self.streams[path]
+            extents = self.ole.get_extents(path)
+            # sectors of the two images alternate in the file
+            self.assertEqual(len(extents), len(data) / SECTOR_SIZE)
+            self.assertEqual(sum(length for offset, length in extents),
+                             len(data))
+            self.assertEqual(self.ole.openstream(path).extents, extents)
+            self.assertEqual(self.read_extents(extents), data)
+            self.assertEqual(self.ole.openstream(path).read(), data)
+
+
+class TestPathLookup(OleFileTestCase):
+
+    def test_case_insensitive(self):
+        data = self.streams['ImageData1/Image2']
+        for path in ('ImageData1/Image2', 'imagedata1/image2',
+                     'IMAGEDATA1/IMAGE2', ['imageData1', 'IMAGE2']):
+            self.assertTrue(self.ole.exists(path))
+            self.assertEqual(self.ole.get_type(path), STGTY_STREAM)
+            self.assertEqual(self.ole.get_size(path), len(data))
+            self.assertEqual(self.ole.openstream(path).read(), data)
+
+    def test_storages(self):
+        self.assertEqual(self.ole.get_type('imageinfo'), STGTY_STORAGE)
+        self.assertEqual(self.ole.get_type(['SAMPLEINFO']), STGTY_STORAGE)
+        self.assertRaises(IOError, self.ole.openstream, 'ImageInfo')
+        self.assertRaises(TypeError, self.ole.get_size, 'ImageInfo')
+
+    def test_missing_paths(self):
+        for path in ('ImageData2/Image1', 'ImageData1/Image3',
+                     'ImageData1/Image1/Image1', 'Image1'):
+            self.assertFalse(self.ole.exists(path))
+            self.assertFalse(self.ole.get_type(path))
+            self.assertRaises(IOError, self.ole.openstream, path)
+            self.assertRaises(IOError, self.ole.get_size, path)
+
+    def test_listdir(self):
+        self.assertEqual(sorted('/'.join(path)
+                                for path in self.ole.listdir()),
+                         sorted(self.streams))
+
+
+class TestLazyStreams(OleFileTestCase):
+
+    # reads cross the extents of the fragmented streams
+    interleave = True
+
+    def setUp(self):
+        OleFileTestCase.setUp(self)
+        self.data = self.streams['ImageData1/Image1']
+        self.stream = self.ole.openstream('ImageData1/Image1')
+
+    def test_lazy_stream(self):
+        self.assertTrue(isinstance(self.stream, _OleLazyStream))
+        self.assertFalse(isinstance(self.ole.openstream('ImageInfo/Angles'),
+                                    _OleLazyStream))
+
+    def test_seek_and_read(self):
+        self.stream.seek(100)
+        self.assertEqual(self.stream.tell(), 100)
+        self.assertEqual(self.stream.read(1000), self.data[100:1100])
+        self.assertEqual(self.stream.tell(), 1100)
+        self.stream.seek(-10, 1)
+        self.assertEqual(self.stream.read(20), self.data[1090:1110])
+        self.stream.seek(-5, 2)
+        self.assertEqual(self.stream.read(), self.data[-5:])
+        self.assertEqual(self.stream.read(), '')
+        self.stream.seek(len(self.data) + 10)
+        self.assertEqual(self.stream.read(10), '')
+        self.stream.seek(0)
+        self.assertEqual(self.stream.read(0), '')
+        self.assertEqual(self.stream.read(), self.data)
+
+    def test_readinto_array(self):
+        image = np.empty((64, 48), dtype='<u2')
+        self.assertEqual(self.stream.readinto(image.view(np.uint8).ravel()),
+                         len(self.data))
+        self.assertEqual(image.tostring(), self.data)
+        self.assertEqual(self.stream.tell(), len(self.data))
+
+    def test_readinto_end_of_stream(self):
+        buf = bytearray(300)
+        self.stream.seek(len(self.data) - 1000)
+        self.assertEqual(self.stream.readinto(buf), 300)
+        self.assertEqual(str(buf), self.data[-1000:-700])
+        self.stream.seek(-100, 2)
+        self.assertEqual(self.stream.readinto(buf), 100)
+        self.assertEqual(str(buf[:100]), self.data[-100:])
+        self.assertEqual(self.stream.readinto(buf), 0)
+
+    def test_readinto_needs_bytes(self):
+        image = np.empty((64, 48), dtype='<u2')
+        self.assertRaises(TypeError, self.stream.readinto, image)
+
+
+class TestMiniStreams(OleFileTestCase):
+
+    small_paths = ('ImageInfo/Angles', 'ImageInfo/ImagesTaken',
+                   'SampleInfo/SampleID')
+
+    def test_fat_arrays(self):
+        self.assertEqual(self.ole.fat.dtype, np.uint32)
+        self.ole.loadminifat()
+        self.assertEqual(self.ole.minifat.dtype, np.uint32)
+        # the MiniStream is stored in consecutive sectors of the FAT
+        self.ole._load_ministream()
+        self.assertEqual(len(self.ole.ministream.extents), 1)
+
+    def test_openstream(self):
+        for path in self.small_paths:
+            data = self.streams[path]
+            stream = self.ole.openstream(path)
+            self.assertEqual(stream.size, len(data))
+            self.assertEqual(stream.read(), data)
+            stream.seek(3)
+            self.assertEqual(stream.read(5), data[3:8])
+
+    def test_readstreams(self):
+        self.assertEqual(self.ole.readstreams(self.small_paths),
+                         dict((path, self.streams[path])
+                              for path in self.small_paths))
+
+    def test_minifat_runs(self):
+        minifat = np.array([1, 2, ENDOFCHAIN, 4, 5, 6, ENDOFCHAIN, 0],
+                           dtype='<u4')
+        self.assertEqual(_sector_chain(3, 4 * MINI_SECTOR_SIZE,
+                                       MINI_SECTOR_SIZE, minifat),
+                         [(3, 4)])
+        self.assertEqual(_sector_chain(7, 4 * MINI_SECTOR_SIZE,
+                                       MINI_SECTOR_SIZE, minifat),
+                         [(7, 1), (0, 3)])
+
+    def test_corrupt_minifat(self):
+        # loop in the chain
+        minifat = np.array([1, 2, 0, ENDOFCHAIN], dtype='<u4')
+        self.assertRaises(IOError, _sector_chain, 0, 3 * MINI_SECTOR_SIZE + 1,
+                          MINI_SECTOR_SIZE, minifat)
+        # chain ending before the declared size
+        self.assertRaises(IOError, _sector_chain, 1, 3 * MINI_SECTOR_SIZE,
+                          MINI_SECTOR_SIZE, np.array([1, 2, ENDOFCHAIN],
+                                                     dtype='<u4'))
+
+
+class TestMappedStreams(OleFileTestCase):
+
+    def tearDown(self):
+        set_use_mmap(False)
+        OleFileTestCase.tearDown(self)
+
+    def test_getbuffer(self):
+        ole = OleFileIO(self.file_name, use_mmap=True)
+        data = self.streams['ImageData1/Image1']
+        stream = ole.openstream('ImageData1/Image1')
+        self.assertTrue(isinstance(stream, _OleMappedStream))
+        self.assertEqual(len(stream.segments), 1)
+        image = np.frombuffer(stream.getbuffer(), dtype='<u2')
+        self.assertEqual(image.tostring(), data)
+        self.assertEqual(stream.read(), data)
+        ole.close()
+
+    def test_views_after_close(self):
+        ole = OleFileIO(self.file_name, use_mmap=True)
+        data = self.streams['ImageData1/Image1']
+        stream = ole.openstream('ImageData1/Image1')
+        image = np.frombuffer(stream.getbuffer(), dtype='<u2')
+        segment = stream.segments[0]
+        ole.close()
+        del stream
+        # the map is kept while the views over it are alive
+        self.assertEqual(image.tostring(), data)
+        self.assertEqual(str(segment), data)
+
+    def test_default_mode(self):
+        set_use_mmap(True)
+        ole = OleFileIO(self.file_name)
+        for path, data in self.streams.items():
+            stream = ole.openstream(path)
+            if len(data) >= MINI_STREAM_CUTOFF:
+                self.assertTrue(isinstance(stream, _OleMappedStream))
+            self.assertEqual(stream.read(), data)
+        self.assertEqual(ole.readstreams(self.streams.keys()), self.streams)
+        ole.close()
+        # the mode given to OleFileIO is used instead
+        ole = OleFileIO(self.file_name, use_mmap=False)
+        self.assertFalse(isinstance(ole.openstream('ImageData1/Image1'),
+                                    _OleMappedStream))
+        ole.close()
+
+
+class TestLayoutCache(OleFileTestCase):
+
+    def setUp(self):
+        OleFileTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        if os.path.isdir(self.cache_dir):
+            os.chmod(self.cache_dir, 0755)
+        OleFileTestCase.tearDown(self)
+
+    def open_cached(self, streams=None):
+        """
+        Open the file with the layout cache, check its streams, and return
+        whether its layout was loaded from the cache.
+        """
+        if streams is None:
+            streams = self.streams
+        ole = OleFileIO(self.file_name, cache_dir=self.cache_dir)
+        try:
+            for path, data in streams.items():
+                self.assertEqual(ole.openstream(path).read(), data)
+                self.assertEqual(ole.get_extents(path),
+                                 self.ole.get_extents(path))
+            self.assertEqual(ole.readstreams(streams.keys()), streams)
+            return ole._layout_cached
+        finally:
+            ole.close()
+
+    def cache_file(self):
+        names = os.listdir(self.cache_dir)
+        self.assertEqual(len(names), 1)
+        return os.path.join(self.cache_dir, names[0])
+
+    def test_cache_hit(self):
+        self.assertFalse(self.open_cached())
+        self.cache_file()
+        self.assertTrue(self.open_cached())
+        self.assertTrue(self.open_cached())
+
+    def test_size_changed(self):
+        self.assertFalse(self.open_cached())
+        streams = dict(self.streams)
+        streams['ImageData1/Image3'] = streams['ImageData1/Image1']
+        write_ole(self.file_name, streams)
+        self.ole.close()
+        self.ole = OleFileIO(self.file_name)
+        self.assertFalse(self.open_cached(streams))
+        self.assertTrue(self.open_cached(streams))
+
+    def test_mtime_changed(self):
+        self.assertFalse(self.open_cached())
+        mtime = os.path.getmtime(self.file_name) + 10
+        os.utime(self.file_name, (mtime, mtime))
+        self.assertFalse(self.open_cached())
+        self.assertTrue(self.open_cached())
+
+    def test_version_mismatch(self):
+        self.assertFalse(self.open_cached())
+        cache_file = self.cache_file()
+        layout = json.load(open(cache_file))
+        layout['version'] = LAYOUT_CACHE_VERSION + 1
+        json.dump(layout, open(cache_file, 'w'))
+        self.assertFalse(self.open_cached())
+        # the layout is saved again with the current version
+        self.assertTrue(self.open_cached())
+
+    def test_corrupt_cache_file(self):
+        self.assertFalse(self.open_cached())
+        cache_file = self.cache_file()
+        layout = json.load(open(cache_file))
+        open(cache_file, 'w').write('{"version": ')
+        self.assertFalse(self.open_cached())
+        # valid version and key, but the entries are malformed
+        layout['entries'] = [[0, 'Root Entry', 5]]
+        json.dump(layout, open(cache_file, 'w'))
+        self.assertFalse(self.open_cached())
+        self.assertTrue(self.open_cached())
+
+    def test_read_only_cache_dir(self):
+        os.mkdir(self.cache_dir)
+        os.chmod(self.cache_dir, 0555)
+        if os.access(self.cache_dir, os.W_OK):
+            self.skipTest('the cache directory is writable by this user')
+        self.assertFalse(self.open_cached())
+        self.assertFalse(self.open_cached())
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_unwritable_cache_dir(self):
+        # the cache directory cannot be created inside a file
+        self.cache_dir = os.path.join(self.file_name, 'cache')
+        self.assertFalse(self.open_cached())
+        self.assertFalse(self.open_cached())
+
+    def test_default_cache_dir(self):
+        def cached():
+            ole = OleFileIO(self.file_name)
+            ole.close()
+            return ole._layout_cached
+        set_layout_cache_dir(self.cache_dir)
+        try:
+            self.assertFalse(cached())
+            self.assertTrue(cached())
+        finally:
+            set_layout_cache_dir(None)
+        self.assertFalse(cached())
@@ -0,0 +1,99 @@
+import threading
+import time
+from unittest import TestCase
+
+import numpy as np
+
+from txm2nexuslib.pipeline import ConversionPipeline
+
+
+class ListWriter(object):
+
+    def __init__(self):
+        self.frames = []
+        self.flushed = 0
+
+    def append(self, frame):
+        self.frames.append(frame)
+
+    def flush(self):
+        self.flushed += 1
+
+
+class TestConversionPipeline(TestCase):
+
+    def convert(self, workers, depth=4):
+        pipeline = ConversionPipeline(workers, depth=depth)
+        writers = []
+        for name, nframes in (('s', 30), ('b', 7), ('d', 0)):
+            def read(key, name=name):
+                # later frames are read faster than the first ones
+                time.sleep(0.0002 * (30 - key))
+                return '%s%02i' % (name, key)
+
+            def decode(key, data):
+                return data.upper()
+            writers.append(ListWriter())
+            pipeline.add(name, range(nframes), read, decode, writers[-1])
+        pipeline.run()
+        self.assertEqual(pipeline.frames, 37)
+        self.assertEqual(writers[0].frames,
+                         ['S%02i' % i for i in range(30)])
+        self.assertEqual(writers[1].frames, ['B%02i' % i for i in range(7)])
+        self.assertEqual(writers[2].frames, [])
+        for writer in writers:
+            self.assertEqual(writer.flushed, 1)
+
+    def test_serial(self):
+        self.convert(0)
+
+    def test_threaded(self):
+        self.convert(1)
+        self.convert(3, depth=1)
+        self.convert(3, depth=8)
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def read(key):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            return np.zeros(10)
+
+        class Writer(ListWriter):
+            def append(self, frame):
+                time.sleep(0.001)
+                with lock:
+                    in_flight[0] -= 1
+
+        pipeline = ConversionPipeline(2, depth=3)
+        pipeline.add('a', range(20), read, None, Writer())
+        pipeline.add('b', range(20), read, None, Writer())
+        pipeline.run()
+        self.assertTrue(in_flight[1] <= 3)
+        self.assertEqual(pipeline.frames, 40)
+
+    def test_errors(self):
+        def read(key):
+            if key == 5:
+                raise IOError("frame %i" % key)
+            return str(key)
+
+        def decode(key, data):
+            if key == 5:
+                raise ValueError("frame %i" % key)
+            return data
+
+        for workers in (0, 2):
+            pipeline = ConversionPipeline(workers)
+            pipeline.add('read', range(10), read, None, ListWriter())
+            self.assertRaises(IOError, pipeline.run)
+            pipeline = ConversionPipeline(workers)
+            pipeline.add('decode', range(10), str, decode, ListWriter())
+            self.assertRaises(ValueError, pipeline.run)
+
+    def test_arguments(self):
+        self.assertRaises(ValueError, ConversionPipeline, -1)
+        self.assertRaises(ValueError, ConversionPipeline, 1, 0)
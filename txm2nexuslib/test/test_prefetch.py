@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import numpy as np
+
+from txm2nexuslib.OleFileIO_PL import OleFileIO
+from txm2nexuslib.prefetch import FramePrefetcher, ole_image_reader
+from test_olefileio import write_ole
+
+NUMBER_OF_FRAMES = 50
+FRAME_SIZE = 1000
+
+
+class FrameReader(object):
+    """Read fake frames, recording how many are read and not consumed"""
+
+    def __init__(self, delay=0.0, fail_at=None):
+        self.delay = delay
+        self.fail_at = fail_at
+        self.lock = threading.Lock()
+        self.read_frames = 0
+        self.consumed_frames = 0
+        self.max_in_flight = 0
+
+    def __call__(self, key):
+        time.sleep(self.delay)
+        if key == self.fail_at:
+            raise IOError('Cannot read frame %d' % key)
+        with self.lock:
+            self.read_frames += 1
+            self.max_in_flight = max(self.max_in_flight,
+                                     self.read_frames - self.consumed_frames)
+        return chr(key % 256) * FRAME_SIZE
+
+    def consume(self):
+        with self.lock:
+            self.consumed_frames += 1
+
+
+class TestFramePrefetcher(TestCase):
+
+    def consume(self, frames, reader, delay=0.0):
+        payloads = []
+        with frames:
+            for payload in frames:
+                payloads.append(payload)
+                reader.consume()
+                time.sleep(delay)
+        return payloads
+
+    def test_order(self):
+        for depth in (0, 1, 4):
+            reader = FrameReader()
+            frames = FramePrefetcher(reader, range(NUMBER_OF_FRAMES), depth)
+            payloads = self.consume(frames, reader)
+            self.assertEqual(payloads, [chr(key) * FRAME_SIZE
+                                        for key in range(NUMBER_OF_FRAMES)])
+            self.assertEqual(frames.frames, NUMBER_OF_FRAMES)
+
+    def test_depth(self):
+        reader = FrameReader()
+        frames = FramePrefetcher(reader, range(NUMBER_OF_FRAMES), 3)
+        self.consume(frames, reader, delay=0.002)
+        # the frame being consumed is not counted as consumed yet:
+        self.assertTrue(reader.max_in_flight <= 3 + 1)
+
+    def test_memory(self):
+        reader = FrameReader()
+        frames = FramePrefetcher(reader, range(NUMBER_OF_FRAMES), 10,
+                                 max_bytes=2 * FRAME_SIZE)
+        self.consume(frames, reader, delay=0.002)
+        self.assertTrue(reader.max_in_flight <= 2 + 1)
+
+    def test_waits(self):
+        reader = FrameReader(delay=0.005)
+        frames = FramePrefetcher(reader, range(10), 4)
+        self.consume(frames, reader)
+        self.assertTrue(frames.waits > 0)
+        self.assertTrue(frames.wait_time > 0)
+
+        reader = FrameReader()
+        frames = FramePrefetcher(reader, range(10), 0)
+        self.consume(frames, reader)
+        self.assertEqual(frames.waits, 10)
+
+    def test_error(self):
+        reader = FrameReader(fail_at=7)
+        frames = FramePrefetcher(reader, range(NUMBER_OF_FRAMES), 4)
+        payloads = []
+
+        def consume():
+            for payload in frames:
+                payloads.append(payload)
+        self.assertRaises(IOError, consume)
+        frames.close()
+        self.assertEqual(len(payloads), 7)
+
+    def test_close(self):
+        reader = FrameReader()
+        frames = FramePrefetcher(reader, range(NUMBER_OF_FRAMES), 2)
+        frames.next()
+        frames.close()
+        self.assertFalse(frames._thread.is_alive())
+        self.assertTrue(reader.read_frames < NUMBER_OF_FRAMES)
+
+
+class TestOleImageReader(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp_dir, 'tomo.txrm')
+        self.image = np.arange(64 * 48, dtype='<u2')
+        write_ole(self.file_name, {'ImageData1/Image1': self.image.tostring()})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read(self):
+        ole = OleFileIO(self.file_name, use_mmap=False)
+        data = ole_image_reader(ole)(1)
+        ole.close()
+        self.assertEqual(data, self.image.tostring())
+
+    def test_mapped(self):
+        ole = OleFileIO(self.file_name, use_mmap=True)
+        data = ole_image_reader(ole)(1)
+        ole.close()
+        # the mapped bytes are not copied
+        self.assertTrue(isinstance(data, buffer))
+        self.assertTrue(np.array_equal(np.frombuffer(data, dtype='<u2'),
+                                       self.image))
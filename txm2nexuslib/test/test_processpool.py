@@ -0,0 +1,63 @@
+import os
+import time
+from unittest import TestCase
+
+from txm2nexuslib.processpool import OrderedProcessPool
+
+
+def square(item):
+    # later items are computed faster than the first ones
+    time.sleep(0.001 * (10 - item))
+    return item * item
+
+
+def identity(item):
+    return item
+
+
+def process_id(item):
+    return os.getpid()
+
+
+def fail(item):
+    if item == 3:
+        raise IOError("item %i" % item)
+    return item
+
+
+class TestOrderedProcessPool(TestCase):
+
+    def test_order(self):
+        with OrderedProcessPool(3) as pool:
+            results = list(pool.imap(square, range(10)))
+        self.assertEqual(results, [item * item for item in range(10)])
+        self.assertEqual(pool.results, 10)
+
+    def test_processes(self):
+        with OrderedProcessPool(2) as pool:
+            pids = set(pool.imap(process_id, range(4)))
+        self.assertFalse(os.getpid() in pids)
+
+    def test_bounded(self):
+        taken = []
+
+        def items():
+            for item in range(20):
+                taken.append(item)
+                yield item
+        with OrderedProcessPool(2, max_pending=3) as pool:
+            for result in pool.imap(identity, items()):
+                # the items consumed and at most 3 more
+                self.assertTrue(len(taken) <= result + 4)
+
+    def test_error(self):
+        results = []
+        with OrderedProcessPool(2) as pool:
+            try:
+                for result in pool.imap(fail, range(10)):
+                    results.append(result)
+                self.fail("IOError not raised")
+            except IOError as error:
+                self.assertEqual(str(error), "item 3")
+        self.assertEqual(results, [0, 1, 2])
+        self.assertRaises(ValueError, OrderedProcessPool, 0)
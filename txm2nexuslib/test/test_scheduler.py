@@ -0,0 +1,131 @@
+import os
+import time
+from unittest import TestCase
+
+from txm2nexuslib.scheduler import ConversionScheduler, _Job
+
+
+def interval(seconds):
+    start = time.time()
+    time.sleep(seconds)
+    return start, time.time()
+
+
+def fail():
+    raise IOError("corrupted file")
+
+
+def prepared(values):
+    return values.get('prepared')
+
+
+def crash():
+    # the process ends without a result
+    os._exit(3)
+
+
+class LatePoll(object):
+    """
+    Connection whose first poll misses the result, as if the process had
+    sent it and exited just after
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+        return self.polls > 1 and self.connection.poll()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class TestConversionScheduler(TestCase):
+
+    def test_processes(self):
+        scheduler = ConversionScheduler(2)
+        for i in range(3):
+            scheduler.add(i, os.getpid)
+        results = scheduler.run()
+        self.assertEqual(sorted(result.name for result in results),
+                         [0, 1, 2])
+        for result in results:
+            self.assertEqual(result.error, None)
+            self.assertNotEqual(result.value, os.getpid())
+
+    def test_in_process(self):
+        scheduler = ConversionScheduler(0)
+        scheduler.add('pid', os.getpid)
+        scheduler.add('fail', fail)
+        results = scheduler.run()
+        self.assertEqual([result.name for result in results],
+                         ['pid', 'fail'])
+        self.assertEqual(results[0].value, os.getpid())
+        self.assertTrue('corrupted file' in results[1].error)
+
+    def test_failures(self):
+        scheduler = ConversionScheduler(2)
+        scheduler.add('fail', fail)
+        scheduler.add('exit', crash)
+        scheduler.add('ok', interval, {'seconds': 0})
+        scheduler.run()
+        errors = dict((result.name, result.error)
+                      for result in scheduler.failed())
+        self.assertEqual(sorted(errors), ['exit', 'fail'])
+        self.assertTrue('IOError: corrupted file' in errors['fail'])
+        self.assertEqual(errors['exit'], 'Process exited with code 3')
+        report = scheduler.report()
+        self.assertTrue('ok: OK' in report)
+        self.assertTrue('1 jobs converted, 2 failed' in report)
+
+    def test_add_failed(self):
+        scheduler = ConversionScheduler(0)
+        scheduler.add('ok', os.getpid)
+        scheduler.add_failed('skipped', 'no bright field')
+        scheduler.run()
+        self.assertEqual([result.name for result in scheduler.failed()],
+                         ['skipped'])
+        self.assertTrue('1 jobs converted, 1 failed' in scheduler.report())
+
+    def test_result_before_exit(self):
+        job = _Job('pid', os.getpid, {}, 0, None, None)
+        job.start()
+        job.process.join()
+        job.connection = LatePoll(job.connection)
+        result = job.poll()
+        self.assertEqual(result.error, None)
+        self.assertEqual(result.value, job.process.pid)
+
+    def test_memory(self):
+        # only one job fits in memory at once
+        scheduler = ConversionScheduler(3, max_memory=100)
+        for i in range(3):
+            scheduler.add(i, interval, {'seconds': 0.1}, memory=60)
+        intervals = sorted(result.value for result in scheduler.run())
+        for previous, following in zip(intervals, intervals[1:]):
+            self.assertTrue(previous[1] <= following[0])
+        self.assertRaises(ValueError, ConversionScheduler, -1)
+
+    def check_callbacks(self, scheduler):
+        values = {}
+        events = []
+
+        def started():
+            values['prepared'] = True
+            events.append('started')
+
+        def done(result):
+            events.append(('done', result.name, result.value))
+
+        scheduler.add('job', prepared, {'values': values}, started=started,
+                      done=done)
+        scheduler.add('other', interval, {'seconds': 0})
+        scheduler.run()
+        # the job sees what has been prepared when it was started
+        self.assertEqual(events, ['started', ('done', 'job', True)])
+
+    def test_callbacks(self):
+        self.check_callbacks(ConversionScheduler(0))
+        self.check_callbacks(ConversionScheduler(2))
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.framewriter import FrameBatchWriter, TeeWriter
+from txm2nexuslib.sinogram import (SinogramWriter, write_sinograms,
+                                   sinogram_chunks)
+from txm2nexuslib.storage import DatasetStorage
+
+
+class TestSinogramWriter(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hdf5 = h5py.File(os.path.join(self.tmp_dir, 'stack.hdf5'), 'w')
+        rng = np.random.RandomState(0)
+        self.frames = rng.randint(0, 100, size=(13, 9, 7)).astype('uint16')
+        self.sinograms = np.swapaxes(self.frames, 0, 1)
+
+    def tearDown(self):
+        self.hdf5.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, memory, storage=None):
+        writer = SinogramWriter(self.hdf5, 'sinogram', self.frames.shape,
+                                'uint16', storage, lambda i: self.frames[i],
+                                memory)
+        with writer:
+            for frame in self.frames:
+                writer.append(frame)
+        return writer
+
+    def test_in_memory(self):
+        writer = self.write(self.frames.nbytes)
+        self.assertTrue(writer.in_memory())
+        self.assertEqual(writer.dataset.shape, (9, 13, 7))
+        self.assertEqual(writer.dataset.chunks, (1, 13, 7))
+        self.assertTrue(np.array_equal(writer.dataset[()], self.sinograms))
+
+    def test_out_of_core(self):
+        # 3 frames or 2 sinograms at once
+        writer = self.write(3 * 9 * 7 * 2 + 1)
+        self.assertFalse(writer.in_memory())
+        self.assertEqual((writer.block_frames, writer.block_rows), (3, 2))
+        self.assertTrue(np.array_equal(writer.dataset[()], self.sinograms))
+        # the temporary file has been removed
+        self.assertEqual(os.listdir(self.tmp_dir), ['stack.hdf5'])
+
+    def test_storage(self):
+        storage = DatasetStorage('gzip', 4, shuffle=True, chunks=4)
+        writer = self.write(1, storage)
+        self.assertEqual(writer.dataset.compression, 'gzip')
+        self.assertEqual(writer.dataset.chunks, (1, 13, 7))
+        self.assertTrue(np.array_equal(writer.dataset[()], self.sinograms))
+
+    def test_errors(self):
+        writer = SinogramWriter(self.hdf5, 'sinogram', self.frames.shape,
+                                'uint16', memory=1)
+        try:
+            with writer:
+                writer.append(self.frames[0])
+                raise IOError("acquisition")
+        except IOError:
+            pass
+        self.assertEqual(os.listdir(self.tmp_dir), ['stack.hdf5'])
+        self.assertRaises(ValueError, SinogramWriter, self.hdf5, 'auto',
+                          self.frames.shape, 'uint16',
+                          DatasetStorage('auto'))
+
+    def test_tee(self):
+        data = self.hdf5.create_dataset('data', data=np.zeros_like(
+            self.frames))
+        sinograms = SinogramWriter(self.hdf5, 'sinogram', self.frames.shape,
+                                   'uint16', memory=100)
+        with TeeWriter(FrameBatchWriter(data, batch=4), sinograms) as writer:
+            for frame in self.frames:
+                writer.append(frame)
+        self.assertTrue(np.array_equal(data[()], self.frames))
+        self.assertTrue(np.array_equal(sinograms.dataset[()],
+                                       self.sinograms))
+
+    def test_write_sinograms(self):
+        source = self.hdf5.create_dataset('data', data=self.frames)
+        dataset = write_sinograms(source, self.hdf5, 'sinogram', memory=200)
+        self.assertTrue(np.array_equal(dataset[()], self.sinograms))
+
+    def test_chunks(self):
+        self.assertEqual(sinogram_chunks((9, 13, 7), 'uint16'), (1, 13, 7))
+        self.assertEqual(sinogram_chunks((2048, 10 ** 6, 2048), 'float32'),
+                         (1, 8192, 2048))
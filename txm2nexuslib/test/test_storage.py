@@ -0,0 +1,125 @@
+import argparse
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.storage import (DatasetStorage, DEFAULT_GZIP_LEVEL,
+                                  add_storage_arguments, parse_chunks,
+                                  storage_from_args)
+
+
+class TestDatasetStorage(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hdf5 = h5py.File(os.path.join(self.tmp_dir, 'stack.hdf5'), 'w')
+        rng = np.random.RandomState(0)
+        self.frames = rng.randint(0, 100, size=(12, 16, 10)).astype('uint16')
+
+    def tearDown(self):
+        self.hdf5.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_chunks(self):
+        self.assertEqual(parse_chunks(None), None)
+        self.assertEqual(parse_chunks('4'), 4)
+        self.assertEqual(parse_chunks('1,256,256'), (1, 256, 256))
+        self.assertRaises(ValueError, parse_chunks, '0')
+        self.assertRaises(ValueError, parse_chunks, 'a,b')
+
+    def test_chunk_shape(self):
+        self.assertEqual(DatasetStorage().chunk_shape((12, 16, 10)),
+                         (1, 16, 10))
+        self.assertEqual(DatasetStorage(chunks=4).chunk_shape((12, 16, 10)),
+                         (4, 16, 10))
+        self.assertEqual(DatasetStorage(chunks=20).chunk_shape((12, 16)),
+                         (12, 16))
+        self.assertEqual(DatasetStorage(chunks=4).chunk_shape((None, 16)),
+                         (4, 16))
+        self.assertEqual(
+            DatasetStorage(chunks=(2, 8, 8)).chunk_shape((12, 16, 10)),
+            (2, 8, 8))
+        self.assertRaises(ValueError,
+                          DatasetStorage(chunks=(2, 8)).chunk_shape,
+                          (12, 16, 10))
+
+    def test_options(self):
+        self.assertEqual(DatasetStorage().options((12, 16, 10), 'uint16'),
+                         {'chunks': (1, 16, 10)})
+        options = DatasetStorage('gzip', 6, True).options((12, 16, 10),
+                                                         'uint16')
+        self.assertEqual(options, {'chunks': (1, 16, 10),
+                                   'compression': 'gzip',
+                                   'compression_opts': 6,
+                                   'shuffle': True})
+        self.assertRaises(ValueError, DatasetStorage, 'zip')
+        self.assertRaises(ValueError, DatasetStorage, 'lzf', 4)
+        self.assertRaises(ValueError, DatasetStorage('auto').options,
+                          (12, 16, 10), 'uint16')
+
+    def test_create_dataset(self):
+        storage = DatasetStorage('lzf', shuffle=True, chunks=3)
+        dataset = storage.create_dataset(self.hdf5, 'data', (12, 16, 10),
+                                         'uint16')
+        dataset[...] = self.frames
+        self.assertEqual(dataset.compression, 'lzf')
+        self.assertTrue(dataset.shuffle)
+        self.assertEqual(dataset.chunks, (3, 16, 10))
+        self.assertTrue(np.array_equal(dataset[()], self.frames))
+
+    def test_auto(self):
+        frames = []
+
+        def frame(i):
+            frames.append(i)
+            return self.frames[i]
+        # with a very slow storage, the smallest dataset is the best one
+        storage = DatasetStorage('auto', bandwidth=1)
+        self.assertRaises(ValueError, storage.create_dataset, self.hdf5,
+                          'data', (12, 16, 10), 'uint16')
+        dataset = storage.create_dataset(self.hdf5, 'data', (12, 16, 10),
+                                         'uint16', frame)
+        self.assertEqual(frames, range(12))
+        self.assertTrue(dataset.compression is not None or
+                        dataset.scaleoffset is not None)
+        dataset[...] = self.frames
+        self.assertTrue(np.array_equal(dataset[()], self.frames))
+        # the lossy scale-offset filter is not tried with floats
+        for candidate in storage.candidates('float32'):
+            self.assertEqual(candidate.scaleoffset, None)
+
+    def test_auto_filters(self):
+        storage = DatasetStorage('auto', shuffle=True, scaleoffset=2,
+                                 workers=3)
+        candidates = storage.candidates('uint16')
+        self.assertEqual(len(candidates), 4)
+        for candidate in candidates:
+            self.assertEqual(candidate.scaleoffset, 2)
+            self.assertEqual(candidate.workers, 3)
+            self.assertEqual(candidate.shuffle,
+                             candidate.compression is not None)
+        # without filters, the lossless scale-offset filter is also tried
+        candidates = DatasetStorage('auto', workers=2).candidates('uint16')
+        self.assertEqual(len(candidates), 6)
+        self.assertEqual(candidates[-1].scaleoffset, 0)
+        self.assertEqual([candidate.workers for candidate in candidates],
+                         [2] * 6)
+
+    def test_storage_from_args(self):
+        parser = argparse.ArgumentParser()
+        add_storage_arguments(parser)
+        args = parser.parse_args(['--compression', 'gzip'])
+        self.assertEqual(storage_from_args(args).level, DEFAULT_GZIP_LEVEL)
+        args = parser.parse_args(['--compression', 'lzf',
+                                  '--compression-level', '6'])
+        self.assertRaises(ValueError, storage_from_args, args)
+        # reported as a wrong option (parser.error exits with status 2)
+        errors = []
+        parser.error = errors.append
+        storage_from_args(args, parser)
+        self.assertEqual(errors, ['A compression level needs gzip '
+                                  'compression'])
@@ -0,0 +1,58 @@
+import threading
+import time
+from unittest import TestCase
+
+from txm2nexuslib.threadpool import OrderedThreadPool
+
+
+class TestOrderedThreadPool(TestCase):
+
+    def test_order(self):
+        def square(item):
+            # later items are computed faster than the first ones
+            time.sleep(0.001 * (20 - item))
+            return item * item
+        with OrderedThreadPool(4) as pool:
+            results = list(pool.imap(square, range(20)))
+        self.assertEqual(results, [item * item for item in range(20)])
+        self.assertEqual(pool.results, 20)
+
+    def test_bounded(self):
+        started = []
+        lock = threading.Lock()
+
+        def record(item):
+            with lock:
+                started.append(item)
+            return item
+        with OrderedThreadPool(2, max_pending=3) as pool:
+            for result in pool.imap(record, range(10)):
+                time.sleep(0.01)
+                with lock:
+                    self.assertTrue(len(started) <= result + 4)
+
+    def test_error(self):
+        computed = []
+
+        def fail(item):
+            if item == 3:
+                raise IOError("item %i" % item)
+            time.sleep(0.005)
+            computed.append(item)
+            return item
+        pool = OrderedThreadPool(2, max_pending=4)
+        results = []
+        try:
+            for result in pool.imap(fail, range(50)):
+                results.append(result)
+            self.fail("IOError not raised")
+        except IOError as error:
+            self.assertEqual(str(error), "item 3")
+        finally:
+            pool.close()
+        self.assertEqual(results, [0, 1, 2])
+        # the items after the error are not all computed
+        self.assertTrue(len(computed) < 10)
+
+    def test_workers(self):
+        self.assertRaises(ValueError, OrderedThreadPool, 0)
@@ -0,0 +1,57 @@
+import datetime
+from unittest import TestCase
+
+import numpy as np
+
+from txm2nexuslib.xradiaheader import (HeaderSnapshot, motor_table,
+                                       parse_dates, iso_time, DATE_DTYPE)
+
+
+class TestMotorTable(TestCase):
+
+    def setUp(self):
+        self.positions = np.arange(12, dtype='<f4').reshape(4, 3)
+        # trailing bytes of an incomplete value are ignored
+        self.motors = motor_table(self.positions.tostring() + '\0\0', 3)
+        fields = dict((name, None) for name in HeaderSnapshot._fields)
+        fields.update(axis_names=('X', 'Y', 'machine_current', ''),
+                      num_axes=3, motors=self.motors, no_of_images=4)
+        self.header = HeaderSnapshot(**fields)
+
+    def test_table(self):
+        self.assertEqual(self.motors.dtype, np.float32)
+        self.assertTrue(np.array_equal(self.motors, self.positions))
+        self.assertFalse(self.motors.flags.writeable)
+        self.assertEqual(motor_table(self.positions.tostring(), None).shape,
+                         (1, 12))
+
+    def test_motor_values(self):
+        self.assertEqual(self.header.motor_names,
+                         ('X', 'Y', 'machine_current'))
+        currents = self.header.motor_values(2)
+        self.assertEqual(currents.dtype, np.float64)
+        self.assertEqual(list(currents), [2, 5, 8, 11])
+        self.assertEqual(list(self.header.motor_values('Y', 2)), [1, 4])
+        self.assertRaises(ValueError, self.header.motor_values, 0, 5)
+
+
+class TestDates(TestCase):
+
+    def test_parse_dates(self):
+        records = np.zeros(3, dtype=DATE_DTYPE)
+        records['date'] = ['06/26/16 10:11:12', '12/31/99 23:59:59',
+                           '02/29/00 00:00:00']
+        # dates from the records of a Date stream (not contiguous)
+        timestamps = parse_dates(records['date'])
+        self.assertEqual(timestamps.dtype, np.dtype('M8[s]'))
+        expected = [datetime.datetime(2016, 6, 26, 10, 11, 12),
+                    datetime.datetime(2099, 12, 31, 23, 59, 59),
+                    datetime.datetime(2000, 2, 29, 0, 0, 0)]
+        self.assertEqual(list(timestamps.astype(datetime.datetime)),
+                         expected)
+        self.assertEqual(iso_time(timestamps[0]), '2016-06-26T10:11:12')
+
+    def test_wrong_dates(self):
+        self.assertRaises(ValueError, parse_dates, ['06/26/16 10:11:1x'])
+        self.assertRaises(ValueError, parse_dates, ['06-26-16 10:11:12'])
+        self.assertRaises(ValueError, parse_dates, ['06/26/16'])
@@ -0,0 +1,161 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.processpool import OrderedProcessPool
+from txm2nexuslib.xrmnex import (xrmReader, XradiaFilePool, read_xrm_image,
+                                 convert_xrm_bright_field, link_bright_field)
+from test_olefileio import write_ole
+
+NUMBER_OF_FILES = 5
+
+
+class TestXrmReader(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_names = []
+        self.streams = []
+        self.images = []
+        for i in range(NUMBER_OF_FILES):
+            image = np.arange(12, dtype='<u2').reshape(3, 4) + i
+            streams = {
+                'ImageInfo/NoOfImages': struct.pack('<I', 1),
+                'ImageInfo/ImageHeight': struct.pack('<I', 3),
+                'ImageInfo/ImageWidth': struct.pack('<I', 4),
+                'ImageInfo/DataType': struct.pack('<I', 5),
+                'ImageInfo/ExpTimes': struct.pack('<f', 0.5 * i),
+                'ImageInfo/Angles': struct.pack('<f', 10 * i),
+                'ImageInfo/Date': '06/26/16 10:00:%02i' % i + '\0' * 23,
+                'ImageData1/Image1': image.tostring(),
+            }
+            file_name = os.path.join(self.tmp_dir, '%i.xrm' % i)
+            write_ole(file_name, streams)
+            self.file_names.append(file_name)
+            self.streams.append(streams)
+            # the images are stored upside down
+            self.images.append(image[::-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_metadata(self):
+        with xrmReader(self.file_names, max_open_files=2) as reader:
+            self.assertEqual(list(reader.get_exp_times()),
+                             [0, 0.5, 1, 1.5, 2])
+            self.assertEqual(list(reader.get_angles()), [0, 10, 20, 30, 40])
+            self.assertEqual(reader.get_start_time(), '2016-06-26T10:00:00')
+            self.assertEqual(reader.get_end_time(), '2016-06-26T10:00:04')
+            self.assertEqual(len(reader.get_timestamps()), NUMBER_OF_FILES)
+            # each file is opened once for all the metadata
+            self.assertEqual(reader._files.opened, NUMBER_OF_FILES)
+            # the missing streams only raise for the values that need them
+            self.assertRaises(RuntimeError, reader.get_machine_currents)
+            self.assertRaises(RuntimeError, reader.get_x_positions)
+
+    def test_images(self):
+        with xrmReader(self.file_names, max_open_files=2) as reader:
+            for i in range(NUMBER_OF_FILES):
+                self.assertTrue(np.array_equal(reader.get_image(i)[0],
+                                               self.images[i]))
+            self.assertEqual(reader._files.opened, NUMBER_OF_FILES)
+            # the last two files are still open
+            reader.get_image(3)
+            reader.get_image(4)
+            self.assertEqual(reader._files.opened, NUMBER_OF_FILES)
+            reader.get_image(0)
+            self.assertEqual(reader._files.opened, NUMBER_OF_FILES + 1)
+
+    def test_pool(self):
+        pool = XradiaFilePool(1)
+        with pool.use(self.file_names[0]) as first:
+            self.assertTrue(first.is_opened())
+        with pool.use(self.file_names[1]):
+            pass
+        # the least recently used file has been closed
+        self.assertRaises(ValueError, first.file.fp.read, 1)
+        pool.close()
+        self.assertRaises(ValueError, XradiaFilePool, 0)
+
+    def test_pool_in_use(self):
+        pool = XradiaFilePool(1)
+        with pool.use(self.file_names[0]) as first:
+            # the file in use is not closed to open another one
+            with pool.use(self.file_names[1]):
+                pass
+            self.assertTrue(first.is_opened())
+            self.assertEqual(first.get_image().shape, (1, 3, 4))
+            # nor given to another user at the same time
+            with pool.use(self.file_names[0]) as again:
+                self.assertFalse(again is first)
+        self.assertEqual(pool.opened, 3)
+        pool.close()
+
+    def test_pool_threads(self):
+        # a thread can use the pool while another one is using a file
+        pool = XradiaFilePool(2)
+        used = threading.Event()
+        images = []
+
+        def read_second():
+            with pool.use(self.file_names[1]) as xrm_file:
+                images.append(xrm_file.get_image())
+            used.set()
+
+        with pool.use(self.file_names[0]):
+            thread = threading.Thread(target=read_second)
+            thread.start()
+            used.wait(10)
+            self.assertTrue(used.is_set())
+        thread.join()
+        self.assertTrue(np.array_equal(images[0][0], self.images[1]))
+        pool.close()
+
+    def test_processes(self):
+        with OrderedProcessPool(2) as pool:
+            images = list(pool.imap(read_xrm_image, self.file_names))
+        for image, expected in zip(images, self.images):
+            self.assertTrue(np.array_equal(image[0], expected))
+
+    def test_cache(self):
+        with xrmReader(self.file_names, cache_images=True) as reader:
+            reader.preload()
+            self.assertEqual(reader._files.opened, NUMBER_OF_FILES)
+            # the images are not read again
+            for i in range(NUMBER_OF_FILES):
+                self.assertTrue(np.array_equal(reader.get_image(i)[0],
+                                               self.images[i]))
+            self.assertEqual(reader._files.opened, NUMBER_OF_FILES)
+
+    def test_shared_bright_field(self):
+        # the bright field needs the motor positions (without names)
+        for file_name, streams in zip(self.file_names, self.streams):
+            streams['PositionInfo/MotorPositions'] = struct.pack(
+                '<32f', *range(32))
+            write_ole(file_name, streams)
+        file_name = os.path.join(self.tmp_dir, 'sample', 'sample_FF.hdf5')
+        convert_xrm_bright_field(self.file_names, file_name, write_batch=2)
+        self.assertEqual(os.listdir(os.path.dirname(file_name)),
+                         ['sample_FF.hdf5'])
+        tomo_name = os.path.join(self.tmp_dir, 'sample', 'tomo.hdf5')
+        with h5py.File(tomo_name, 'w') as tomo_file:
+            group = tomo_file.create_group('bright_field')
+            link_bright_field(group, file_name, os.path.dirname(tomo_name))
+            self.assertEqual(group.get('data', getlink=True).filename,
+                             'sample_FF.hdf5')
+        # the links are relative to the file of the tomo
+        os.rename(os.path.join(self.tmp_dir, 'sample'),
+                  os.path.join(self.tmp_dir, 'moved'))
+        with h5py.File(os.path.join(self.tmp_dir, 'moved', 'tomo.hdf5'),
+                       'r') as tomo_file:
+            group = tomo_file['bright_field']
+            self.assertEqual(sorted(group), ['ExpTimes', 'current', 'data',
+                                             'motor_positions'])
+            self.assertTrue(np.array_equal(group['data'][()], self.images))
+            self.assertEqual(list(group['ExpTimes']), [0, 0.5, 1, 1.5, 2])
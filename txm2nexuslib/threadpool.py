@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import threading
+import Queue
+from collections import deque
+
+
+class _Task(object):
+
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def run(self):
+        if not self.cancelled:
+            try:
+                self.result = self.func(self.item)
+            except Exception:
+                self.error = sys.exc_info()
+        self.done.set()
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+        return self.result
+
+
+class OrderedThreadPool(object):
+    """
+    Pool of worker threads computing func(item) for a sequence of items,
+    whose results are returned in the order of the items (see imap).
+
+    At most max_pending items (2 per worker by default) are submitted
+    before their results are consumed, which bounds the memory used by the
+    results waiting to be consumed.
+
+    waits counts the results the consumer had to wait for, and wait_time
+    is the total time waited (seconds).
+    """
+
+    def __init__(self, workers, max_pending=None):
+        if workers < 1:
+            raise ValueError("At least one worker is needed")
+        self.workers = workers
+        self.max_pending = max_pending or 2 * workers
+        self.results = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='OrderedThreadPool-%i' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            task.run()
+
+    def _submit(self, func, item):
+        task = _Task(func, item)
+        self._tasks.put(task)
+        return task
+
+    def submit(self, func, item):
+        """
+        Compute func(item) in a worker. The returned task has a get method
+        which waits for the result and returns it (or raises the error of
+        func), and a done event. The tasks submitted are not bounded by
+        max_pending.
+        """
+        return self._submit(func, item)
+
+    def imap(self, func, items):
+        """
+        Iterate over func(item) for each one of the items, in order. An
+        exception raised by func is raised again when its result is reached.
+        """
+        items = iter(items)
+        pending = deque()
+        for item in items:
+            pending.append(self._submit(func, item))
+            if len(pending) == self.max_pending:
+                break
+        try:
+            while pending:
+                task = pending.popleft()
+                if not task.done.is_set():
+                    self.waits += 1
+                    start = time.time()
+                    task.done.wait()
+                    self.wait_time += time.time() - start
+                result = task.get()
+                for item in items:
+                    pending.append(self._submit(func, item))
+                    break
+                self.results += 1
+                yield result
+        finally:
+            # after an error, or if the iteration is abandoned, the items
+            # not computed yet are skipped
+            for task in pending:
+                task.cancelled = True
+
+    def close(self):
+        """Stop the workers once the submitted items are computed"""
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def report(self):
+        """Summary of the time that the consumer has waited for the results"""
+        return ("Waited for %i of %i results computed by %i workers "
+                "(%.3f s)" % (self.waits, self.results, self.workers,
+                              self.wait_time))
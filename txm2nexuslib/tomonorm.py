@@ -22,12 +22,27 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import numpy as np
 import h5py
 
+from storage import DatasetStorage
+from external import upright_frame
+from framewriter import TeeWriter
+from sinogram import SinogramWriter, DEFAULT_SINOGRAM_MEMORY
+
 
 class TomoNormalize:
 
-    def __init__(self, inputfile, avgtomnorm, gaussianblur, avgff, diffraction):
+    def __init__(self, inputfile, avgtomnorm, gaussianblur, avgff, diffraction,
+                 write_batch=None, storage=None, sinogram=None,
+                 sinogram_memory=DEFAULT_SINOGRAM_MEMORY):
 
         self.avgtomnorm = avgtomnorm
+        # Number of images written at once (None: computed from memory)
+        self.write_batch = write_batch
+        # Chunking and compression of the normalized images
+        self.storage = storage or DatasetStorage()
+        # Normalized sinograms written also ('also') or instead of ('only')
+        # the normalized images, using sinogram_memory bytes (see sinogram)
+        self.sinogram = sinogram
+        self.sinogram_memory = sinogram_memory
         self.filename_nexus = inputfile
         self.input_nexusfile = h5py.File(self.filename_nexus, 'r')
         self.outputfilehdf5 = inputfile.rsplit('.', 1)[0] + '_norm.hdf5'
@@ -72,6 +87,25 @@ class TomoNormalize:
         self.diffraction = diffraction
         return
 
+    # Create the datasets of the normalized images (TomoNormalized and/or
+    # TomoNormalizedSinogram) and return the writer of the normalized
+    # images; normalize_image(numimg) returns the normalized image numimg.
+    def normalized_writer(self, normalize_image):
+        shape = (self.nFramesSample, self.numrows, self.numcols)
+        writers = []
+        if self.sinogram != 'only':
+            self.storage.create_dataset(self.norm_grp, "TomoNormalized",
+                                        shape, 'float32', normalize_image)
+            writers.append(self.storage.frame_writer(
+                self.norm_grp['TomoNormalized'], batch=self.write_batch))
+        if self.sinogram is not None:
+            writers.append(SinogramWriter(
+                self.norm_grp, "TomoNormalizedSinogram", shape, 'float32',
+                self.storage, normalize_image, self.sinogram_memory))
+        for writer in writers:
+            writer.dataset.attrs['Number of Frames'] = self.nFramesSample
+        return TeeWriter(*writers)
+
     def normalize_tomo(self):
 
         nxtomo_grp = self.input_nexusfile["NXtomo"]
@@ -161,19 +195,6 @@ class TomoNormalize:
         if dimensions_singleimage_tomo == \
                 dimensions_singleimage_flatfield:
 
-            self.norm_grp.create_dataset(
-                "TomoNormalized",
-                shape=(self.nFramesSample,
-                       self.numrows,
-                       self.numcols),
-                chunks=(1,
-                        self.numrows,
-                        self.numcols),
-                dtype='float32')
-
-            self.norm_grp['TomoNormalized'].attrs['Number of Frames'] = \
-                self.nFramesSample
-
             avgnormalizedtomo = np.zeros((self.numrows,
                                           self.numcols),
                                          dtype=np.float)
@@ -215,32 +236,32 @@ class TomoNormalize:
 
                 # FlatField (FF) images normalized with current,
                 # and Average of FlatField Normalized with current
-                self.norm_grp.create_dataset(
+                self.storage.create_dataset(
+                    self.norm_grp,
                     "FFNormalizedWithCurrent",
-                    shape=(self.nFramesFF,
-                           self.numrowsFF,
-                           self.numcolsFF),
-                    chunks=(1,
-                            self.numrowsFF,
-                            self.numcolsFF),
-                    dtype='float32')
+                    (self.nFramesFF, self.numrowsFF, self.numcolsFF),
+                    'float32',
+                    lambda i: (self.data_flatfield[i] /
+                               self.ratios_currents_flatfield[i]))
 
                 dset_FF_norm_current = self.norm_grp["FFNormalizedWithCurrent"]
                 dset_FF_norm_current.attrs['Number of Frames'] = self.nFramesFF
 
-                for numimgFF in range(self.nFramesFF):
-                    image_FF_normalized_with_current = np.array(
-                        self.data_flatfield[numimgFF] /
-                        self.ratios_currents_flatfield[numimgFF],
-                        dtype=np.float)
-                    self.norm_grp['FFNormalizedWithCurrent'][numimgFF] = \
-                        image_FF_normalized_with_current
+                writer = self.storage.frame_writer(dset_FF_norm_current,
+                                                   batch=self.write_batch)
+                with writer:
+                    for numimgFF in range(self.nFramesFF):
+                        image_FF_normalized_with_current = np.array(
+                            self.data_flatfield[numimgFF] /
+                            self.ratios_currents_flatfield[numimgFF],
+                            dtype=np.float)
+                        writer.append(image_FF_normalized_with_current)
 
-                    if self.avgff == 1:
-                        self.averageff += image_FF_normalized_with_current
+                        if self.avgff == 1:
+                            self.averageff += image_FF_normalized_with_current
 
-                    print('FF Image %d has been normalized using the '
-                          'machine_currents' % numimgFF)
+                        print('FF Image %d has been normalized using the '
+                              'machine_currents' % numimgFF)
 
                 if self.avgff == 0:
                     self.averageff = np.array(self.data_flatfield[0] /
@@ -267,18 +288,24 @@ class TomoNormalize:
                     print('\nAverageFF has been calculated '
                           'using the machine_currents\n')
 
-                for numimg in range(self.nFramesSample):
-                    individual_image = sample_image_data[numimg]
-                    normalizedtomo_singleimage = np.array(
-                        ((individual_image / self.ratios_currents_tomo[numimg]) /
+                def normalize_image(numimg):
+                    individual_image = upright_frame(sample_image_data,
+                                                     numimg)
+                    return np.array(
+                        ((individual_image /
+                          self.ratios_currents_tomo[numimg]) /
                          (self.averageff*self.ratios_exptimes[numimg])),
                         dtype=np.float32)
-                    self.norm_grp['TomoNormalized'][numimg] = \
-                        normalizedtomo_singleimage
-                    if self.avgtomnorm == 1:
-                        avgnormalizedtomo += normalizedtomo_singleimage
-                    if numimg%10 == 0:
-                        print('Image %d has been normalized' % numimg)
+
+                writer = self.normalized_writer(normalize_image)
+                with writer:
+                    for numimg in range(self.nFramesSample):
+                        normalizedtomo_singleimage = normalize_image(numimg)
+                        writer.append(normalizedtomo_singleimage)
+                        if self.avgtomnorm == 1:
+                            avgnormalizedtomo += normalizedtomo_singleimage
+                        if numimg%10 == 0:
+                            print('Image %d has been normalized' % numimg)
 
             else:
 
@@ -312,18 +339,23 @@ class TomoNormalize:
                     self.ratios_exptimes[i] = self.exposuretimes_tomo[i] / \
                                               self.avg_ff_exptime
 
-                for numimg in range(self.nFramesSample):
-                    individual_image = sample_image_data[numimg]
-                    normalizedtomo_singleimage = np.array(
+                def normalize_image(numimg):
+                    individual_image = upright_frame(sample_image_data,
+                                                     numimg)
+                    return np.array(
                         (individual_image /
                          (self.averageff*self.ratios_exptimes[numimg])),
                         dtype=np.float32)
-                    self.norm_grp['TomoNormalized'][numimg] = \
-                        normalizedtomo_singleimage
-                    if self.avgtomnorm == 1:
-                        avgnormalizedtomo += normalizedtomo_singleimage
-                    if numimg%10 == 0:
-                        print('Image %d has been normalized' % numimg)
+
+                writer = self.normalized_writer(normalize_image)
+                with writer:
+                    for numimg in range(self.nFramesSample):
+                        normalizedtomo_singleimage = normalize_image(numimg)
+                        writer.append(normalizedtomo_singleimage)
+                        if self.avgtomnorm == 1:
+                            avgnormalizedtomo += normalizedtomo_singleimage
+                        if numimg%10 == 0:
+                            print('Image %d has been normalized' % numimg)
 
             if self.avgtomnorm == 1:
                 avgnormalizedtomo /= self.nFramesSample
@@ -19,16 +19,33 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import re
+import os
 import sys
-import struct
-import datetime
+import time
 
 from OleFileIO_PL import *
+from xradiaheader import (read_header_snapshot, write_motor_table,
+                          write_timestamps, iso_time)
+from imagedecode import decode_image, pixel_dtype
+from threadpool import OrderedThreadPool
+from pipeline import ConversionPipeline
+from storage import DatasetStorage
+from framewriter import TeeWriter
+from sinogram import SinogramWriter, write_sinograms, DEFAULT_SINOGRAM_MEMORY
+from external import frame_location, create_external_dataset
+from prefetch import (FramePrefetcher, ole_image_reader, image_stream_name,
+                      stream_data, DEFAULT_PREFETCH_DEPTH,
+                      DEFAULT_PREFETCH_MEMORY)
 import numpy as np
 import argparse
 import h5py
 
+# Seconds between two readings of a txrm file being written (follow mode)
+DEFAULT_POLL_INTERVAL = 1.0
+# Seconds without changes after which a followed txrm file is considered
+# finished even if not all the images have been written
+DEFAULT_IDLE_TIMEOUT = 120.0
+
 
 class txrmNXtomo:
 
@@ -36,7 +53,10 @@ class txrmNXtomo:
                  zero_deg_final=None, title='X-ray imaging',
                  sourcename='ALBA', sourcetype='Synchrotron X-ray Source', 
                  sourceprobe='x-ray', instrument='BL09 @ ALBA', 
-                 sample='Unknown'):
+                 sample='Unknown', prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+                 prefetch_memory=DEFAULT_PREFETCH_MEMORY, write_batch=None,
+                 workers=0, pipeline=0, storage=None, sinogram=None,
+                 sinogram_memory=DEFAULT_SINOGRAM_MEMORY, external=False):
 
         self.exitprogram = 0
         if len(files) < 1:
@@ -107,6 +127,31 @@ class txrmNXtomo:
         self.instrumentname = instrument
         self.samplename = sample
         self.datatype = 'uint16' #two bytes
+
+        # Images read in advance while the previous ones are converted
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_memory = prefetch_memory
+        # Number of images written at once (None: computed from memory)
+        self.write_batch = write_batch
+        # Threads decoding the images (0: decoded by the writing thread)
+        self.workers = workers
+        # Threads decoding the images of the sample, bright and dark field
+        # files converted concurrently by a pipeline (0: no pipeline)
+        self.pipeline_workers = pipeline
+        # Chunking and compression of the image stacks
+        self.storage = storage or DatasetStorage()
+        # Sinogram dataset written also ('also') or instead of ('only')
+        # the data dataset, using sinogram_memory bytes (see sinogram)
+        self.sinogram = sinogram
+        self.sinogram_memory = sinogram_memory
+        # The sample images are referenced in the txrm file instead of
+        # copied (see external)
+        if external and sinogram is not None:
+            raise ValueError("The sinograms cannot be written from images "
+                             "stored externally")
+        self.external = external
+        # Number of images converted by follow_image_stack()
+        self.followed_frames = None
         
         self.nFramesSampleTotal = 0
         self.nFramesBrightTotal = 0
@@ -191,15 +236,14 @@ class txrmNXtomo:
         
         # Opening the .txrm files as Ole structures
         ole = OleFileIO(self.filename_txrm)
+        # All the metadata streams are read and decoded at once
+        header = read_header_snapshot(ole)
+        ole.close()
 
         # Sample-ID
-        if ole.exists('SampleInfo/SampleID'):   
-            stream = ole.openstream('SampleInfo/SampleID')
-            data = stream.read()
-            struct_fmt = '<'+'50s'
-            samplename = struct.unpack(struct_fmt, data)
+        if header.sample_id is not None:
             if self.samplename != 'Unknown':
-                self.samplename = samplename[0]    
+                self.samplename = header.sample_id
             if verbose: 
                 print "SampleInfo/SampleID: %s " % self.samplename
             self.nxsample.create_dataset("name", data=self.samplename)
@@ -208,17 +252,9 @@ class txrmNXtomo:
             print("There is no information about SampleID")
 
         # Detector to Sample distance
-        if ole.exists('PositionInfo/AxisNames'):   
-            stream = ole.openstream('PositionInfo/AxisNames')
-            data = stream.read()
-            lendatabytes=len(data)
-            formatstring='<'+str(lendatabytes)+'c'
-            struct_fmt = formatstring
-            axis_names_raw = struct.unpack(struct_fmt, data)
-            axis_names_raw = ''.join(axis_names_raw)
-            axis_names_raw = axis_names_raw.replace("\x00", " ")
-            axis_names = re.split('\s+\s+', axis_names_raw)
-            self.num_axis = len(axis_names)-1
+        if header.axis_names is not None:
+            axis_names = header.axis_names
+            self.num_axis = header.num_axes
             sample_enc_z_string = axis_names[2]
             detector_enc_z_string = axis_names[23]
             energy_name = axis_names[27]
@@ -228,23 +264,14 @@ class txrmNXtomo:
             except:
                 energyenc_name = " "
 
-        where_detzero = ("ConfigureBackup/ConfigCamera/" +
-                        "Camera 1/ConfigZonePlates/DetZero")
-        if ole.exists(where_detzero):
-            stream = ole.openstream(where_detzero)
-            data = stream.read()
-            if len(data) != 0:
-                struct_fmt = '<1f'
-                sample_to_detector_zero_enc = struct.unpack(struct_fmt, data)
-                self.sample_detector_zeroenc = sample_to_detector_zero_enc[0]
-
-        if ole.exists('PositionInfo/MotorPositions'):   
-            stream = ole.openstream('PositionInfo/MotorPositions')
-            data = stream.read(112)
-            struct_fmt = '<28f'
-            axis = struct.unpack(struct_fmt, data)
-            self.sample_distance_enc = axis[2]  # this is already in um
-            self.detector_distance_enc = axis[23]*1000  # from mm to um
+        if header.det_zero is not None:
+            self.sample_detector_zeroenc = header.det_zero
+
+        if header.motors is not None:
+            axis = header.motors[0, :28]
+            self.sample_distance_enc = float(axis[2])  # this is already in um
+            # from mm to um
+            self.detector_distance_enc = float(axis[23])*1000
         if (sample_enc_z_string == "Sample Z" and
                     detector_enc_z_string == "Detector Z"):
             self.sample_detector_distance = self.sample_detector_zeroenc + \
@@ -260,12 +287,9 @@ class txrmNXtomo:
                   "NOT be correctly calculated")
 
         # Pixel-size
-        if ole.exists('ImageInfo/PixelSize'):   
-            stream = ole.openstream('ImageInfo/PixelSize')
-            data = stream.read()
-            struct_fmt = '<1f'
-            pixelsize = struct.unpack(struct_fmt, data)
-            self.pixelsize = pixelsize[0]
+        if header.pixel_size is not None:
+            pixelsize = (header.pixel_size,)
+            self.pixelsize = header.pixel_size
             if verbose: 
                 print "ImageInfo/PixelSize: %f " % pixelsize
             self.nxdetectorsample.create_dataset("x_pixel_size",
@@ -278,12 +302,8 @@ class txrmNXtomo:
             print("There is no information about PixelSize")
 
         # X-Ray Magnification
-        if ole.exists('ImageInfo/XrayMagnification'):   
-            stream = ole.openstream('ImageInfo/XrayMagnification')
-            data = stream.read(4)
-            struct_fmt = '<1f'
-            XrayMagnification = struct.unpack(struct_fmt, data)
-            self.magnification = XrayMagnification[0]
+        if header.xray_magnification is not None:
+            self.magnification = header.xray_magnification
             if self.magnification != 0.0:
                 pass
             elif self.magnification == 0.0 and self.pixelsize != 0.0:
@@ -293,52 +313,37 @@ class txrmNXtomo:
                 print("Magnification could not be deduced.")	
                 self.magnification = 0.0
             if verbose: 
-                print "ImageInfo/XrayMagnification: %f " % XrayMagnification
+                print "ImageInfo/XrayMagnification: %f " % \
+                      header.xray_magnification
             self.nxdetectorsample['magnification'] = self.magnification
 
         # Stack data size
-        if (ole.exists('ImageInfo/NoOfImages') and 
-            ole.exists('ImageInfo/ImageWidth') and 
-            ole.exists('ImageInfo/ImageHeight')):                  
-                    
-            stream = ole.openstream('ImageInfo/NoOfImages')
-            data = stream.read()
-            nimages = struct.unpack('<I', data)
-            if verbose: 
-                print "ImageInfo/NoOfImages = %i" % nimages[0] 
-            self.nSampleFrames = np.int(nimages[0])
-        
-            stream = ole.openstream('ImageInfo/ImageHeight')
-            data = stream.read()
-            ximage = struct.unpack('<I', data)    
-            if verbose: 
-                print "ImageInfo/ImageHeight = %i" % ximage[0]  
-            self.numrows = np.int(ximage[0])
-            
-            stream = ole.openstream('ImageInfo/ImageWidth')
-            data = stream.read()
-            yimage = struct.unpack('<I', data)
+        if (header.no_of_images is not None and 
+            header.image_width is not None and 
+            header.image_height is not None):
+
+            self.nSampleFrames = np.int(header.no_of_images)
+            self.numrows = np.int(header.image_height)
+            self.numcols = np.int(header.image_width)
             if verbose: 
-                print "ImageInfo/ImageWidth = %i" % yimage[0]  
-            self.numcols = np.int(yimage[0])
+                print "ImageInfo/NoOfImages = %i" % self.nSampleFrames
+                print "ImageInfo/ImageHeight = %i" % self.numrows
+                print "ImageInfo/ImageWidth = %i" % self.numcols
 
         else:
             print('There is no information about the image stack size '
                   '(ImageHeight, ImageWidth or Number of images)')
 
+        # Positions of all the motors for each image
+        if header.motors is not None:
+            write_motor_table(self.nxdetectorsample, header.motors,
+                              header.motor_names)
+
         # Accelerator current for each image (machine current)
         if current_name == "machine_current":
-            if ole.exists('PositionInfo/MotorPositions'):   
-                stream = ole.openstream('PositionInfo/MotorPositions')
-                number_of_floats= self.num_axis*self.nSampleFrames
-                struct_fmt = '<'+str(number_of_floats)+'f'
-                number_of_bytes = number_of_floats * 4  # 4 bytes every float
-                data = stream.read(number_of_bytes)
-                axis = struct.unpack(struct_fmt, data)
-
-                currents = self.nSampleFrames*[0]
-                for i in range(self.nSampleFrames):
-                    currents[i] = axis[self.num_axis*i+28] #In mA
+            if header.motors is not None:
+                # In mA
+                currents = header.motor_values(28, self.nSampleFrames)
                 self.nxdetectorsample['current'] = currents
                 self.nxdetectorsample['current'].attrs["units"] = "mA"
         else:     
@@ -348,45 +353,19 @@ class txrmNXtomo:
         # Energy for each image:
         # Energy for each image calculated from Energyenc ####
         if energyenc_name.lower()=="energyenc":
-            if ole.exists('PositionInfo/MotorPositions'):
-                stream = ole.openstream('PositionInfo/MotorPositions')
-                number_of_floats= self.num_axis*self.nSampleFrames
-                struct_fmt = '<'+str(number_of_floats)+'f'
-                number_of_bytes = number_of_floats * 4  # 4 bytes every float
-                data = stream.read(number_of_bytes)
-                axis = struct.unpack(struct_fmt, data)
-                energenc = self.nSampleFrames*[0]
-                for i in range(self.nSampleFrames):
-                    energenc[i] = axis[self.num_axis*i+30]  # In eV
-                if verbose: print "Energyenc: \n ",  energenc
-                energies_hdf = energenc
+            if header.motors is not None:
+                # In eV
+                energies_hdf = header.motor_values(30, self.nSampleFrames)
+                if verbose: print "Energyenc: \n ",  energies_hdf
         # Energy for each image calculated from Energy motor ####
         elif energy_name == "Energy":
-            if ole.exists('PositionInfo/MotorPositions'):   
-                stream = ole.openstream('PositionInfo/MotorPositions')
-                number_of_floats= self.num_axis*self.nSampleFrames
-                struct_fmt = '<'+str(number_of_floats)+'f'
-                number_of_bytes = number_of_floats * 4  # 4 bytes every float
-                data = stream.read(number_of_bytes)
-                axis = struct.unpack(struct_fmt, data)
-                energies_hdf = self.nSampleFrames*[0]
-                for i in range(self.nSampleFrames):
-                    energies_hdf[i] = axis[self.num_axis*i+27]  # In eV
+            if header.motors is not None:
+                # In eV
+                energies_hdf = header.motor_values(27, self.nSampleFrames)
                 if verbose: print "ImageInfo/Energy: \n ",  energies_hdf
         # Energy for each image calculated from ImageInfo ####
-        elif ole.exists('ImageInfo/Energy'):
-            stream = ole.openstream('ImageInfo/Energy')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            # Some txrm images (flatfields) have different encoding of data
-            try:
-                energies_hdf = struct.unpack(struct_fmt, data)
-            except struct.error:
-                print >> sys.stderr, 'Unexpected data length (%i bytes). ' \
-                                     'Trying to unpack energies with: ' \
-                                     '"f"+"36xf"*(nSampleFrames-1)' % len(data)
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                energies_hdf = struct.unpack(struct_fmt, data)
+        elif header.energies is not None:
+            energies_hdf = header.energies
             if verbose: print "ImageInfo/Energy: \n ",  energies_hdf
         else:
             energies_hdf = 0
@@ -396,19 +375,8 @@ class txrmNXtomo:
         self.nxsource["energy"].attrs["units"] = "eV"
 
         # Exposure Times
-        if ole.exists('ImageInfo/ExpTimes'):
-            stream = ole.openstream('ImageInfo/ExpTimes')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            # Some txrm images (flatfields) have different encoding of data
-            try:
-                exptimes = struct.unpack(struct_fmt, data)
-            except struct.error:
-                print >> sys.stderr, 'Unexpected data length (%i bytes). ' \
-                                     'Trying to unpack exposure times with: ' \
-                                     '"f"+"36xf"*(nSampleFrames-1)' % len(data)
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                exptimes = struct.unpack(struct_fmt, data)
+        if header.exp_times is not None:
+            exptimes = header.exp_times
             if verbose:
                 print "ImageInfo/ExpTimes: \n ",  exptimes
             self.nxdetectorsample["ExpTimes"] = exptimes
@@ -419,78 +387,33 @@ class txrmNXtomo:
                   'which have been taken the different images')
 
         # DataType: 10 float; 5 uint16 (unsigned 16-bit (2-byte) integers)
-        if ole.exists('ImageInfo/DataType'):                  
-            stream = ole.openstream('ImageInfo/DataType')
-            data = stream.read()
-            struct_fmt = '<1I'
-            datatype = struct.unpack(struct_fmt, data)
-            datatype = int(datatype[0])
-            if datatype == 5:
-                self.datatype = 'uint16'
-            else:
-                self.datatype = 'float'
+        if header.data_type is not None:
+            self.datatype = header.data_type
             if verbose: 
                 print "ImageInfo/DataType: %s " %  self.datatype      
         else:
             print("There is no information about DataType")
 
-        # Start and End Times 
-        if ole.exists('ImageInfo/Date'):  
-            stream = ole.openstream('ImageInfo/Date')       
-            data = stream.read()
-            dates = struct.unpack('<'+'17s23x'*self.nSampleFrames, data) 
-            
-            startdate = dates[0]
-            [day, hour] = startdate.split(" ")
-            [month, day, year] = day.split("/")
-            [hour, minute, second] = hour.split(":")    
-            
-            year = '20'+year
-            year = int(year)   
-            month = int(month)
-            day = int(day)
-            hour = int(hour)
-            minute = int(minute)
-            second = int(second)
-
-            starttime = datetime.datetime(year, month, day, 
-                                          hour, minute, second)                 
-            starttimeiso = starttime.isoformat()
-
+        # Start and End Times, and time of each image
+        if header.dates is not None:
+            timestamps = header.timestamps[:self.nSampleFrames]
+            starttimeiso = iso_time(timestamps[0])
             if verbose: 
                 print "ImageInfo/Date = %s" % starttimeiso 
             self.nxentry['start_time'] = str(starttimeiso)
 
-            enddate = dates[self.nSampleFrames-1]    
-            [endday, endhour] = enddate.split(" ")
-            [endmonth, endday, endyear] = endday.split("/")
-            [endhour, endminute, endsecond] = endhour.split(":")
-
-            endyear = '20'+endyear
-            endyear = int(endyear)   
-            endmonth = int(endmonth)
-            endday = int(endday)
-            endhour = int(endhour)
-            endminute = int(endminute)
-            endsecond = int(endsecond)
-
-            endtime = datetime.datetime(endyear, endmonth, endday, 
-                                        endhour, endminute, endsecond)                 
-            endtimeiso = endtime.isoformat()
-            
+            endtimeiso = iso_time(timestamps[-1])
             if verbose: 
                 print "ImageInfo/Date = %s" % endtimeiso 
             self.nxentry['end_time'] = str(endtimeiso)
+            write_timestamps(self.nxentry, timestamps)
 
         else:
             print("There is no information about Date")
 
         # Sample rotation angles 
-        if ole.exists('ImageInfo/Angles'):    
-            stream = ole.openstream('ImageInfo/Angles')
-            data = stream.read()
-            struct_fmt = '<{0:10}f'.format(self.nSampleFrames)
-            angles = struct.unpack(struct_fmt, data)
+        if header.angles is not None:
+            angles = header.angles
             if verbose: 
                 print "ImageInfo/Angles: \n ",  angles
             self.nxsample['rotation_angle'] = angles
@@ -506,20 +429,8 @@ class txrmNXtomo:
 
         # Sample translations in X, Y and Z 
         # X sample translation: nxsample['z_translation']
-        if ole.exists('ImageInfo/XPosition'):
-
-            stream = ole.openstream('ImageInfo/XPosition')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            #Found some txrm images with different encoding of data #
-            try: 
-                xpositions = struct.unpack(struct_fmt, data) 
-            except struct.error:
-                print >> sys.stderr, 'Unexpected data length (%i bytes). ' \
-                                     'Trying to unpack XPositions with: ' \
-                                     '"f"+"36xf"*(nSampleFrames-1)' % len(data)
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                xpositions = struct.unpack(struct_fmt, data)
+        if header.x_positions is not None:
+            xpositions = header.x_positions
             if verbose: 
                 print "ImageInfo/XPosition: \n ",  xpositions  
             self.nxsample['x_translation'] = xpositions
@@ -529,19 +440,8 @@ class txrmNXtomo:
             print("There is no information about xpositions")
 
         # Y sample translation: nxsample['z_translation']
-        if ole.exists('ImageInfo/YPosition'):
-
-            stream = ole.openstream('ImageInfo/YPosition')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            try:
-                ypositions = struct.unpack(struct_fmt, data) 
-            except struct.error:
-                print >> sys.stderr, 'Unexpected data length (%i bytes). ' \
-                                     'Trying to unpack YPositions with: ' \
-                                     '"f"+"36xf"*(nSampleFrames-1)' % len(data)
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                ypositions = struct.unpack(struct_fmt, data)
+        if header.y_positions is not None:
+            ypositions = header.y_positions
             if verbose: 
                 print "ImageInfo/YPosition: \n ",  ypositions  
             self.nxsample['y_translation'] = ypositions
@@ -551,19 +451,8 @@ class txrmNXtomo:
             print("There is no information about xpositions")
 
         # Z sample translation: nxsample['z_translation']
-        if ole.exists('ImageInfo/ZPosition'):
-    
-            stream = ole.openstream('ImageInfo/ZPosition')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.nSampleFrames)
-            try:
-                zpositions = struct.unpack(struct_fmt, data)
-            except struct.error:
-                print >> sys.stderr, 'Unexpected data length (%i bytes). ' \
-                                     'Trying to unpack ZPositions with: ' \
-                                     '"f"+"36xf"*(nSampleFrames-1)' % len(data)
-                struct_fmt = '<'+"f"+"36xf"*(self.nSampleFrames-1)
-                zpositions = struct.unpack(struct_fmt, data)
+        if header.z_positions is not None:
+            zpositions = header.z_positions
             if verbose: 
                 print "ImageInfo/ZPosition: \n ",  zpositions
             self.nxsample['z_translation'] = zpositions
@@ -574,7 +463,6 @@ class txrmNXtomo:
 
         self.metadata=1
 
-        ole.close()
         print("Meta-Data conversion from 'txrm' to NeXus HDF5 "
               "has been done.\n")
 
@@ -583,39 +471,25 @@ class txrmNXtomo:
     def convert_zero_deg_images(self, ole_zerodeg):
 
         verbose = False
+        header = read_header_snapshot(ole_zerodeg)
         # DataType: 10 float; 5 uint16 (unsigned 16-bit (2-byte) integers)
-        if ole_zerodeg.exists('ImageInfo/DataType'):                  
-            stream = ole_zerodeg.openstream('ImageInfo/DataType')
-            data = stream.read()
-            struct_fmt = '<1I'
-            datatype_zerodeg = struct.unpack(struct_fmt, data)
-            datatype_zerodeg = int(datatype_zerodeg[0])
-            if datatype_zerodeg == 5:
-                self.datatype_zerodeg='uint16'
-            else:
-                self.datatype_zerodeg= 'float'
+        if header.data_type is not None:
+            self.datatype_zerodeg = header.data_type
             if verbose: 
                 print "ImageInfo/DataType: %s " %  self.datatype_zerodeg     
         else:
             print("There is no information about DataType")
 
         # Zero degrees data size 
-        if (ole_zerodeg.exists('ImageInfo/NoOfImages') and 
-            ole_zerodeg.exists('ImageInfo/ImageWidth') and 
-            ole_zerodeg.exists('ImageInfo/ImageHeight')):                  
-                          
-            stream = ole_zerodeg.openstream('ImageInfo/ImageHeight')
-            data = stream.read()
-            yimage = struct.unpack('<I', data)     
-            self.numrows_zerodeg = np.int(yimage[0])
-            if verbose: 
-                print "ImageInfo/ImageHeight = %i" % yimage[0]
-            stream = ole_zerodeg.openstream('ImageInfo/ImageWidth')
-            data = stream.read()
-            ximage = struct.unpack('<I', data)
-            self.numcols_zerodeg = np.int(ximage[0])
+        if (header.no_of_images is not None and 
+            header.image_width is not None and 
+            header.image_height is not None):
+
+            self.numrows_zerodeg = np.int(header.image_height)
+            self.numcols_zerodeg = np.int(header.image_width)
             if verbose: 
-                print "ImageInfo/ImageWidth = %i" % ximage[0]  
+                print "ImageInfo/ImageHeight = %i" % self.numrows_zerodeg
+                print "ImageInfo/ImageWidth = %i" % self.numcols_zerodeg
         else:
             print('There is no information about the 0 degrees image size '
                   '(ImageHeight, or about ImageWidth)')
@@ -623,22 +497,10 @@ class txrmNXtomo:
         if ole_zerodeg.exists('ImageData1/Image1'):        
             img_string = "ImageData1/Image1"
             stream = ole_zerodeg.openstream(img_string) 
-            data = stream.read()
-            if self.datatype == 'uint16':
-                struct_fmt = "<{0:10}H".format(self.numrows_zerodeg *
-                                               self.numcols_zerodeg)
-                imgdata = struct.unpack(struct_fmt, data)
-            elif self.datatype == 'float':                   
-                struct_fmt = "<{0:10}f".format(self.numrows_zerodeg *
-                                               self.numcols_zerodeg)
-                imgdata = struct.unpack(struct_fmt, data)
-            else:                            
-                print "Wrong data type"
-
-            imgdata_zerodeg = np.flipud(np.reshape(imgdata,
-                                                   (self.numrows,
-                                                    self.numcols),
-                                                   order='A'))
+            data = stream_data(stream)
+            imgdata_zerodeg = decode_image(data, self.numrows_zerodeg,
+                                           self.numcols_zerodeg,
+                                           self.datatype_zerodeg)
         else:
             imgdata_zerodeg = 0
         return imgdata_zerodeg
@@ -646,96 +508,248 @@ class txrmNXtomo:
     # Read single image. Function that will be used inside
     # convert_image_stack() for converting the full image stack
     # thanks to multiple chunks.
-    def extract_single_image(self, ole, numimage): 
+    def extract_single_image(self, ole, numimage, data=None): 
 
         # Read the images - They are stored in the txrm as ImageData1,
         # ImageData2...
         # Each folder contains 100 images 1-100, 101-200...
-        img_string = "ImageData%i/Image%i" % (np.ceil(numimage/100.0),
-                                              numimage)
-        stream = ole.openstream(img_string)
-        data = stream.read()
-    
-        if self.datatype == 'uint16':
-            struct_fmt = "<{0:10}H".format(self.numrows*self.numcols)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.datatype == 'float':                   
-            struct_fmt = "<{0:10}f".format(self.numrows*self.numcols)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:                            
-            print "Wrong data type"
-            return
-            
-        singleimage = np.flipud(np.reshape(imgdata,
-                                           (self.numrows, self.numcols),
-                                           order='A'))
-        singleimage = np.reshape(singleimage,
-                                 (1, self.numrows, self.numcols),
-                                 order='A')
-        return singleimage
+        # data: raw data of the image if it has already been read
+        if data is None:
+            data = ole_image_reader(ole)(numimage)
+        singleimage = decode_image(data, self.numrows, self.numcols,
+                                   self.datatype)
+        return singleimage[np.newaxis]
 
     # Read single image. Function that will be used inside
     # convert_image_stack()
-    def extract_single_image_bright(self, ole, numimage): 
+    def extract_single_image_bright(self, ole, numimage, data=None): 
 
         # Read the images - They are stored in the txrm as ImageData1,
         # ImageData2...
         # Each folder contains 100 images 1-100, 101-200...
-        img_string = "ImageData%i/Image%i" % (np.ceil(numimage/100.0),
-                                              numimage)
-        stream = ole.openstream(img_string)
-        data = stream.read()
-    
-        if self.datatype_bright == 'uint16':
-            struct_fmt = "<{0:10}H".format(self.numrows_bright *
-                                           self.numcols_bright)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.datatype_bright == 'float':                   
-            struct_fmt = "<{0:10}f".format(self.numrows_bright *
-                                           self.numcols_bright)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:                            
-            print "Wrong data type"
-            return
-            
-        singleimage = np.flipud(np.reshape(imgdata,
-                                           (self.numrows_bright,
-                                            self.numcols_bright),
-                                           order='A'))
-        singleimage = np.reshape(singleimage,
-                                 (1, self.numrows_bright, self.numcols_bright),
-                                 order='A')
-        return singleimage
+        # data: raw data of the image if it has already been read
+        if data is None:
+            data = ole_image_reader(ole)(numimage)
+        singleimage = decode_image(data, self.numrows_bright,
+                                   self.numcols_bright, self.datatype_bright)
+        return singleimage[np.newaxis]
 
     # Read single image. Function that will only be used inside
     # convert_image_stack().
-    def extract_single_image_dark(self, ole, numimage): 
+    def extract_single_image_dark(self, ole, numimage, data=None): 
 
         # Read the images - They are stored in the txrm as ImageData1,
         # ImageData2...
         # Each folder contains 100 images 1-100, 101-200...
-        img_string = "ImageData%i/Image%i" % (np.ceil(numimage/100.0),
-                                              numimage)
-        stream = ole.openstream(img_string)
-        data = stream.read()
-    
-        if self.datatype_dark == 'uint16':
-            struct_fmt = "<{0:10}H".format(self.numrows_dark*self.numcols_dark)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.datatype_dark == 'float':                   
-            struct_fmt = "<{0:10}f".format(self.numrows_dark*self.numcols_dark)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:                            
-            print "Wrong data type"
+        # data: raw data of the image if it has already been read
+        if data is None:
+            data = ole_image_reader(ole)(numimage)
+        singleimage = decode_image(data, self.numrows_dark,
+                                   self.numcols_dark, self.datatype_dark)
+        return singleimage[np.newaxis]
+
+    # Read and decode the images first to nframes of a txrm file, with one of
+    # the extract_single_image functions, in order.
+    def decode_frames(self, ole, nframes, extract, first=1):
+        if self.workers > 0:
+            # Images read and decoded by a pool of threads
+            def decode(numimage):
+                return np.ascontiguousarray(extract(ole, numimage))
+            pool = OrderedThreadPool(self.workers)
+            with pool:
+                for image in pool.imap(decode, range(first, nframes+1)):
+                    yield image
+            print(pool.report())
+        else:
+            # Images read in advance by a thread and decoded here
+            frames = FramePrefetcher(ole_image_reader(ole),
+                                     range(first, nframes+1),
+                                     self.prefetch_depth,
+                                     self.prefetch_memory)
+            with frames:
+                for numimage, data in enumerate(frames):
+                    yield extract(ole, numimage+first, data)
+            print(frames.report())
+
+    # Create the data dataset of the sample images referencing the images
+    # of the txrm file filename, opened as ole, that are contiguous in it;
+    # the fragmented images are copied.
+    def convert_external_frames(self, ole, filename):
+        shape = (self.nSampleFrames, self.numrows, self.numcols)
+        dtype = pixel_dtype(self.datatype)
+        nbytes = self.numrows * self.numcols * dtype.itemsize
+        locations = [frame_location(ole, filename, numimage, nbytes)
+                     for numimage in range(1, self.nSampleFrames + 1)]
+        read = ole_image_reader(ole)
+
+        def read_frame(i):
+            return decode_image(read(i + 1), self.numrows, self.numcols,
+                                self.datatype, flip=False)
+        create_external_dataset(self.nxdetectorsample, "data", locations,
+                                shape, dtype, read_frame,
+                                self.storage)
+        self.set_image_attrs('data')
+        copied = locations.count(None)
+        print('%i images referenced in %s, %i images copied'
+              % (self.nSampleFrames - copied, filename, copied))
+
+    # Attributes of the dataset name of the sample images.
+    def set_image_attrs(self, name):
+        dataset = self.nxdetectorsample[name]
+        dataset.attrs['Data Type'] = self.datatype
+        dataset.attrs['Number of Frames'] = self.nSampleFrames
+        dataset.attrs['Image Height'] = self.numrows
+        dataset.attrs['Image Width'] = self.numcols
+
+    # h5py NeXus link of the dataset name of the sample images in NXdata.
+    def link_image_dataset(self, name):
+        source_addr = '/NXtomo/instrument/sample/' + name
+        self.nxdetectorsample[name].attrs['target'] = source_addr
+        self.nxdata._id.link(source_addr, name, h5py.h5g.LINK_HARD)
+
+    # Sequence numbers of the next nframes images acquired.
+    def next_sequence_numbers(self, nframes):
+        first = self.count_num_sequence + 1
+        self.count_num_sequence += nframes
+        return range(first, self.count_num_sequence + 1)
+
+    # Convert the images first to nframes of a txrm file with writer (see
+    # framewriter). With a pipeline, the images are only added to it, and
+    # they are converted when the pipeline is run.
+    def convert_frames(self, pipeline, ole, nframes, extract, writer, name,
+                       first=1):
+        if pipeline is not None:
+            def decode(numimage, data):
+                return extract(ole, numimage, data)
+            pipeline.add(name, range(first, nframes+1), ole_image_reader(ole),
+                         decode, writer)
+        else:
+            with writer:
+                for image in self.decode_frames(ole, nframes, extract,
+                                                first):
+                    writer.append(image)
+            print('%i %s have been converted\n' % (nframes - first + 1,
+                                                   name))
+
+    # Read the sample images of the txrm file while it is being written by
+    # the microscope. Function that must be called before convert_metadata().
+    def follow_image_stack(self, poll_interval=DEFAULT_POLL_INTERVAL,
+                           idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        Convert each image of the sample txrm file as soon as it has been
+        completely written, re-reading the file every poll_interval seconds.
+        The HDF5 data dataset grows with the converted images. It finishes
+        when all the images announced in ImageInfo/NoOfImages have been
+        converted, or when the file has not changed for idle_timeout seconds.
+        The metadata has to be converted afterwards (convert_metadata and
+        convert_image_stack), when the file is complete.
+        """
+        print("\nFollowing the acquisition of %s" % self.filename_txrm)
+        dataset = None
+        writer = None
+        numimage = 0
+        frame_size = None
+        last_change = time.time()
+        last_state = None
+        while True:
+            try:
+                stat = os.stat(self.filename_txrm)
+                state = (stat.st_size, stat.st_mtime)
+            except OSError:
+                state = None
+            if state != last_state:
+                last_state = state
+                last_change = time.time()
+
+            converted = 0
+            nimages = None
+            try:
+                ole = OleFileIO(self.filename_txrm)
+            except IOError:
+                # not created yet, or the OLE structures are being written
+                ole = None
+            if ole is not None:
+                try:
+                    header = read_header_snapshot(ole)
+                    nimages = header.no_of_images
+                    if dataset is None and header.image_height and \
+                            header.image_width and header.data_type:
+                        self.numrows = np.int(header.image_height)
+                        self.numcols = np.int(header.image_width)
+                        self.datatype = header.data_type
+                        datatype = self.datatype
+                        if datatype == 'float':
+                            datatype = 'float32'
+                        frame_size = (self.numrows * self.numcols *
+                                      np.dtype(datatype).itemsize)
+                    if dataset is None and frame_size is not None and \
+                            ole.get_size(image_stream_name(1)) == frame_size:
+                        # the storage is chosen with the first image
+                        maxshape = (None, self.numrows, self.numcols)
+                        storage = self.storage.tune(
+                            (1, self.numrows, self.numcols), datatype,
+                            lambda i: self.extract_single_image(ole, 1))
+                        dataset = self.nxdetectorsample.create_dataset(
+                            "data",
+                            shape=(0, self.numrows, self.numcols),
+                            maxshape=maxshape,
+                            dtype=datatype,
+                            **storage.options(maxshape, datatype))
+                        writer = self.storage.frame_writer(
+                            dataset, 0, self.write_batch)
+                        print('Image pixels are {0}rows * {1}columns \n'
+                              .format(self.numrows, self.numcols))
+                    while dataset is not None:
+                        # Only the images completely written are converted
+                        img_string = image_stream_name(numimage+1)
+                        if ole.get_size(img_string) != frame_size:
+                            break
+                        data = stream_data(ole.openstream(img_string))
+                        if len(data) != frame_size:
+                            break
+                        writer.append(self.extract_single_image(
+                            ole, numimage+1, data))
+                        if numimage % 10 == 0:
+                            print('Image %i converted' % numimage)
+                        numimage += 1
+                        converted += 1
+                except IOError:
+                    # the image sectors have not been written yet
+                    pass
+                finally:
+                    ole.close()
+
+            if converted:
+                last_change = time.time()
+                writer.flush()
+                self.txrmhdf.flush()
+            if dataset is not None and nimages is not None and \
+                    numimage >= nimages:
+                break
+            if time.time() - last_change > idle_timeout:
+                print('WARNING: %s has not changed for %i seconds'
+                      % (self.filename_txrm, idle_timeout))
+                break
+            if not converted:
+                time.sleep(poll_interval)
+
+        if dataset is None:
+            print('No image of %s could be converted' % self.filename_txrm)
             return
-             
-        singleimage = np.flipud(np.reshape(imgdata, (self.numrows_dark,
-                                                     self.numcols_dark),
-                                           order='A'))
-        singleimage = np.reshape(singleimage,
-                                 (1, self.numrows_dark, self.numcols_dark),
-                                 order='A')
-        return singleimage
+
+        self.followed_frames = numimage
+        dataset.attrs['Data Type'] = dataset.dtype.name
+        dataset.attrs['Number of Frames'] = numimage
+        dataset.attrs['Image Height'] = self.numrows
+        dataset.attrs['Image Width'] = self.numcols
+
+        # h5py NeXus link
+        source_addr = '/NXtomo/instrument/sample/data'
+        target_addr = 'data'
+        dataset.attrs['target'] = source_addr
+        self.nxdata._id.link(source_addr, target_addr, h5py.h5g.LINK_HARD)
+        self.txrmhdf.flush()
+        print('%i images have been converted\n' % numimage)
 
     # Function used to convert all the images (main data),
     # from .txrm to NeXus .hdf5.
@@ -786,74 +800,98 @@ class txrmNXtomo:
             counter_bright_frames = 0
             counter_dark_frames = 0
             print(self.orderlist)
+            pipeline = None
+            if self.pipeline_workers > 0:
+                pipeline = ConversionPipeline(self.pipeline_workers,
+                                              max_bytes=self.prefetch_memory)
+            # The files are closed once all the images are converted
+            oles = []
             for i in range(len(self.orderlist)):
 
                 ole = OleFileIO(self.files[i])
+                oles.append(ole)
+
+                # Data Images already converted by follow_image_stack()
+                if self.orderlist[i] == 's' and \
+                        self.followed_frames is not None:
+                    if self.followed_frames < self.nSampleFrames:
+                        # the acquisition was considered finished before
+                        # the last images were written: they are converted
+                        # now, before the sinograms are computed
+                        self.convert_frames(
+                            None, ole, self.nSampleFrames,
+                            self.extract_single_image,
+                            self.storage.frame_writer(
+                                self.nxdetectorsample['data'],
+                                self.followed_frames, self.write_batch),
+                            'remaining images', self.followed_frames + 1)
+                        self.followed_frames = self.nSampleFrames
+                        self.set_image_attrs('data')
+                    elif self.followed_frames > self.nSampleFrames:
+                        print('WARNING: %i images have been converted but '
+                              'the txrm file has %i' % (self.followed_frames,
+                                                        self.nSampleFrames))
+                    self.num_sample_sequence.extend(
+                        self.next_sequence_numbers(self.followed_frames))
+                    # the sinograms of the images converted
+                    if self.sinogram is not None:
+                        data = self.nxdetectorsample['data']
+                        sinogram = write_sinograms(
+                            data, self.nxdetectorsample, 'sinogram',
+                            self.storage, self.sinogram_memory)
+                        for key in ('Data Type', 'Number of Frames',
+                                    'Image Height', 'Image Width'):
+                            sinogram.attrs[key] = data.attrs[key]
+                        self.link_image_dataset('sinogram')
 
                 # Data Images
-                if self.orderlist[i] == 's':
+                elif self.orderlist[i] == 's':
                     if self.datatype == 'float':
                         self.datatype = 'float32'
 
-                    self.nxdetectorsample.create_dataset(
-                        "data",
-                        shape=(self.nSampleFrames,
-                               self.numrows,
-                               self.numcols),
-                        chunks=(1,
-                                self.numrows,
-                                self.numcols),
-                        dtype=self.datatype)
-
-                    self.nxdetectorsample['data'].attrs[
-                        'Data Type'] = self.datatype
-                    self.nxdetectorsample[
-                        'data'].attrs['Number of Frames'] = self.nSampleFrames
-                    self.nxdetectorsample['data'].attrs[
-                        'Image Height'] = self.numrows
-                    self.nxdetectorsample['data'].attrs[
-                        'Image Width'] = self.numcols
+                    shape = (self.nSampleFrames, self.numrows, self.numcols)
+                    frame = lambda i: self.extract_single_image(ole, i+1)
+                    writers = []
+                    if self.external:
+                        self.convert_external_frames(ole, self.files[i])
+                    elif self.sinogram != 'only':
+                        self.storage.create_dataset(
+                            self.nxdetectorsample, "data", shape,
+                            self.datatype, frame)
+                        self.set_image_attrs('data')
+                        writers.append(self.storage.frame_writer(
+                            self.nxdetectorsample['data'], 0,
+                            self.write_batch))
+                    if self.sinogram is not None:
+                        writers.append(SinogramWriter(
+                            self.nxdetectorsample, 'sinogram', shape,
+                            self.datatype, self.storage, frame,
+                            self.sinogram_memory))
+                        self.set_image_attrs('sinogram')
 
                     print('Image pixels are {0}rows * {1}columns \n'.format(
                         self.numrows, self.numcols))
-                    for numimage in range(self.nSampleFrames):
-                        self.count_num_sequence = self.count_num_sequence+1
-                        tomoimagesingle = self.extract_single_image(ole,
-                                                                    numimage+1)
-                        self.num_sample_sequence.append(
-                            self.count_num_sequence)
-                        self.nxdetectorsample['data'][numimage] = \
-                            tomoimagesingle
-                        if numimage % 10 == 0:
-                            print('Image %i converted' % numimage)
-
-                    # h5py NeXus link
-                    source_addr = '/NXtomo/instrument/sample/data'
-                    target_addr = 'data'
-                    self.nxdetectorsample['data'].attrs[
-                        'target'] = source_addr
-                    self.nxdata._id.link(source_addr, target_addr,
-                                         h5py.h5g.LINK_HARD)
-                    ole.close()
-                    print('%i images have been converted\n'
-                          % self.nSampleFrames)
+                    if writers:
+                        self.convert_frames(pipeline, ole, self.nSampleFrames,
+                                            self.extract_single_image,
+                                            TeeWriter(*writers), 'images')
+                    self.num_sample_sequence.extend(
+                        self.next_sequence_numbers(self.nSampleFrames))
+
+                    # h5py NeXus links
+                    for name in ('data', 'sinogram'):
+                        if name in self.nxdetectorsample:
+                            self.link_image_dataset(name)
 
                 # Bright-Field
                 elif self.orderlist[i] == 'b':
                     count_brightfield_file = count_brightfield_file+1
+                    header = read_header_snapshot(ole)
                     
                     # DataType_bright: 10 float; 5 uint16
                     # (unsigned 16-bit (2-byte) integers)
-                    if ole.exists('ImageInfo/DataType'):                  
-                        stream = ole.openstream('ImageInfo/DataType')
-                        data = stream.read()
-                        struct_fmt = '<1I'
-                        datatype_bright = struct.unpack(struct_fmt, data)
-                        datatype_bright = int(datatype_bright[0])
-                        if datatype_bright == 5:
-                            self.datatype_bright = 'uint16'
-                        else:
-                            self.datatype_bright = 'float'
+                    if header.data_type is not None:
+                        self.datatype_bright = header.data_type
                         if verbose: 
                             print "ImageInfo/DataType: %s " % \
                                   self.datatype_bright
@@ -862,31 +900,22 @@ class txrmNXtomo:
                               "BrightField DataType")
 
                     # Image stack data size
-                    if (ole.exists('ImageInfo/NoOfImages') and 
-                        ole.exists('ImageInfo/ImageWidth') and 
-                        ole.exists('ImageInfo/ImageHeight')):                  
-                                
-                        stream = ole.openstream('ImageInfo/NoOfImages')
-                        data = stream.read()
-                        nimages = struct.unpack('<I', data)
+                    if (header.no_of_images is not None and 
+                        header.image_width is not None and 
+                        header.image_height is not None):
+
+                        nBrightFrames = np.int(header.no_of_images)
                         if verbose: 
-                            print "ImageInfo/NoOfImages = %i" % nimages[0] 
-                        nBrightFrames = np.int(nimages[0])
+                            print "ImageInfo/NoOfImages = %i" % nBrightFrames
                     
                         if count_brightfield_file == 1:
-                            stream = ole.openstream('ImageInfo/ImageHeight')
-                            data = stream.read()
-                            ximage = struct.unpack('<I', data)    
+                            self.numrows_bright = np.int(header.image_height)
+                            self.numcols_bright = np.int(header.image_width)
                             if verbose: 
-                                print "ImageInfo/ImageHeight = %i" % ximage[0]  
-                            self.numrows_bright = np.int(ximage[0])
-                            
-                            stream = ole.openstream('ImageInfo/ImageWidth')
-                            data = stream.read()
-                            yimage = struct.unpack('<I', data)
-                            if verbose: 
-                                print "ImageInfo/ImageWidth = %i" % yimage[0]  
-                            self.numcols_bright = np.int(yimage[0])
+                                print "ImageInfo/ImageHeight = %i" % \
+                                      self.numrows_bright
+                                print "ImageInfo/ImageWidth = %i" % \
+                                      self.numcols_bright
 
                     else:
                         print('There is no information about the bright field'
@@ -897,15 +926,15 @@ class txrmNXtomo:
                         self.nxbright = self.nxinstrument.create_group(
                             "bright_field")
                         self.nxbright.attrs['NX_class'] = "Unknown"
-                        self.nxbright.create_dataset(
+                        self.storage.create_dataset(
+                            self.nxbright,
                             "data",
-                            shape=(nBrightFrames,
-                                   self.numrows_bright,
-                                   self.numcols_bright),
-                            chunks=(1,
-                                    self.numrows_bright,
-                                    self.numcols_bright),
-                            dtype=self.datatype_bright)
+                            (nBrightFrames,
+                             self.numrows_bright,
+                             self.numcols_bright),
+                            self.datatype_bright,
+                            lambda i: self.extract_single_image_bright(
+                                ole, i+1))
                         self.nxbright['data'].attrs['Data Type'] = \
                             self.datatype_bright
                         self.nxbright['data'].attrs['Image Height'] = \
@@ -916,48 +945,33 @@ class txrmNXtomo:
                     print('BrightField pixels are {0}rows * '
                           '{1}columns'.format(self.numrows_bright,
                                               self.numcols_bright))
-                    for numimage in range(nBrightFrames):
-                        if numimage + 1 == nBrightFrames:
-                            print ('%i Bright-Field images '
-                                   'converted\n' % nBrightFrames)
-                        self.count_num_sequence = self.count_num_sequence + 1
-                        tomoimagebright = self.extract_single_image_bright(
-                            ole, numimage+1)
-                        self.num_bright_sequence.append(
-                            self.count_num_sequence)
-                        self.nxbright['data'][counter_bright_frames] = \
-                            tomoimagebright
-                        counter_bright_frames = counter_bright_frames+1
+                    self.convert_frames(pipeline, ole, nBrightFrames,
+                                        self.extract_single_image_bright,
+                                        self.storage.frame_writer(
+                                            self.nxbright['data'],
+                                            counter_bright_frames,
+                                            self.write_batch),
+                                        'Bright-Field images')
+                    self.num_bright_sequence.extend(
+                        self.next_sequence_numbers(nBrightFrames))
+                    counter_bright_frames += nBrightFrames
+
+                    # Positions of all the motors for each FF image
+                    if header.motors is not None:
+                        write_motor_table(self.nxbright, header.motors,
+                                          header.motor_names)
 
                     # machine_current name of FF images #
-                    if ole.exists('PositionInfo/AxisNames'):   
-                        stream = ole.openstream('PositionInfo/AxisNames')
-                        data = stream.read()
-                        lendatabytes = len(data)
-                        formatstring = '<'+str(lendatabytes)+'c'
-                        struct_fmt = formatstring
-                        axis_names_raw = struct.unpack(struct_fmt, data)
-                        axis_names_raw = ''.join(axis_names_raw)
-                        axis_names_raw = axis_names_raw.replace("\x00", " ")
-                        axis_names = re.split('\s+\s+', axis_names_raw)
-                        current_name_FF = axis_names[28]   
+                    if header.axis_names is not None:
+                        current_name_FF = header.axis_names[28]
 
                     # Accelerator current for each image of FF
                     # (machine current)
                     if current_name_FF == "machine_current":
-                        if ole.exists('PositionInfo/MotorPositions'):   
-                            stream = ole.openstream(
-                                'PositionInfo/MotorPositions')
-                            number_of_floats = self.num_axis*nBrightFrames
-                            struct_fmt = '<'+str(number_of_floats)+'f'
-                            # 4 bytes every float
-                            number_of_bytes = number_of_floats * 4
-                            data = stream.read(number_of_bytes)
-                            axis = struct.unpack(struct_fmt, data)
-                            currents_FF = nBrightFrames*[0]
-                            for i in range(nBrightFrames):
-                                # In mA
-                                currents_FF[i] = axis[self.num_axis*i+28]
+                        if header.motors is not None:
+                            # In mA
+                            currents_FF = header.motor_values(28,
+                                                              nBrightFrames)
                             self.nxbright.create_dataset(
                                 "current", data=currents_FF)
                             self.nxbright["current"].attrs["units"] = "mA"
@@ -970,24 +984,8 @@ class txrmNXtomo:
                               "machine_current.")
 
                     # Exposure Times            	
-                    if ole.exists('ImageInfo/ExpTimes'):
-                        stream = ole.openstream('ImageInfo/ExpTimes')
-                        data = stream.read()
-                        struct_fmt = "<{0:10}f".format(nBrightFrames)
-                        # Found some txrm images (flatfields) with
-                        # different encoding of data
-                        try:
-                            exptimes = struct.unpack(struct_fmt, data)
-                        except struct.error:
-                            print >> sys.stderr, 'Unexpected data length ' \
-                                                 '(%i bytes). ' \
-                                                 'Trying to unpack ' \
-                                                 'exposure times with: ' \
-                                                 '"f"+"36xf"*' \
-                                                 '(nBrightFrames-1)' \
-                                                 % len(data)
-                            struct_fmt = '<'+"f"+"36xf"*(nBrightFrames-1)
-                            exptimes = struct.unpack(struct_fmt, data)
+                    if header.exp_times is not None:
+                        exptimes = header.exp_times
                         if verbose: print "ImageInfo/ExpTimes: \n ",  exptimes
                         self.nxbright.create_dataset(
                             "ExpTimes", data=exptimes)
@@ -996,25 +994,16 @@ class txrmNXtomo:
                         print('There is no information about the '
                               'exposure times with which have been taken '
                               'the different images')
-   
-                    ole.close()
 
                 # Post-Dark-Field
                 elif self.orderlist[i] == 'd':
                     count_darkfield_file = count_darkfield_file+1
+                    header = read_header_snapshot(ole)
 
                     # DataType_dark: 10 float; 5 uint16
                     # (unsigned 16-bit (2-byte) integers)
-                    if ole.exists('ImageInfo/DataType'):                  
-                        stream = ole.openstream('ImageInfo/DataType')
-                        data = stream.read()
-                        struct_fmt = '<1I'
-                        datatype_dark = struct.unpack(struct_fmt, data)
-                        datatype_dark = int(datatype_dark[0])
-                        if datatype_dark == 5:
-                            self.datatype_dark = 'uint16'
-                        else:
-                            self.datatype_dark = 'float'
+                    if header.data_type is not None:
+                        self.datatype_dark = header.data_type
                         if verbose: 
                             print "ImageInfo/DataType: %s " % \
                                   self.datatype_dark
@@ -1023,31 +1012,22 @@ class txrmNXtomo:
                               "DarkField DataType")
 
                     # Image stack data size
-                    if (ole.exists('ImageInfo/NoOfImages') and 
-                        ole.exists('ImageInfo/ImageWidth') and 
-                        ole.exists('ImageInfo/ImageHeight')):                  
-                                
-                        stream = ole.openstream('ImageInfo/NoOfImages')
-                        data = stream.read()
-                        nimages = struct.unpack('<I', data)
+                    if (header.no_of_images is not None and 
+                        header.image_width is not None and 
+                        header.image_height is not None):
+
+                        nDarkFrames = np.int(header.no_of_images)
                         if verbose: 
-                            print "ImageInfo/NoOfImages = %i" % nimages[0] 
-                        nDarkFrames = np.int(nimages[0])
+                            print "ImageInfo/NoOfImages = %i" % nDarkFrames
                     
                         if count_darkfield_file == 1:
-                            stream = ole.openstream('ImageInfo/ImageHeight')
-                            data = stream.read()
-                            ximage = struct.unpack('<I', data)    
-                            if verbose: 
-                                print "ImageInfo/ImageHeight = %i" % ximage[0]  
-                            self.numrows_dark = np.int(ximage[0])
-                            
-                            stream = ole.openstream('ImageInfo/ImageWidth')
-                            data = stream.read()
-                            yimage = struct.unpack('<I', data)
+                            self.numrows_dark = np.int(header.image_height)
+                            self.numcols_dark = np.int(header.image_width)
                             if verbose: 
-                                print "ImageInfo/ImageWidth = %i" % yimage[0]  
-                            self.numcols_dark = np.int(yimage[0])
+                                print "ImageInfo/ImageHeight = %i" % \
+                                      self.numrows_dark
+                                print "ImageInfo/ImageWidth = %i" % \
+                                      self.numcols_dark
 
                     else:
                         print('There is no information about the '
@@ -1058,15 +1038,15 @@ class txrmNXtomo:
                         self.nxdark = self.nxinstrument.create_group(
                             "dark_field")
                         self.nxdark.attrs['NX_class'] = "Unknown"
-                        self.nxdark.create_dataset(
+                        self.storage.create_dataset(
+                            self.nxdark,
                             "data",
-                            shape=(nDarkFrames,
-                                   self.numrows_dark,
-                                   self.numcols_dark),
-                            chunks=(1,
-                                    self.numrows_dark,
-                                    self.numcols_dark),
-                            dtype=self.datatype_dark)
+                            (nDarkFrames,
+                             self.numrows_dark,
+                             self.numcols_dark),
+                            self.datatype_dark,
+                            lambda i: self.extract_single_image_dark(
+                                ole, i+1))
 
                         self.nxdark['data'].attrs['Data Type'] = \
                             self.datatype_dark
@@ -1078,46 +1058,32 @@ class txrmNXtomo:
                     print('DarkField pixels are {0}rows * '
                           '{1}columns'.format(self.numrows_dark,
                                               self.numcols_dark))
-                    for numimage in range(nDarkFrames):
-                        if numimage + 1 == nDarkFrames:
-                            print ('%i Dark-Field images '
-                                   'converted\n' % nDarkFrames)
-                        self.count_num_sequence = self.count_num_sequence+1
-                        tomoimagedark = self.extract_single_image_dark(
-                            ole, numimage+1)
-                        self.num_dark_sequence.append(self.count_num_sequence)
-                        self.nxdark['data'][counter_dark_frames] = \
-                            tomoimagedark
+                    self.convert_frames(pipeline, ole, nDarkFrames,
+                                        self.extract_single_image_dark,
+                                        self.storage.frame_writer(
+                                            self.nxdark['data'],
+                                            counter_dark_frames,
+                                            self.write_batch),
+                                        'Dark-Field images')
+                    self.num_dark_sequence.extend(
+                        self.next_sequence_numbers(nDarkFrames))
+                    counter_dark_frames += nDarkFrames
+
+                    # Positions of all the motors for each DF image
+                    if header.motors is not None:
+                        write_motor_table(self.nxdark, header.motors,
+                                          header.motor_names)
 
                     # machine_current name of DF images #
-                    if ole.exists('PositionInfo/AxisNames'):   
-                        stream = ole.openstream('PositionInfo/AxisNames')
-                        data = stream.read()
-                        lendatabytes=len(data)
-                        formatstring='<'+str(lendatabytes)+'c'
-                        struct_fmt = formatstring
-                        axis_names_raw = struct.unpack(struct_fmt, data)
-                        axis_names_raw = ''.join(axis_names_raw)
-                        axis_names_raw = axis_names_raw.replace("\x00", " ")
-                        axis_names = re.split('\s+\s+', axis_names_raw)
-                        current_name_DF = axis_names[28]   
+                    if header.axis_names is not None:
+                        current_name_DF = header.axis_names[28]
 
                     # Accelerator current for each image of DF
                     # (machine current)
                     if current_name_DF == "machine_current":
-                        if ole.exists('PositionInfo/MotorPositions'):   
-                            stream = ole.openstream(
-                                'PositionInfo/MotorPositions')
-                            number_of_floats= self.num_axis*nDarkFrames
-                            struct_fmt = '<'+str(number_of_floats)+'f'
-                            # 4 bytes every float
-                            number_of_bytes = number_of_floats * 4
-                            data = stream.read(number_of_bytes)
-                            axis = struct.unpack(struct_fmt, data)
-                            currents_DF = nDarkFrames*[0]
-                            for i in range(nDarkFrames):
-                                # In mA
-                                currents_DF[i] = axis[self.num_axis*i+28]
+                        if header.motors is not None:
+                            # In mA
+                            currents_DF = header.motor_values(28, nDarkFrames)
                             self.nxdark.create_dataset(
                                 "current", data=currents_DF)
                             self.nxdark["current"].attrs["units"] = "mA"
@@ -1130,23 +1096,8 @@ class txrmNXtomo:
                               "machine_current.")
 
                     # Exposure Times
-                    if ole.exists('ImageInfo/ExpTimes'):
-                        stream = ole.openstream('ImageInfo/ExpTimes')
-                        data = stream.read()
-                        struct_fmt = "<{0:10}f".format(nDarkFrames)
-                        # Found some txrm images (flatfields)
-                        # with different encoding of data
-                        try:
-                            exptimes = struct.unpack(struct_fmt, data)
-                        except struct.error:
-                            print >> sys.stderr, 'Unexpected data length ' \
-                                                 '(%i bytes). ' \
-                                                 'Trying to unpack ' \
-                                                 'exposure times with: ' \
-                                                 '"f"+"36xf"*(nDarkFrames-1)'\
-                                                 % len(data)
-                            struct_fmt = '<'+"f"+"36xf"*(nDarkFrames-1)
-                            exptimes = struct.unpack(struct_fmt, data)
+                    if header.exp_times is not None:
+                        exptimes = header.exp_times
                         if verbose: print "ImageInfo/ExpTimes: \n ",  exptimes
                         self.nxdark.create_dataset(
                             "ExpTimes", data=exptimes)
@@ -1155,7 +1106,13 @@ class txrmNXtomo:
                         print('There is no information about the '
                               'exposure times with which have been taken '
                               'the different images')
-                    ole.close()
+
+            # The images of all the files flow together through the pipeline
+            if pipeline is not None:
+                pipeline.run()
+                print(pipeline.report())
+            for ole in oles:
+                ole.close()
 
             self.nxdetectorsample['sequence_number'] = \
                 self.num_sample_sequence
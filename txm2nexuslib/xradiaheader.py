@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2014 Marc Rosanes
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import sys
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+
+SAMPLE_ID = 'SampleInfo/SampleID'
+AXIS_NAMES = 'PositionInfo/AxisNames'
+MOTOR_POSITIONS = 'PositionInfo/MotorPositions'
+DET_ZERO = 'ConfigureBackup/ConfigCamera/Camera 1/ConfigZonePlates/DetZero'
+PIXEL_SIZE = 'ImageInfo/PixelSize'
+XRAY_MAGNIFICATION = 'ImageInfo/XrayMagnification'
+NO_OF_IMAGES = 'ImageInfo/NoOfImages'
+IMAGE_HEIGHT = 'ImageInfo/ImageHeight'
+IMAGE_WIDTH = 'ImageInfo/ImageWidth'
+DATA_TYPE = 'ImageInfo/DataType'
+CURRENT = 'ImageInfo/Current'
+ENERGY = 'ImageInfo/Energy'
+EXP_TIMES = 'ImageInfo/ExpTimes'
+ANGLES = 'ImageInfo/Angles'
+X_POSITION = 'ImageInfo/XPosition'
+Y_POSITION = 'ImageInfo/YPosition'
+Z_POSITION = 'ImageInfo/ZPosition'
+DATE = 'ImageInfo/Date'
+
+# Records of the Date stream: 'mm/dd/yy hh:mm:ss' and 23 padding bytes
+DATE_DTYPE = np.dtype([('date', 'S17'), ('padding', 'V23')])
+# Positions of the fields of the dates (month, day, year, hour, minute,
+# second) and of their separators
+_DATE_FIELDS = (0, 3, 6, 9, 12, 15)
+_DATE_SEPARATORS = ((2, '/'), (5, '/'), (8, ' '), (11, ':'), (14, ':'))
+
+HEADER_STREAMS = (SAMPLE_ID, AXIS_NAMES, MOTOR_POSITIONS, DET_ZERO,
+                  PIXEL_SIZE, XRAY_MAGNIFICATION, NO_OF_IMAGES, IMAGE_HEIGHT,
+                  IMAGE_WIDTH, DATA_TYPE, CURRENT, ENERGY, EXP_TIMES, ANGLES,
+                  X_POSITION, Y_POSITION, Z_POSITION, DATE)
+
+
+class HeaderSnapshot(namedtuple('HeaderSnapshot', [
+        'sample_id', 'axis_names', 'num_axes', 'motors',
+        'det_zero', 'pixel_size', 'xray_magnification', 'no_of_images',
+        'image_height', 'image_width', 'data_type', 'current', 'energies',
+        'exp_times', 'angles', 'x_positions', 'y_positions', 'z_positions',
+        'dates'])):
+    """
+    Metadata of a txrm/xrm file, decoded once by read_header_snapshot().
+
+    Fields are None when the corresponding stream does not exist in the
+    file. Per-image values (energies, exp_times, angles and positions) are
+    read-only float64 numpy arrays, dates is a read-only array of
+    'mm/dd/yy hh:mm:ss' strings. motors is the motor table (see
+    motor_table).
+    """
+    __slots__ = ()
+
+    @property
+    def timestamps(self):
+        """datetime64 of the dates of the images (see parse_dates)"""
+        if self.dates is None:
+            return None
+        return parse_dates(self.dates)
+
+    @property
+    def motor_names(self):
+        """Names of the columns of the motor table"""
+        if self.axis_names is None:
+            return None
+        return self.axis_names[:self.num_axes]
+
+    def motor_values(self, axis, count=None):
+        """
+        Return the positions (float64) of one motor axis, given by its
+        column or its name, for the first count images (all the images of
+        the file by default).
+        """
+        if count is None:
+            count = self.no_of_images
+        if isinstance(axis, basestring):
+            axis = self.motor_names.index(axis)
+        if len(self.motors) < count:
+            raise ValueError("%s has less than %d images" %
+                             (MOTOR_POSITIONS, count))
+        return self.motors[:count, axis].astype(np.float64)
+
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+def _decode_frames(name, data, nframes):
+    """
+    Decode a stream with one float per image. Some files (flatfields) store
+    each float in a 40 bytes record: "f"+"36xf"*(nframes-1).
+    """
+    if len(data) == 4 * nframes:
+        values = np.frombuffer(data, dtype='<f4')
+    elif nframes > 0 and len(data) == 40 * nframes - 36:
+        print >> sys.stderr, 'Unexpected data length (%i bytes). ' \
+                             'Unpacking %s with: ' \
+                             '"f"+"36xf"*(nFrames-1)' % (len(data), name)
+        values = np.frombuffer(data + '\0' * 36,
+                               dtype='<f4').reshape(nframes, 10)[:, 0]
+    else:
+        print >> sys.stderr, 'Unexpected data length (%i bytes) of %s for ' \
+                             '%i images' % (len(data), name, nframes)
+        return None
+    return _read_only(values.astype(np.float64))
+
+
+def motor_table(data, num_axes):
+    """
+    Decode a MotorPositions stream in a read-only float32 (nFrames, nAxes)
+    array with the positions of the num_axes motors for each image. Without
+    num_axes (no AxisNames), it has one row with all the positions.
+    """
+    values = np.frombuffer(data[:len(data) - len(data) % 4], dtype='<f4')
+    if not num_axes:
+        return _read_only(values.reshape(1, -1))
+    rows = len(values) // num_axes
+    return _read_only(values[:rows * num_axes].reshape(rows, num_axes))
+
+
+def write_motor_table(group, motors, names, name='motor_positions'):
+    """
+    Write the motor table motors as the 2-D dataset name of group, with the
+    names of its columns in the attribute 'axis_names' (if names is not
+    None).
+    """
+    dataset = group.create_dataset(name, data=motors)
+    if names is not None:
+        dataset.attrs['axis_names'] = np.array(names, dtype='S')
+    return dataset
+
+
+def parse_dates(dates):
+    """
+    Convert an array of 'mm/dd/yy hh:mm:ss' dates (years 2000-2099) to
+    datetime64[s], without a loop over the dates.
+    """
+    dates = np.ascontiguousarray(dates, dtype='S17')
+    chars = dates.view(np.uint8).reshape(len(dates), 17)
+    digits = chars.astype(np.int64) - ord('0')
+    wrong = np.zeros(len(dates), dtype=bool)
+    for position, separator in _DATE_SEPARATORS:
+        wrong |= chars[:, position] != ord(separator)
+    for field in _DATE_FIELDS:
+        wrong |= np.any((digits[:, field:field + 2] < 0) |
+                        (digits[:, field:field + 2] > 9), axis=1)
+    if np.any(wrong):
+        raise ValueError("Wrong date format: %s" % dates[wrong][0])
+    month, day, year, hour, minute, second = [
+        digits[:, field] * 10 + digits[:, field + 1]
+        for field in _DATE_FIELDS]
+    timestamps = ((year + 30).astype('M8[Y]') +
+                  (month - 1).astype('m8[M]')).astype('M8[D]')
+    return (timestamps + (day - 1).astype('m8[D]') +
+            hour.astype('m8[h]') + minute.astype('m8[m]') +
+            second.astype('m8[s]'))
+
+
+def iso_time(timestamp):
+    """ISO 8601 string (yyyy-mm-ddThh:mm:ss) of a datetime64"""
+    return str(np.datetime_as_string(timestamp.astype('M8[s]')))
+
+
+def write_timestamps(group, timestamps, name='timestamp'):
+    """
+    Write the datetime64 timestamps as the dataset name of group: seconds
+    since 1970-01-01T00:00:00 (the dates of the files have no time zone).
+    """
+    seconds = timestamps.astype('M8[s]').astype(np.int64)
+    dataset = group.create_dataset(name, data=seconds)
+    dataset.attrs['units'] = 's'
+    dataset.attrs['epoch'] = '1970-01-01T00:00:00'
+    return dataset
+
+
+def read_header_snapshot(ole):
+    """
+    Read all the known metadata streams of a txrm/xrm file in one pass (the
+    MiniStream is loaded once, see OleFileIO.readstreams) and decode them in
+    a HeaderSnapshot.
+
+    ole: OleFileIO object of the txrm/xrm file
+    """
+    streams = ole.readstreams(HEADER_STREAMS)
+
+    def unpack(name, fmt):
+        # only the first bytes are decoded, as with stream.read(4):
+        if name not in streams:
+            return None
+        return struct.unpack(fmt, streams[name][:struct.calcsize(fmt)])[0]
+
+    sample_id = unpack(SAMPLE_ID, '<50s')
+
+    axis_names = None
+    num_axes = None
+    if AXIS_NAMES in streams:
+        axis_names_raw = streams[AXIS_NAMES].replace("\x00", " ")
+        axis_names = tuple(re.split('\s+\s+', axis_names_raw))
+        num_axes = len(axis_names) - 1
+
+    motors = None
+    if MOTOR_POSITIONS in streams:
+        motors = motor_table(streams[MOTOR_POSITIONS], num_axes)
+
+    det_zero = None
+    if DET_ZERO in streams:
+        det_zero = 0
+        if len(streams[DET_ZERO]) != 0:
+            det_zero = unpack(DET_ZERO, '<1f')
+
+    data_type = unpack(DATA_TYPE, '<1I')
+    if data_type is not None:
+        # DataType: 10 float; 5 uint16 (unsigned 16-bit (2-byte) integers)
+        if data_type == 5:
+            data_type = 'uint16'
+        else:
+            data_type = 'float'
+
+    no_of_images = unpack(NO_OF_IMAGES, '<I')
+    nframes = no_of_images or 0
+    frames = {}
+    for name in (ENERGY, EXP_TIMES, ANGLES, X_POSITION, Y_POSITION,
+                 Z_POSITION):
+        if name in streams:
+            frames[name] = _decode_frames(name, streams[name], nframes)
+        else:
+            frames[name] = None
+
+    dates = None
+    if DATE in streams:
+        if len(streams[DATE]) == DATE_DTYPE.itemsize * nframes:
+            dates = _read_only(np.frombuffer(streams[DATE], dtype=DATE_DTYPE,
+                                             count=nframes)['date'])
+        else:
+            print >> sys.stderr, 'Unexpected data length (%i bytes) of %s ' \
+                                 'for %i images' % (len(streams[DATE]), DATE,
+                                                    nframes)
+
+    return HeaderSnapshot(
+        sample_id=sample_id,
+        axis_names=axis_names,
+        num_axes=num_axes,
+        motors=motors,
+        det_zero=det_zero,
+        pixel_size=unpack(PIXEL_SIZE, '<1f'),
+        xray_magnification=unpack(XRAY_MAGNIFICATION, '<1f'),
+        no_of_images=no_of_images,
+        image_height=unpack(IMAGE_HEIGHT, '<I'),
+        image_width=unpack(IMAGE_WIDTH, '<I'),
+        data_type=data_type,
+        current=unpack(CURRENT, '<1f'),
+        energies=frames[ENERGY],
+        exp_times=frames[EXP_TIMES],
+        angles=frames[ANGLES],
+        x_positions=frames[X_POSITION],
+        y_positions=frames[Y_POSITION],
+        z_positions=frames[Z_POSITION],
+        dates=dates)
@@ -21,14 +21,22 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
 from OleFileIO_PL import *
+from xradiaheader import (read_header_snapshot, write_motor_table,
+                          write_timestamps, iso_time)
+from imagedecode import decode_image
+from pipeline import ConversionPipeline
+from processpool import OrderedProcessPool
+from storage import DatasetStorage
+from prefetch import (FramePrefetcher, stream_data, DEFAULT_PREFETCH_DEPTH,
+                      DEFAULT_PREFETCH_MEMORY)
 import numpy as np
 import h5py
 import sys
-import struct
-import datetime
 import argparse
-import re
+import threading
 import pkg_resources
+from collections import OrderedDict
+from contextlib import contextmanager
 
 
 
@@ -60,17 +68,7 @@ class XradiaFile(object):
     def __init__(self, file_name):
         self.file_name = file_name
         self.file = None
-        self._axes_names = None
-        self._no_of_images = None
-        self._no_of_axes = None
-        self._energyenc_name = None
-        self._image_width = None
-        self._image_height = None
-        self._data_type = None
-        self._det_zero = None
-        self._pixel_size = None
-        self._dates = None
-        self._axes_positions = None
+        self._header = None
 
     def __enter__(self):
         self.open()
@@ -84,6 +82,7 @@ class XradiaFile(object):
 
     def open(self):
         self.file = OleFileIO(self.file_name)
+        self._header = None
 
     def close(self):
         self.file.close()
@@ -91,35 +90,27 @@ class XradiaFile(object):
     def exists(self, field):
         return self.file.exists(field)
 
+    def get_header(self):
+        # all the metadata streams are read at the first access:
+        if self._header is None:
+            self._header = read_header_snapshot(self.file)
+        return self._header
+
+    header = property(get_header)
+
     @validate_getter(["SampleInfo/SampleID"])
     def get_sample_id(self):
-        stream = self.file.openstream('SampleInfo/SampleID')
-        data = stream.read()
-        struct_fmt = '<' + '50s'
-        sample_id = struct.unpack(struct_fmt, data)
-        if sample_id != 'Unknown':
-            sample_id = sample_id[0]
-        return sample_id
+        return self.header.sample_id
 
     @validate_getter(["ImageInfo/PixelSize"])
     def get_pixel_size(self):
-        if self._pixel_size is None:
-            stream = self.file.openstream('ImageInfo/PixelSize')
-            data = stream.read()
-            struct_fmt = '<1f'
-            pixel_size = struct.unpack(struct_fmt, data)
-            self._pixel_size = pixel_size[0]
-        return self._pixel_size
+        return self.header.pixel_size
 
     pixel_size = property(get_pixel_size)
 
     @validate_getter(["ImageInfo/XrayMagnification"])
     def get_xray_magnification(self):
-        stream = self.file.openstream('ImageInfo/XrayMagnification')
-        data = stream.read(4)
-        struct_fmt = '<1f'
-        xray_magnification = struct.unpack(struct_fmt, data)
-        xray_magnification = xray_magnification[0]
+        xray_magnification = self.header.xray_magnification
         if (xray_magnification != 0.0):
             pass
         elif (xray_magnification == 0.0 and self.pixel_size != 0.0):
@@ -132,12 +123,7 @@ class XradiaFile(object):
 
     @validate_getter(["PositionInfo/MotorPositions"])
     def get_axes_positions(self):
-        if self._axes_positions is None:
-            stream = self.file.openstream('PositionInfo/MotorPositions')
-            data = stream.read(112)
-            struct_fmt = '<28f'
-            self._axes_positions = struct.unpack(struct_fmt, data)
-        return self._axes_positions
+        return self.header.motors[0, :28].astype(np.float64)
 
     axes_positions = property(get_axes_positions)
 
@@ -161,40 +147,14 @@ class XradiaFile(object):
     @validate_getter(["ImageData1/Image1"])
     def get_image(self):
         stream = self.file.openstream('ImageData1/Image1')
-        data = stream.read()
-
-        if self.data_type == 'uint16':
-            struct_fmt = "<{0:10}H".format(
-                self.image_height * self.image_width)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.data_type == 'float':
-            struct_fmt = "<{0:10}f".format(
-                self.image_height * self.image_width)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:
-            print "Wrong data type"
-            return
-
-        image = np.flipud(np.reshape(imgdata, (self.image_height,
-                                               self.image_width), order='A'))
-        image = np.reshape(image, (1, self.image_height, self.image_width),
-                           order='A')
-        return image
+        data = stream_data(stream)
+        image = decode_image(data, self.image_height, self.image_width,
+                             self.data_type)
+        return image[np.newaxis]
 
     @validate_getter(["PositionInfo/AxisNames"])
     def get_axes_names(self):
-        if self._axes_names is None:
-            stream = self.file.openstream('PositionInfo/AxisNames')
-            data = stream.read()
-            lendatabytes = len(data)
-            formatstring = '<' + str(lendatabytes) + 'c'
-            struct_fmt = formatstring
-            axis_names_raw = struct.unpack(struct_fmt, data)
-            axis_names_raw = ''.join(axis_names_raw)
-            axis_names_raw = axis_names_raw.replace("\x00", " ")
-            self._axes_names = re.split('\s+\s+', axis_names_raw)
-            self._no_of_axes = len(self._axes_names) - 1
-        return self._axes_names
+        return self.header.axis_names
 
     axes_names = property(get_axes_names)
 
@@ -223,98 +183,52 @@ class XradiaFile(object):
 
     current_name = property(get_current_name)
 
+    @validate_getter(["PositionInfo/AxisNames"])
     def get_no_of_axes(self):
-        if self._no_of_axes is None:
-            self.get_axes_names()
-        return self._no_of_axes
+        return self.header.num_axes
 
     no_of_axes = property(get_no_of_axes)
 
     @validate_getter(["ImageInfo/NoOfImages"])
     def get_no_of_images(self):
-        if self._no_of_images is None:
-            stream = self.file.openstream('ImageInfo/NoOfImages')
-            data = stream.read()
-            nimages = struct.unpack('<I', data)
-            self._no_of_images = np.int(nimages[0])
-        return self._no_of_images
+        return np.int(self.header.no_of_images)
 
     no_of_images = property(get_no_of_images)
 
     @validate_getter(["ImageInfo/ImageWidth"])
     def get_image_width(self):
-        if self._image_width is None:
-            stream = self.file.openstream('ImageInfo/ImageWidth')
-            data = stream.read()
-            yimage = struct.unpack('<I', data)
-            self._image_width = np.int(yimage[0])
-        return self._image_width
+        return np.int(self.header.image_width)
 
     image_width = property(get_image_width)
 
     @validate_getter(["ImageInfo/ImageHeight"])
     def get_image_height(self):
-        if self._image_height is None:
-            stream = self.file.openstream('ImageInfo/ImageHeight')
-            data = stream.read()
-            yimage = struct.unpack('<I', data)
-            self._image_height = np.int(yimage[0])
-        return self._image_height
+        return np.int(self.header.image_height)
 
     image_height = property(get_image_height)
 
     @validate_getter(["PositionInfo/MotorPositions"])
     def get_machine_currents(self):
-        stream = self.file.openstream('PositionInfo/MotorPositions')
-        num_axes = len(self.axes_names) - 1
-        number_of_floats = num_axes * self.no_of_images
-        struct_fmt = '<' + str(number_of_floats) + 'f'
-        number_of_bytes = number_of_floats * 4  # 4 bytes every float
-        data = stream.read(number_of_bytes)
-        axis = struct.unpack(struct_fmt, data)
-
-        currents = self.no_of_images * [0]
-        for i in range(self.no_of_images):
-            currents[i] = axis[self.no_of_axes * i + 28]  # In mA
-        return currents
+        return self.header.motor_values(CURRENT)  # In mA
+
+    @validate_getter(["PositionInfo/MotorPositions"])
+    def get_motor_table(self):
+        # (nFrames, nAxes) positions of all the motors for each image
+        return self.header.motors[:self.no_of_images]
 
     @validate_getter([])
     def get_energies(self):
+        header = self.header
         if (self.energyenc_name.lower() == "energyenc"):
-            if self.file.exists('PositionInfo/MotorPositions'):
-                stream = self.file.openstream('PositionInfo/MotorPositions')
-                number_of_floats = self.no_of_axes * self.no_of_images
-                struct_fmt = '<' + str(number_of_floats) + 'f'
-                number_of_bytes = number_of_floats * 4  # 4 bytes every float
-                data = stream.read(number_of_bytes)
-                axis = struct.unpack(struct_fmt, data)
-                energies = self.no_of_images * [0]
-                for i in range(self.no_of_images):
-                    energies[i] = axis[self.no_of_axes * i + 30]  # In eV
+            if header.motors is not None:
+                energies = header.motor_values(ENERGYENC)  # In eV
         # Energy for each image calculated from Energy motor ####
         elif (self.energy_name == "Energy"):
-            if self.file.exists('PositionInfo/MotorPositions'):
-                stream = self.file.openstream('PositionInfo/MotorPositions')
-                number_of_floats = self.no_of_axes * self.no_of_images
-                struct_fmt = '<' + str(number_of_floats) + 'f'
-                number_of_bytes = number_of_floats * 4  # 4 bytes every float
-                data = stream.read(number_of_bytes)
-                axis = struct.unpack(struct_fmt, data)
-                energies = self.no_of_images * [0]
-                for i in range(self.no_of_images):
-                    energies[i] = axis[self.no_of_axes * i + 27]  # In eV
+            if header.motors is not None:
+                energies = header.motor_values(ENERGY)  # In eV
         # Energy for each image calculated from ImageInfo ####
-        elif self.file.exists('ImageInfo/Energy'):
-            stream = self.file.openstream('ImageInfo/Energy')
-            data = stream.read()
-            struct_fmt = "<{0:10}f".format(self.no_of_images)
-            try:  # we found some txrm images (flatfields) with different encoding of data
-                energies = struct.unpack(struct_fmt, data)
-            except struct.error:
-                print >> sys.stderr, 'Unexpected data length (%i bytes). Trying to unpack energies with: "f"+"36xf"*(nSampleFrames-1)' % len(
-                    data)
-                struct_fmt = '<' + "f" + "36xf" * (self.no_of_images - 1)
-                energies = struct.unpack(struct_fmt, data)
+        elif header.energies is not None:
+            energies = header.energies
         else:
             raise RuntimeError("There is no information about the energies at"
                                "which have been taken the different images.")
@@ -322,155 +236,140 @@ class XradiaFile(object):
 
     @validate_getter(["ImageInfo/ExpTimes"])
     def get_exp_times(self):
-        stream = self.file.openstream('ImageInfo/ExpTimes')
-        data = stream.read()
-        struct_fmt = "<{0:10}f".format(self.no_of_images)
-        try:  # we found some txrm images (flatfields) with different encoding of data
-            exp_times = struct.unpack(struct_fmt, data)
-        except struct.error:
-            print >> sys.stderr, 'Unexpected data length (%i bytes). Trying to unpack exposure times with: "f"+"36xf"*(nSampleFrames-1)' % len(
-                data)
-            struct_fmt = '<' + "f" + "36xf" * (self.no_of_images - 1)
-            exp_times = struct.unpack(struct_fmt, data)
-        return exp_times
+        return self.header.exp_times
 
     @validate_getter(['ImageInfo/Angles'])
     def get_angles(self):
-        stream = self.file.openstream('ImageInfo/Angles')
-        data = stream.read()
-        struct_fmt = '<{0:10}f'.format(self.no_of_images)
-        angles = struct.unpack(struct_fmt, data)
-        return angles
+        return self.header.angles
 
     @validate_getter(['ImageInfo/XPosition'])
     def get_x_positions(self):
-        stream = self.file.openstream('ImageInfo/XPosition')
-        data = stream.read()
-        struct_fmt = "<{0:10}f".format(self.no_of_images)
-        # Found some txrm images with different encoding of data #
-        try:
-            positions = struct.unpack(struct_fmt, data)
-        except struct.error:
-            print >> sys.stderr, 'Unexpected data length (%i bytes). Trying to unpack XPositions with: "f"+"36xf"*(nSampleFrames-1)' % len(
-                data)
-            struct_fmt = '<' + "f" + "36xf" * (self.no_of_images - 1)
-            positions = struct.unpack(struct_fmt, data)
-        return positions
+        return self.header.x_positions
 
     @validate_getter(['ImageInfo/YPosition'])
     def get_y_positions(self):
-        stream = self.file.openstream('ImageInfo/YPosition')
-        data = stream.read()
-        struct_fmt = "<{0:10}f".format(self.no_of_images)
-        # Found some txrm images with different encoding of data #
-        try:
-            positions = struct.unpack(struct_fmt, data)
-        except struct.error:
-            print >> sys.stderr, 'Unexpected data length (%i bytes). Trying to unpack YPositions with: "f"+"36xf"*(nSampleFrames-1)' % len(
-                data)
-            struct_fmt = '<' + "f" + "36xf" * (self.no_of_images - 1)
-            positions = struct.unpack(struct_fmt, data)
-        return positions
+        return self.header.y_positions
 
     @validate_getter(['ImageInfo/ZPosition'])
     def get_z_positions(self):
-        stream = self.file.openstream('ImageInfo/ZPosition')
-        data = stream.read()
-        struct_fmt = "<{0:10}f".format(self.no_of_images)
-        # Found some txrm images with different encoding of data #
-        try:
-            positions = struct.unpack(struct_fmt, data)
-        except struct.error:
-            print >> sys.stderr, 'Unexpected data length (%i bytes). Trying to unpack ZPositions with: "f"+"36xf"*(nSampleFrames-1)' % len(
-                data)
-            struct_fmt = '<' + "f" + "36xf" * (self.no_of_images - 1)
-            positions = struct.unpack(struct_fmt, data)
-        return positions
+        return self.header.z_positions
 
     @validate_getter(["ImageInfo/DataType"])
     def get_data_type(self):
-        if self._data_type is None:
-            stream = self.file.openstream('ImageInfo/DataType')
-            data = stream.read()
-            struct_fmt = '<1I'
-            datatype = struct.unpack(struct_fmt, data)
-            datatype = int(datatype[0])
-            if datatype == 5:
-                self._data_type = 'uint16'
-            else:
-                self._data_type = 'float'
-        return self._data_type
+        return self.header.data_type
 
     data_type = property(get_data_type)
 
     @validate_getter(["ImageInfo/Date"])
     def get_dates(self):
-        if self._dates is None:
-            stream = self.file.openstream('ImageInfo/Date')
-            data = stream.read()
-            self._dates = struct.unpack('<' + '17s23x' * self.no_of_images,
-                                        data)
-        return self._dates
+        return self.header.dates
 
     dates = property(get_dates)
 
-    def get_start_date(self):
-
-        startdate = self.dates[0]
-        [day, hour] = startdate.split(" ")
-        [month, day, year] = day.split("/")
-        [hour, minute, second] = hour.split(":")
-
-        year = '20' + year
-        year = int(year)
-        month = int(month)
-        day = int(day)
-        hour = int(hour)
-        minute = int(minute)
-        second = int(second)
+    @validate_getter(["ImageInfo/Date"])
+    def get_timestamps(self):
+        # datetime64 of each image
+        return self.header.timestamps[:self.no_of_images]
 
-        starttime = datetime.datetime(year, month, day,
-                                      hour, minute, second)
-        starttimeiso = starttime.isoformat()
-        return starttimeiso
+    def get_start_date(self):
+        return iso_time(self.get_timestamps()[0])
 
     def get_end_date(self):
-        enddate = self.dates[self.no_of_images - 1]
-        [endday, endhour] = enddate.split(" ")
-        [endmonth, endday, endyear] = endday.split("/")
-        [endhour, endminute, endsecond] = endhour.split(":")
-
-        endyear = '20' + endyear
-        endyear = int(endyear)
-        endmonth = int(endmonth)
-        endday = int(endday)
-        endhour = int(endhour)
-        endminute = int(endminute)
-        endsecond = int(endsecond)
-
-        endtime = datetime.datetime(endyear, endmonth, endday,
-                                    endhour, endminute, endsecond)
-        endtimeiso = endtime.isoformat()
-        return endtimeiso
+        return iso_time(self.get_timestamps()[-1])
 
     @validate_getter(["ConfigureBackup/ConfigCamera/" +
                       "Camera 1/ConfigZonePlates/DetZero"])
     def get_det_zero(self):
-        if self._det_zero is None:
-            stream = self.file.openstream("ConfigureBackup/ConfigCamera/" +
-                                          "Camera 1/ConfigZonePlates/DetZero")
-            data = stream.read()
-            if (len(data) != 0):
-                struct_fmt = '<1f'
-                sample_to_detector_zero_enc = struct.unpack(struct_fmt, data)
-                self._det_zero = sample_to_detector_zero_enc[0]
-            else:
-                self._det_zero = 0
-        return self._det_zero
+        return self.header.det_zero
 
     det_zero = property(get_det_zero)
 
 
+def read_xrm_image(file_name):
+    """
+    Image of the xrm file file_name, as returned by XradiaFile.get_image.
+    Used to decode the xrm files in the processes of an OrderedProcessPool.
+    """
+    with XradiaFile(file_name) as xrm_file:
+        return xrm_file.get_image()
+
+
+def read_frames(reader, nframes, jobs=0,
+                prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+                prefetch_memory=DEFAULT_PREFETCH_MEMORY):
+    """
+    Images of the xrmReader reader, in order, and the object reading them
+    (to be used as a context manager): a pool of jobs processes decoding
+    the files, or a prefetcher reading them in advance (always if the
+    reader caches its images).
+    """
+    if jobs > 0 and not reader.cache_images:
+        pool = OrderedProcessPool(jobs)
+        return pool, pool.imap(read_xrm_image, reader.file_names)
+    frames = FramePrefetcher(reader.get_image, range(nframes),
+                             prefetch_depth, prefetch_memory)
+    return frames, frames
+
+
+def write_bright_field(group, ff_reader, storage=None, write_batch=None,
+                       read=read_frames, pipeline=None):
+    """
+    Write the images of the bright field files of ff_reader, and their
+    metadata, in group. The images are read with read(ff_reader, nframes)
+    (see read_frames) or, if a ConversionPipeline is given, added to it.
+    """
+    storage = storage or DatasetStorage()
+    datatype = ff_reader.get_data_type()
+    numrows, numcols = ff_reader.get_image_size()
+    nframes = ff_reader.get_images_number()
+    storage.create_dataset(group, "data", (nframes, numrows, numcols),
+                           datatype, ff_reader.get_image)
+    group['data'].attrs['Data Type'] = datatype
+    group['data'].attrs['Image Height'] = numrows
+    group['data'].attrs['Image Width'] = numcols
+
+    writer = storage.frame_writer(group['data'], 0, write_batch)
+    if pipeline is not None:
+        pipeline.add('Bright-Field images', range(nframes),
+                     ff_reader.get_image, None, writer)
+    else:
+        source, frames = read(ff_reader, nframes)
+        with source, writer:
+            for numimage, tomoimagesingle in enumerate(frames):
+                if numimage + 1 == nframes:
+                    print ('%i Bright-Field images '
+                           'converted\n' % nframes)
+                writer.append(tomoimagesingle)
+
+    # Positions of all the motors for each image of FF
+    motors, names = ff_reader.get_motor_table()
+    write_motor_table(group, motors, names)
+
+    # Accelerator current for each image of FF (machine current)
+    ff_currents = ff_reader.get_machine_currents()
+    group.create_dataset("current", data=ff_currents)
+    group["current"].attrs["units"] = "mA"
+
+    # Exposure Times
+    exp_times = ff_reader.get_exp_times()
+    group.create_dataset("ExpTimes", data=exp_times)
+    group["ExpTimes"].attrs["units"] = "s"
+
+
+def link_bright_field(group, file_name, directory):
+    """
+    Add to group an external link to each dataset of the bright field group
+    of the file file_name (see convert_xrm_bright_field), by its path
+    relative to the directory of the file of group.
+    """
+    relative_name = os.path.relpath(file_name, directory)
+    with h5py.File(file_name, 'r') as bright_field_file:
+        names = list(bright_field_file[BRIGHT_FIELD_GROUP])
+    for name in names:
+        group[name] = h5py.ExternalLink(
+            relative_name, '%s/%s' % (BRIGHT_FIELD_GROUP, name))
+
+
 class xrmNXtomo(object):
     definition = 'NXtomo'
     # CCD detector pixelsize in micrometers
@@ -483,7 +382,13 @@ class xrmNXtomo(object):
                  zero_deg_in=None, zero_deg_final=None, sourcename='ALBA',
                  sourcetype='Synchrotron X-ray Source',
                  sourceprobe='x-ray', instrument='BL09 @ ALBA',
-                 sample='Unknown'):
+                 sample='Unknown', prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+                 prefetch_memory=DEFAULT_PREFETCH_MEMORY, write_batch=None,
+                 pipeline=0, storage=None, jobs=0, atomic=False,
+                 bright_field_file=None):
+        if pipeline > 0 and jobs > 0:
+            raise ValueError("The images cannot be decoded by a pipeline "
+                             "and by processes at once")
         self.reader = reader
         self.ff_reader = ffreader
         if hdf5_output_path is None:
@@ -497,7 +402,16 @@ class xrmNXtomo(object):
         if not os.path.exists(path):
             os.makedirs(path)
         self.hdf5_file_name = os.path.join(path, "%s.hdf5" % sample_name)
-        self.txrmhdf = h5py.File(self.hdf5_file_name, 'w')
+        # With atomic, the file is written with a temporary name, renamed
+        # to hdf5_file_name once converted (see convert_tomography and
+        # discard)
+        self.atomic = atomic
+        if atomic:
+            self.hdf5_write_name = os.path.join(
+                path, ".%s.hdf5.part" % sample_name)
+        else:
+            self.hdf5_write_name = self.hdf5_file_name
+        self.txrmhdf = h5py.File(self.hdf5_write_name, 'w')
 
         self.filename_zerodeg_in = zero_deg_in
         self.filename_zerodeg_final = zero_deg_final
@@ -543,6 +457,24 @@ class xrmNXtomo(object):
         self.nFramesBright = 0
         self.datatype_bright = 'uint16'
 
+        # Images read in advance while the previous ones are converted
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_memory = prefetch_memory
+        # Number of images written at once (None: computed from memory)
+        self.write_batch = write_batch
+        # Threads decoding the images of the sample and bright field files
+        # converted concurrently by a pipeline (0: no pipeline)
+        self.pipeline_workers = pipeline
+        # Processes opening and decoding the xrm files (0: read in this
+        # process)
+        self.jobs = jobs
+        # Chunking and compression of the image stacks
+        self.storage = storage or DatasetStorage()
+        # File with the bright field shared by the tomos of the sample (see
+        # convert_xrm_bright_field), referenced instead of converting the
+        # images of ffreader
+        self.bright_field_file = bright_field_file
+
     def convert_metadata(self):
 
         self.nxentry = self.txrmhdf.create_group(self.definition)
@@ -601,6 +533,10 @@ class xrmNXtomo(object):
         magnification = self.reader.get_xray_magnification()
         self.nxdetectorsample['magnification'] = magnification
 
+        # Positions of all the motors for each image
+        motors, names = self.reader.get_motor_table()
+        write_motor_table(self.nxdetectorsample, motors, names)
+
         # Accelerator current for each image (machine current)
         currents = self.reader.get_machine_currents()
         self.nxdetectorsample['current'] = currents
@@ -621,6 +557,7 @@ class xrmNXtomo(object):
         self.nxentry['start_time'] = str(starttimeiso)
         endtimeiso = self.reader.get_end_time()
         self.nxentry['end_time'] = str(endtimeiso)
+        write_timestamps(self.nxentry, self.reader.get_timestamps())
 
         # Sample rotation angles
         angles = self.reader.get_angles()
@@ -648,7 +585,16 @@ class xrmNXtomo(object):
         self.nxsample['z_translation'] = zpositions
         self.nxsample['z_translation'].attrs['units'] = 'um'
 
-    def _convert_samples(self):
+    def _next_sequence_numbers(self, nframes):
+        first = self.count_num_sequence + 1
+        self.count_num_sequence += nframes
+        return range(first, self.count_num_sequence + 1)
+
+    def _read_frames(self, reader, nframes):
+        return read_frames(reader, nframes, self.jobs, self.prefetch_depth,
+                           self.prefetch_memory)
+
+    def _convert_samples(self, pipeline=None):
         self.numrows, self.numcols = self.reader.get_image_size()
         data_type = self.reader.get_data_type()
         self.nSampleFrames = self.reader.get_images_number()
@@ -658,15 +604,12 @@ class xrmNXtomo(object):
         else:
             self.datatype = data_type
 
-        self.nxdetectorsample.create_dataset(
+        self.storage.create_dataset(
+            self.nxdetectorsample,
             "data",
-            shape=(self.nSampleFrames,
-                   self.numrows,
-                   self.numcols),
-            chunks=(1,
-                    self.numrows,
-                    self.numcols),
-            dtype=self.datatype)
+            (self.nSampleFrames, self.numrows, self.numcols),
+            self.datatype,
+            self.reader.get_image)
 
         self.nxdetectorsample['data'].attrs[
             'Data Type'] = self.datatype
@@ -677,16 +620,24 @@ class xrmNXtomo(object):
         self.nxdetectorsample['data'].attrs[
             'Image Width'] = self.numcols
 
-        for numimage in range(self.nSampleFrames):
-            self.count_num_sequence = self.count_num_sequence + 1
-            tomoimagesingle = self.reader.get_image(numimage)
-            self.num_sample_sequence.append(
-                self.count_num_sequence)
-            self.nxdetectorsample['data'][numimage] = tomoimagesingle
-            if numimage % 20 == 0:
-                print('Image %i converted' % numimage)
-            if numimage + 1 == self.nSampleFrames:
-                print ('%i images converted\n' % self.nSampleFrames)
+        writer = self.storage.frame_writer(self.nxdetectorsample['data'], 0,
+                                           self.write_batch)
+        if pipeline is not None:
+            pipeline.add('images', range(self.nSampleFrames),
+                         self.reader.get_image, None, writer)
+        else:
+            source, frames = self._read_frames(self.reader,
+                                               self.nSampleFrames)
+            with source, writer:
+                for numimage, tomoimagesingle in enumerate(frames):
+                    writer.append(tomoimagesingle)
+                    if numimage % 20 == 0:
+                        print('Image %i converted' % numimage)
+                    if numimage + 1 == self.nSampleFrames:
+                        print ('%i images converted\n' % self.nSampleFrames)
+            print(source.report())
+        self.num_sample_sequence.extend(
+            self._next_sequence_numbers(self.nSampleFrames))
 
         # h5py NeXus link
         source_addr = '/NXtomo/instrument/sample/data'
@@ -696,84 +647,43 @@ class xrmNXtomo(object):
         self.nxdata._id.link(source_addr, target_addr,
                              h5py.h5g.LINK_HARD)
 
-    def _convert_bright(self):
-        self.datatype_bright = self.ff_reader.get_data_type()
-        self.numrows_bright, self.numcols_bright = \
-            self.ff_reader.get_image_size()
-        self.nFramesBright = self.ff_reader.get_images_number()
-
+    def _convert_bright(self, pipeline=None):
         self.nxbright = self.nxinstrument.create_group("bright_field")
         self.nxbright.attrs['NX_class'] = "Unknown"
-        self.nxbright.create_dataset(
-            "data",
-            shape=(self.nFramesBright,
-                   self.numrows_bright,
-                   self.numcols_bright),
-            chunks=(1,
-                    self.numrows_bright,
-                    self.numcols_bright),
-            dtype=self.datatype_bright)
-        self.nxbright['data'].attrs['Data Type'] = \
-            self.datatype_bright
-        self.nxbright['data'].attrs['Image Height'] = \
-            self.numrows_bright
-        self.nxbright['data'].attrs['Image Width'] = \
-            self.numcols_bright
-
-        for numimage in range(self.nFramesBright):
-            if numimage + 1 == self.nFramesBright:
-                print ('%i Bright-Field images '
-                       'converted\n' % self.nFramesBright)
-            self.count_num_sequence = self.count_num_sequence + 1
-            tomoimagesingle = self.ff_reader.get_image(numimage)
-            self.num_bright_sequence.append(self.count_num_sequence)
-            self.nxbright['data'][numimage] = tomoimagesingle
-
-        # Accelerator current for each image of FF (machine current)
-        ff_currents = self.ff_reader.get_machine_currents()
-        self.nxbright.create_dataset("current", data=ff_currents)
-        self.nxbright["current"].attrs["units"] = "mA"
-
-        # Exposure Times
-        exp_times = self.ff_reader.get_exp_times()
-        self.nxbright.create_dataset("ExpTimes", data=exp_times)
-        self.nxbright["ExpTimes"].attrs["units"] = "s"
+        if self.bright_field_file is not None:
+            link_bright_field(self.nxbright, self.bright_field_file,
+                              os.path.dirname(self.hdf5_file_name))
+        else:
+            write_bright_field(self.nxbright, self.ff_reader, self.storage,
+                               self.write_batch, self._read_frames, pipeline)
+        data = self.nxbright['data']
+        self.datatype_bright = data.attrs['Data Type']
+        self.nFramesBright, self.numrows_bright, self.numcols_bright = \
+            data.shape
+        self.num_bright_sequence.extend(
+            self._next_sequence_numbers(self.nFramesBright))
 
     def _convert_zero_deg_images(self, ole_zerodeg):
         verbose = False
+        header = read_header_snapshot(ole_zerodeg)
         # DataType: 10 float; 5 uint16 (unsigned 16-bit (2-byte) integers)
-        if ole_zerodeg.exists('ImageInfo/DataType'):
-            stream = ole_zerodeg.openstream('ImageInfo/DataType')
-            data = stream.read()
-            struct_fmt = '<1I'
-            datatype_zerodeg = struct.unpack(struct_fmt, data)
-            datatype_zerodeg = int(datatype_zerodeg[0])
-            if datatype_zerodeg == 5:
-                self.datatype_zerodeg = 'uint16'
-            else:
-                self.datatype_zerodeg = 'float'
+        if header.data_type is not None:
+            self.datatype_zerodeg = header.data_type
             if verbose:
                 print "ImageInfo/DataType: %s " % self.datatype_zerodeg
         else:
             print("There is no information about DataType")
 
         # Zero degrees data size
-        if (ole_zerodeg.exists('ImageInfo/NoOfImages') and
-                ole_zerodeg.exists('ImageInfo/ImageWidth') and
-                ole_zerodeg.exists('ImageInfo/ImageHeight')):
-
-            stream = ole_zerodeg.openstream('ImageInfo/ImageHeight')
-            data = stream.read()
-            yimage = struct.unpack('<I', data)
-            self.numrows_zerodeg = np.int(yimage[0])
-            if verbose:
-                print "ImageInfo/ImageHeight = %i" % yimage[0]
-            stream = ole_zerodeg.openstream('ImageInfo/ImageWidth')
-            data = stream.read()
-            ximage = struct.unpack('<I', data)
-            self.numcols_zerodeg = np.int(ximage[0])
+        if (header.no_of_images is not None and
+                header.image_width is not None and
+                header.image_height is not None):
+
+            self.numrows_zerodeg = np.int(header.image_height)
+            self.numcols_zerodeg = np.int(header.image_width)
             if verbose:
-                print "ImageInfo/ImageWidth = %i" % ximage[0]
+                print "ImageInfo/ImageHeight = %i" % self.numrows_zerodeg
+                print "ImageInfo/ImageWidth = %i" % self.numcols_zerodeg
         else:
             print('There is no information about the 0 degrees image size '
                   '(ImageHeight, or about ImageWidth)')
@@ -781,22 +691,10 @@ class xrmNXtomo(object):
         if ole_zerodeg.exists('ImageData1/Image1'):
             img_string = "ImageData1/Image1"
             stream = ole_zerodeg.openstream(img_string)
-            data = stream.read()
-            if self.datatype == 'uint16':
-                struct_fmt = "<{0:10}H".format(self.numrows_zerodeg *
-                                               self.numcols_zerodeg)
-                imgdata = struct.unpack(struct_fmt, data)
-            elif self.datatype == 'float':
-                struct_fmt = "<{0:10}f".format(self.numrows_zerodeg *
-                                               self.numcols_zerodeg)
-                imgdata = struct.unpack(struct_fmt, data)
-            else:
-                print "Wrong data type"
-
-            imgdata_zerodeg = np.flipud(np.reshape(imgdata,
-                                                   (self.numrows,
-                                                    self.numcols),
-                                                   order='A'))
+            data = stream_data(stream)
+            imgdata_zerodeg = decode_image(data, self.numrows_zerodeg,
+                                           self.numcols_zerodeg,
+                                           self.datatype_zerodeg)
         else:
             imgdata_zerodeg = 0
         return imgdata_zerodeg
@@ -836,21 +734,30 @@ class xrmNXtomo(object):
 
         print("\nConverting tomography image data from xrm(s) to NeXus HDF5.")
 
+        # With a pipeline, the images of all the files are converted
+        # concurrently once all of them have been added to it
+        pipeline = None
+        if self.pipeline_workers > 0:
+            pipeline = ConversionPipeline(self.pipeline_workers,
+                                          max_bytes=self.prefetch_memory)
         brightexists = False
         darkexists = False
         for file in self.file_order:
             # Tomography Data Images
             if file == 's':
-                self._convert_samples()
+                self._convert_samples(pipeline)
             # Bright-Field
             elif file == 'b':
                 brightexists = True
-                self._convert_bright()
+                self._convert_bright(pipeline)
             # Post-Dark-Field
             elif file == 'd':
                 darkexists = True
                 # TODO
                 pass
+        if pipeline is not None:
+            pipeline.run()
+            print(pipeline.report())
 
         self.nxinstrument['sample']['sequence_number'] = \
             self.num_sample_sequence
@@ -872,116 +779,293 @@ class xrmNXtomo(object):
         # Flush and close the nexus file
         self.txrmhdf.flush()
         self.txrmhdf.close()
+        if self.atomic:
+            os.rename(self.hdf5_write_name, self.hdf5_file_name)
+
+    def discard(self):
+        """Close the file after a failed conversion and remove it if atomic"""
+        if self.txrmhdf:
+            self.txrmhdf.close()
+        if self.atomic and os.path.exists(self.hdf5_write_name):
+            os.remove(self.hdf5_write_name)
+
+
+# Group of the bright field in the file shared by the tomos of a sample
+BRIGHT_FIELD_GROUP = 'bright_field'
+
+# Maximum number of xrm files kept open by an xrmReader
+DEFAULT_MAX_OPEN_FILES = 64
+
+# Per-image metadata of the xrm files collected by xrmReader, and the
+# XradiaFile getters returning them
+XRM_METADATA = (('exp_times', 'get_exp_times'),
+                ('machine_currents', 'get_machine_currents'),
+                ('energies', 'get_energies'),
+                ('angles', 'get_angles'),
+                ('x_positions', 'get_x_positions'),
+                ('y_positions', 'get_y_positions'),
+                ('z_positions', 'get_z_positions'),
+                ('motor_table', 'get_motor_table'),
+                ('timestamps', 'get_timestamps'))
+
+
+def default_max_open_files():
+    """
+    Number of files kept open by default: DEFAULT_MAX_OPEN_FILES, or a
+    quarter of the open files allowed to the process if it is less.
+    """
+    try:
+        import resource
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, ValueError):
+        return DEFAULT_MAX_OPEN_FILES
+    if soft == resource.RLIM_INFINITY:
+        return DEFAULT_MAX_OPEN_FILES
+    return max(1, min(DEFAULT_MAX_OPEN_FILES, soft // 4))
+
+
+class XradiaFilePool(object):
+    """
+    XradiaFiles kept open to be read several times: at most max_open of
+    them, the least recently used one is closed to open another one.
+    A file is checked out of the pool while it is used (see use), so the
+    lock of the pool is only held to check files out and to return them,
+    never while they are read or opened.
+    """
+
+    def __init__(self, max_open=None):
+        if max_open is None:
+            max_open = default_max_open_files()
+        if max_open < 1:
+            raise ValueError("At least one file must be kept open")
+        self.max_open = max_open
+        # number of times a file has been opened
+        self.opened = 0
+        # files not in use, the least recently used first
+        self._files = OrderedDict()
+        # number of files in use
+        self._busy = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self, file_name):
+        """
+        Context manager returning the XradiaFile file_name, open. If the
+        file is already in use, another XradiaFile of it is opened. While
+        all the files are in use, more than max_open files may be open.
+        """
+        xrm_file = self._check_out(file_name)
+        try:
+            yield xrm_file
+        finally:
+            self._return(file_name, xrm_file)
+
+    def _check_out(self, file_name):
+        to_close = []
+        with self._lock:
+            xrm_file = self._files.pop(file_name, None)
+            self._busy += 1
+            if xrm_file is None:
+                # room for the file to open
+                while self._files and \
+                        len(self._files) + self._busy > self.max_open:
+                    to_close.append(self._files.popitem(last=False)[1])
+        for old_file in to_close:
+            old_file.close()
+        if xrm_file is not None:
+            return xrm_file
+        try:
+            xrm_file = XradiaFile(file_name)
+            xrm_file.open()
+        except Exception:
+            with self._lock:
+                self._busy -= 1
+            raise
+        with self._lock:
+            self.opened += 1
+        return xrm_file
+
+    def _return(self, file_name, xrm_file):
+        to_close = []
+        with self._lock:
+            self._busy -= 1
+            # the file of file_name returned last is kept
+            previous = self._files.pop(file_name, None)
+            if previous is not None:
+                to_close.append(previous)
+            self._files[file_name] = xrm_file
+            while len(self._files) + self._busy > self.max_open:
+                to_close.append(self._files.popitem(last=False)[1])
+        for old_file in to_close:
+            old_file.close()
+
+    def close(self):
+        """Close all the files which are not in use"""
+        with self._lock:
+            files = self._files.values()
+            self._files.clear()
+        for xrm_file in files:
+            xrm_file.close()
 
 
 class xrmReader(object):
-    def __init__(self, file_names):
+    """
+    Images and metadata of a sequence of xrm files (one image per file).
+    The per-image metadata of all the files (see XRM_METADATA) is read in
+    one pass, the first time that it is needed, and the images are read
+    from a pool of at most max_open_files open files.
+
+    With cache_images, the images are decoded once and kept in memory, to
+    be converted several times (the bright field shared by several tomos).
+    """
+
+    def __init__(self, file_names, max_open_files=None, cache_images=False):
         self.file_names = file_names
+        self._files = XradiaFilePool(max_open_files)
+        self._metadata = None
+        self._metadata_errors = None
+        self.cache_images = cache_images
+        self._images = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the files and release the cached images"""
+        self._files.close()
+        self._images = {}
+
+    def preload(self):
+        """
+        Read the metadata and cache the images of all the files, and close
+        them: the reader can then be shared by forked processes, which
+        reopen the files if they need them.
+        """
+        if self._metadata is None:
+            self._read_metadata()
+        if self.cache_images:
+            for numimage in range(len(self.file_names)):
+                self.get_image(numimage)
+        self._files.close()
+
+    def _read_metadata(self):
+        # Each getter is called for every file, and its values of all the
+        # files are joined in an array. A missing stream only raises when
+        # the values that need it are asked for.
+        values = dict((name, []) for name, getter in XRM_METADATA)
+        errors = {}
+        for file_name in self.file_names:
+            with self._files.use(file_name) as xrm_file:
+                for name, getter in XRM_METADATA:
+                    if name in errors:
+                        continue
+                    try:
+                        values[name].append(getattr(xrm_file, getter)())
+                    except Exception as error:
+                        errors[name] = error
+        self._metadata = dict((name, np.concatenate(values[name]))
+                              for name in values
+                              if name not in errors and values[name])
+        self._metadata_errors = errors
+
+    def get_metadata(self, name):
+        """Values of all the images of the metadata name (see XRM_METADATA)"""
+        if self._metadata is None:
+            self._read_metadata()
+        if name in self._metadata_errors:
+            raise self._metadata_errors[name]
+        return self._metadata[name]
 
     def get_images_number(self):
         return len(self.file_names)
 
     def get_pixel_size(self):
         file_name = self.file_names[0]
-        with XradiaFile(file_name) as xrm_file:
+        with self._files.use(file_name) as xrm_file:
             return xrm_file.pixel_size
 
     def get_exp_times(self):
-        exp_times = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                exp_times.extend(xrm_file.get_exp_times())
-        return exp_times
+        return self.get_metadata('exp_times')
 
     def get_machine_currents(self):
-        currents = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                currents.extend(xrm_file.get_machine_currents())
-        return currents
+        return self.get_metadata('machine_currents')
+
+    def get_motor_table(self):
+        # Motor table of all the files (one row per image) and the names of
+        # its columns
+        with self._files.use(self.file_names[0]) as xrm_file:
+            names = xrm_file.header.motor_names
+        return self.get_metadata('motor_table'), names
 
     def get_energies(self):
-        energies = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                energies.extend(xrm_file.get_energies())
-        return energies
+        return self.get_metadata('energies')
 
     def get_start_time(self):
-        filename = self.file_names[0]
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_start_date()
+        return iso_time(self.get_metadata('timestamps')[0])
 
     def get_end_time(self):
-        filename = self.file_names[-1]
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_end_date()
+        return iso_time(self.get_metadata('timestamps')[-1])
+
+    def get_timestamps(self):
+        return self.get_metadata('timestamps')
 
     def get_angles(self):
-        angles = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                angles.extend(xrm_file.get_angles())
-        return angles
+        return self.get_metadata('angles')
 
     def get_x_positions(self):
-        positions = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                positions.extend(xrm_file.get_x_positions())
-        return positions
+        return self.get_metadata('x_positions')
 
     def get_y_positions(self):
-        positions = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                positions.extend(xrm_file.get_y_positions())
-        return positions
+        return self.get_metadata('y_positions')
 
     def get_z_positions(self):
-        positions = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                positions.extend(xrm_file.get_z_positions())
-        return positions
+        return self.get_metadata('z_positions')
 
     def get_image(self, id):
         """
         :param id: number of the images sequence
         :return: image data
         """
-        filename = self.file_names[id]
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_image()
+        image = self._images.get(id)
+        if image is None:
+            filename = self.file_names[id]
+            with self._files.use(filename) as xrm_file:
+                image = xrm_file.get_image()
+            if self.cache_images:
+                self._images[id] = image
+        return image
 
     def get_distance(self):
         filename = self.file_names[0]
         # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
+        with self._files.use(filename) as xrm_file:
             return xrm_file.get_distance()
 
     def get_sample_id(self):
         filename = self.file_names[0]
         # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
+        with self._files.use(filename) as xrm_file:
             return xrm_file.get_sample_id()
 
     def get_xray_magnification(self):
         filename = self.file_names[0]
         # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
+        with self._files.use(filename) as xrm_file:
             return xrm_file.get_xray_magnification()
 
     def get_data_type(self):
         filename = self.file_names[0]
         # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
+        with self._files.use(filename) as xrm_file:
             return xrm_file.data_type
 
     def get_image_size(self):
         filename = self.file_names[0]
         # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
+        with self._files.use(filename) as xrm_file:
             return xrm_file.image_height, xrm_file.image_width
 
     def get_sample_name(self):
@@ -1001,3 +1085,69 @@ class xrmReader(object):
         filename = self.file_names[0]
         path = filename.rsplit('/', 1)[0]
         return path
+
+
+def convert_xrm_tomo(tomo_files, ffreader, program_args, **options):
+    """
+    Convert the tomography of the xrm files tomo_files, with the bright
+    field of the xrmReader ffreader (which can be shared by several tomos,
+    and can be None with the option bright_field_file), to a NeXus file
+    written atomically (see xrmNXtomo, which takes the options). If the
+    conversion fails, the file is removed. Returns the name of the file.
+    """
+    with xrmReader(tomo_files) as reader:
+        xrm = xrmNXtomo(reader, ffreader, 'sb', 'xrm2nexus', program_args,
+                        atomic=True, **options)
+        try:
+            xrm.convert_metadata()
+            xrm.convert_tomography()
+        except BaseException:
+            xrm.discard()
+            raise
+    return xrm.hdf5_file_name
+
+
+def bright_field_file_name(ff_files, hdf5_output_path=None):
+    """
+    Name of the file with the bright field of the sample of the xrm files
+    ff_files (see convert_xrm_bright_field), in the directory of the NeXus
+    files of its tomos.
+    """
+    path, file_name = os.path.split(ff_files[0])
+    if hdf5_output_path is not None:
+        path = hdf5_output_path
+    splitted_file = file_name.split('_')
+    return os.path.join(path, '_'.join(splitted_file[:2]),
+                        '%s_FF.hdf5' % '_'.join(splitted_file[:3]))
+
+
+def convert_xrm_bright_field(ff_files, file_name, storage=None,
+                             write_batch=None, jobs=0,
+                             prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+                             prefetch_memory=DEFAULT_PREFETCH_MEMORY):
+    """
+    Convert the bright field xrm files ff_files to the group
+    BRIGHT_FIELD_GROUP of the HDF5 file file_name, written atomically,
+    which can be referenced by the NeXus files of all the tomos of the
+    sample (see xrmNXtomo). Returns file_name.
+    """
+    path, name = os.path.split(file_name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    write_name = os.path.join(path, '.%s.part' % name)
+
+    def read(reader, nframes):
+        return read_frames(reader, nframes, jobs, prefetch_depth,
+                           prefetch_memory)
+    try:
+        with xrmReader(ff_files) as ffreader, \
+                h5py.File(write_name, 'w') as hdf5_file:
+            group = hdf5_file.create_group(BRIGHT_FIELD_GROUP)
+            group.attrs['NX_class'] = "Unknown"
+            write_bright_field(group, ffreader, storage, write_batch, read)
+    except BaseException:
+        if os.path.exists(write_name):
+            os.remove(write_name)
+        raise
+    os.rename(write_name, file_name)
+    return file_name